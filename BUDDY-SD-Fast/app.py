@@ -1,26 +1,57 @@
 # BUDDY-SD-Fast: CPU Image Generator
 # FastAPI app for image generation with CPU optimization
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import Response
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
 from pydantic import BaseModel
-from diffusers import StableDiffusionPipeline
+from diffusers import (
+    StableDiffusionPipeline,
+    StableDiffusionImg2ImgPipeline,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    LCMScheduler
+)
 import torch
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageFilter
 import io
-import base64
+import os
+import resource
+import time
+import asyncio
+import contextvars
+import random
+import multiprocessing
 import json
+import uuid
 
-app = FastAPI(title="BUDDY-SD-Fast API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app):
+    """Bind the port right away and load the model in the background"""
+    loader = asyncio.create_task(load_in_background())
+    yield
+    loader.cancel()
+    scheduler.shutdown()
 
-# Load model once at startup with CPU optimization
+app = FastAPI(title="BUDDY-SD-Fast API", version="1.0.0", lifespan=lifespan)
+
+# Keep downloaded weights on persistent storage (/data on Spaces) so restarts skip the download
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR") or ("/data/hf_cache" if os.path.isdir("/data") else None)
+
+# Load model with CPU optimization (called from the background loader)
 def load_model():
     """Load Stable Diffusion model with CPU optimization"""
     try:
         pipe = StableDiffusionPipeline.from_pretrained(
             "CompVis/stable-diffusion-v1-4",
             torch_dtype=torch.float32,  # Use float32 for CPU compatibility
-            use_safetensors=True,
+            use_safetensors=True,  # memory-mapped, zero-copy weight loading
+            cache_dir=MODEL_CACHE_DIR,
             safety_checker=None,  # Disable safety checker for speed
             low_cpu_mem_usage=True  # Optimize for CPU memory usage
         )
@@ -31,11 +62,997 @@ def load_model():
         print(f"❌ Error loading model: {e}")
         return None
 
-# Load the model
-pipe = load_model()
+# Explicit thread counts must be set before torch starts any parallel work
+INTRA_OP_THREADS = int(os.getenv("SD_INTRA_OP_THREADS", "0")) or None
+INTER_OP_THREADS = int(os.getenv("SD_INTER_OP_THREADS", "0")) or None
+if INTRA_OP_THREADS:
+    torch.set_num_threads(INTRA_OP_THREADS)
+if INTER_OP_THREADS:
+    torch.set_num_interop_threads(INTER_OP_THREADS)
+
+# Filled in by the background loader once the server is up
+pipe = None
+img2img = None  # Shares pipe's components, used by /refine
+
+# Optional LCM LoRA for few-step drafts, e.g. latent-consistency/lcm-lora-sdv1-5
+LCM_LORA = os.getenv("LCM_LORA")
+
+def build_schedulers(pipe):
+    """Build the fast schedulers once from the pipeline config so requests can swap them in"""
+    if pipe is None:
+        return {}
+    config = pipe.scheduler.config
+    schedulers = {
+        "default": pipe.scheduler,
+        "dpm++": DPMSolverMultistepScheduler.from_config(
+            config, algorithm_type="dpmsolver++", use_karras_sigmas=True
+        ),
+        "euler_a": EulerAncestralDiscreteScheduler.from_config(config)
+    }
+    if LCM_LORA:
+        try:
+            # LoRA layers stay loaded; non-LCM requests run them at scale 0
+            pipe.load_lora_weights(LCM_LORA)
+            schedulers["lcm"] = LCMScheduler.from_config(config)
+            print(f"✅ LCM LoRA loaded: {LCM_LORA}")
+        except Exception as e:
+            print(f"⚠️  Could not load LCM LoRA {LCM_LORA}: {e}")
+    return schedulers
+
+SCHEDULERS = build_schedulers(pipe)
+
+def build_tiers(schedulers):
+    """Speed/quality tiers; explicit steps/scheduler/guidance in a request override the preset"""
+    return {
+        "draft": (
+            {"steps": 4, "scheduler": "lcm", "guidance_scale": 1.0}
+            if "lcm" in schedulers
+            else {"steps": 8, "scheduler": "dpm++", "guidance_scale": 7.5}
+        ),
+        "standard": {"steps": 20, "scheduler": "dpm++", "guidance_scale": 7.5},
+        "quality": {"steps": 50, "scheduler": "default", "guidance_scale": 7.5}
+    }
+
+TIERS = build_tiers(SCHEDULERS)
+DEFAULT_TIER = os.getenv("DEFAULT_TIER", "standard")  # 20-step renders for speed
+
+# CPU engine options, each switchable by environment variable and reported by /health
+ENGINE_OPTIONS = {
+    "bf16_autocast": os.getenv("SD_BF16_AUTOCAST", "false").lower() == "true",
+    "int8_dynamic": os.getenv("SD_INT8_DYNAMIC", "false").lower() == "true",
+    "channels_last": os.getenv("SD_CHANNELS_LAST", "false").lower() == "true",
+    "torch_compile": os.getenv("SD_TORCH_COMPILE", "false").lower() == "true",
+    "attention_slicing": os.getenv("SD_ATTENTION_SLICING", "false").lower() == "true",
+    "vae_slicing": os.getenv("SD_VAE_SLICING", "false").lower() == "true"
+}
+
+def cpu_supports_bf16():
+    """bf16 autocast only pays off on CPUs with native bf16 instructions"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+class DynamicInt8Linear(torch.nn.Module):
+    """Dynamically quantized stand-in for diffusers' Linear layers (ignores the LoRA scale arg)"""
+
+    def __init__(self, linear):
+        super().__init__()
+        plain = torch.nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        plain.weight = linear.weight
+        plain.bias = linear.bias
+        plain.qconfig = torch.ao.quantization.default_dynamic_qconfig
+        self.inner = torch.ao.nn.quantized.dynamic.Linear.from_float(plain)
+
+    def forward(self, hidden_states, *args, **kwargs):
+        return self.inner(hidden_states)
+
+def quantize_linears(module):
+    """Swap Linear layers for int8 dynamic ones, leaving LoRA-carrying layers alone"""
+    count = 0
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear) and getattr(child, "lora_layer", None) is None:
+            setattr(module, name, DynamicInt8Linear(child))
+            count += 1
+        else:
+            count += quantize_linears(child)
+    return count
+
+def configure_engine(pipe, options):
+    """Apply the selected CPU engine options and return what actually took effect"""
+    engine = {
+        **options,
+        "bf16_supported": cpu_supports_bf16(),
+        # None means torch's default (intra-op is split across inference workers)
+        "intra_op_threads": INTRA_OP_THREADS,
+        "inter_op_threads": INTER_OP_THREADS
+    }
+    if pipe is None:
+        return engine
+
+    if options["bf16_autocast"] and not engine["bf16_supported"]:
+        print("⚠️  bf16 autocast requested but this CPU has no native bf16 support, skipping")
+        engine["bf16_autocast"] = False
+    if options["bf16_autocast"] and options["int8_dynamic"]:
+        # Quantized linears expect float32 activations
+        print("⚠️  bf16 autocast is incompatible with int8 quantization, using int8 only")
+        engine["bf16_autocast"] = False
+
+    if options["int8_dynamic"]:
+        engine["int8_unet_layers"] = quantize_linears(pipe.unet)
+        pipe.text_encoder = torch.ao.quantization.quantize_dynamic(
+            pipe.text_encoder, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    if options["channels_last"]:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+    if options["attention_slicing"]:
+        pipe.enable_attention_slicing()
+    if options["vae_slicing"]:
+        pipe.enable_vae_slicing()
+    if options["torch_compile"]:
+        # Compiled lazily on the first call in each worker process
+        pipe.unet = torch.compile(pipe.unet)
+    print(f"⚙️  CPU engine: {engine}")
+    return engine
+
+ENGINE = configure_engine(pipe, ENGINE_OPTIONS)
 
 class PromptRequest(BaseModel):
     prompt: str
+    tier: Optional[str] = None  # draft, standard or quality
+    steps: Optional[int] = None
+    scheduler: Optional[str] = None  # default, dpm++, euler_a or lcm
+    guidance_scale: Optional[float] = None
+    width: int = 512
+    height: int = 512
+    seed: Optional[int] = None
+    format: Optional[str] = None  # png, webp, jpeg or avif; otherwise negotiated from Accept
+    quality: Optional[int] = None  # lossy formats only
+    upscale: Optional[int] = None  # fast large mode: render width x height, then upscale 2x or 4x
+
+class RefineRequest(BaseModel):
+    image_id: str  # X-Image-Id of an earlier /generate or /refine response
+    prompt: Optional[str] = None  # defaults to the source image's prompt
+    strength: float = 0.5  # share of the schedule re-run; lower keeps more of the source
+    steps: Optional[int] = None  # full schedule length, defaults to the source's
+    scheduler: Optional[str] = None
+    guidance_scale: Optional[float] = None
+    seed: Optional[int] = None  # defaults to the source's seed
+    format: Optional[str] = None
+    quality: Optional[int] = None
+    upscale: Optional[int] = None
+
+# >>> shared: output encoding (copies must match, see tests/test_shared_code.py)
+# Output encoding: format comes from the request or the Accept header, encoded off the event loop
+try:
+    import pillow_avif  # noqa: F401  registers the AVIF plugin when installed
+except ImportError:
+    pass
+
+IMAGE_FORMATS = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+if "AVIF" in Image.registered_extensions().values():
+    IMAGE_FORMATS["avif"] = "image/avif"
+DEFAULT_QUALITY = {"webp": 85, "jpeg": 90, "avif": 60}
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))  # zlib level; 1 is far faster than Pillow's 6
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def negotiate_format(requested, accept):
+    """Pick the output format: explicit request field first, then the Accept header, else PNG"""
+    if requested:
+        fmt = "jpeg" if requested.lower() == "jpg" else requested.lower()
+        if fmt not in IMAGE_FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported format '{requested}'. Use one of: {', '.join(IMAGE_FORMATS)}"
+            )
+        return fmt
+    ranges = []
+    for position, part in enumerate((accept or "").split(",")):
+        media_type, _, options = part.strip().partition(";")
+        q = 1.0
+        for option in options.split(";"):
+            name, _, value = option.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges.append((-q, position, media_type.strip().lower()))
+    for neg_q, _, media_type in sorted(ranges):
+        if neg_q >= 0:
+            break
+        for fmt, format_type in IMAGE_FORMATS.items():
+            if media_type == format_type:
+                return fmt
+        if media_type in ("image/*", "*/*"):
+            return "png"
+    return "png"
+
+def encode_image(image, fmt, quality=None):
+    """Blocking encode into a BytesIO buffer"""
+    quality = quality or DEFAULT_QUALITY.get(fmt)
+    buffer = io.BytesIO()
+    if fmt == "png":
+        image.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    elif fmt == "webp":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    elif fmt == "jpeg":
+        image.save(buffer, format="JPEG", quality=quality)
+    else:
+        image.save(buffer, format="AVIF", quality=quality, speed=8)
+    return buffer
+
+async def image_response(image, fmt, quality=None, headers=None):
+    """Encode in a worker thread and stream straight from the encoder's buffer"""
+    with span("image_encode"):
+        buffer = await asyncio.to_thread(encode_image, image, fmt, quality)
+    return buffer_response(buffer, IMAGE_FORMATS[fmt], headers)
+
+def buffer_response(buffer, media_type, headers=None):
+    """Stream a BytesIO in chunks without copying it into one bytes object first"""
+    view = buffer.getbuffer()
+    size = len(view)
+
+    async def body():
+        try:
+            for start in range(0, size, STREAM_CHUNK_SIZE):
+                yield bytes(view[start:start + STREAM_CHUNK_SIZE])
+        finally:
+            view.release()
+
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        headers={**(headers or {}), "Content-Length": str(size)}
+    )
+
+# Output size: native generation up to MAX_OUTPUT_PIXELS, bigger images by upscaling a base render
+MAX_OUTPUT_PIXELS = int(os.getenv("MAX_OUTPUT_PIXELS", str(768 * 768)))
+MAX_UPSCALED_PIXELS = int(os.getenv("MAX_UPSCALED_PIXELS", str(2048 * 2048)))
+VAE_TILING_PIXELS = int(os.getenv("VAE_TILING_PIXELS", str(512 * 512)))  # decode in tiles above this
+UPSCALE_FACTORS = (2, 4)
+
+def check_size(width, height, upscale=None):
+    """Reject sizes the UNet cannot take or that would blow the memory ceiling"""
+    if width % 8 or height % 8:
+        raise HTTPException(status_code=400, detail="width and height must be multiples of 8")
+    if width * height > MAX_OUTPUT_PIXELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{width}x{height} is over the {MAX_OUTPUT_PIXELS} pixel limit, generate smaller and set upscale"
+        )
+    if upscale is not None:
+        if upscale not in UPSCALE_FACTORS:
+            raise HTTPException(status_code=400, detail=f"upscale must be one of: {', '.join(map(str, UPSCALE_FACTORS))}")
+        if width * height * upscale ** 2 > MAX_UPSCALED_PIXELS:
+            raise HTTPException(status_code=400, detail=f"Upscaled output is over the {MAX_UPSCALED_PIXELS} pixel limit")
+
+def upscale_image(image, factor):
+    """Cheap CPU upscale: Lanczos resize plus a light unsharp mask to restore edges"""
+    large = image.resize((image.width * factor, image.height * factor), Image.LANCZOS)
+    return large.filter(ImageFilter.UnsharpMask(radius=2, percent=60, threshold=2))
+# <<< shared: output encoding
+
+def configure_vae(pipeline, height, width, batch_size):
+    """Tile the VAE decode for large outputs and decode big batches one image at a time"""
+    if height * width > VAE_TILING_PIXELS:
+        pipeline.enable_vae_tiling()
+        if batch_size > 1:
+            pipeline.enable_vae_slicing()
+    else:
+        pipeline.disable_vae_tiling()
+        if batch_size > 1 and not ENGINE["vae_slicing"]:
+            pipeline.disable_vae_slicing()
+
+# >>> shared: worker telemetry (copies must match, see tests/test_shared_code.py)
+# Peak memory per batch, measured inside the worker and reported per request and in /health
+MEMORY_STATS = {"last_peak_rss_mb": None, "max_peak_rss_mb": 0.0, "max_peak_rss_mb_by_size": {}}
+
+def reset_peak_rss():
+    """Start a fresh peak-RSS window for this process (Linux; otherwise the lifetime peak is reported)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def record_peak_rss(width, height, peak):
+    size = f"{width}x{height}"
+    by_size = MEMORY_STATS["max_peak_rss_mb_by_size"]
+    by_size[size] = max(by_size.get(size, 0.0), peak)
+    MEMORY_STATS["last_peak_rss_mb"] = peak
+    MEMORY_STATS["max_peak_rss_mb"] = max(MEMORY_STATS["max_peak_rss_mb"], peak)
+
+# Timing spans and Prometheus metrics; the backend's X-Request-ID is echoed and logged so traces join up
+REQUEST_ID_HEADER = "X-Request-ID"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+REQUEST_ID = contextvars.ContextVar("request_id", default=None)
+TRACE = contextvars.ContextVar("trace", default=None)  # stage -> seconds for the current request
+
+# >>> shared: metric types (copies must match, see tests/test_shared_code.py)
+def _escape(value):
+    # The text format needs backslash, double quote and newline escaped inside label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                labels = _labels(self.labelnames + ("le",), key + (str(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class CallbackMetric:
+    """Gauge or counter read at scrape time from existing stats.
+
+    fn() returns a number, or a dict of label value tuple -> number.
+    """
+
+    def __init__(self, name, documentation, fn, labelnames=(), kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.fn()
+        except Exception:
+            return []  # e.g. state not set up yet; skip rather than break the scrape
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {float(value)}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def callback(self, *args, **kwargs):
+        metric = CallbackMetric(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+# <<< shared: metric types
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram("buddy_sd_stage_duration_seconds", "Time spent in each request stage", ("stage",))
+UNET_STEP_SECONDS = REGISTRY.histogram(
+    "buddy_sd_unet_step_seconds", "Wall time of one denoising step for the whole batch", ("size",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "buddy_sd_request_duration_seconds", "HTTP request latency by endpoint", ("method", "endpoint", "status")
+)
+
+def record(stage, seconds):
+    """Observe a stage duration and add it to the current request's trace"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = TRACE.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0.0) + seconds
+
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+class StepTimer:
+    """Pipeline step callback that times each denoising step, then chains to another callback"""
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.started = self.last = time.perf_counter()
+        self.steps = []
+
+    def __call__(self, pipeline, step, timestep, callback_kwargs):
+        self.steps.append(time.perf_counter() - self.last)
+        if self.inner is not None:
+            callback_kwargs = self.inner(pipeline, step, timestep, callback_kwargs)
+        self.last = time.perf_counter()  # Preview decoding is not UNet time
+        return callback_kwargs
+
+WORKER_STAGES = ("text_encode", "unet", "vae_decode")
+
+def record_batch_stats(results):
+    """Stage timings and peak RSS measured inside the worker, recorded once per batch"""
+    # Every image in a batch shares one stats dict
+    image, stats = results[0][0], results[0][-1]
+    width, height = image.size
+    record_peak_rss(width, height, stats["peak_rss_mb"])
+    for stage in WORKER_STAGES:
+        STAGE_SECONDS.observe(stats[f"{stage}_s"], stage=stage)
+    for seconds in stats["unet_steps_s"]:
+        UNET_STEP_SECONDS.observe(seconds, size=f"{width}x{height}")
+
+def trace_worker_stats(stats):
+    """Add the batch's worker stages to the current request's trace; the metrics have them once per batch"""
+    trace = TRACE.get()
+    if trace is not None:
+        for stage in WORKER_STAGES:
+            trace[stage] = trace.get(stage, 0.0) + stats[f"{stage}_s"]
+
+class RequestContextMiddleware:
+    """Request ids, Server-Timing, the latency histogram and one JSON timing line per request.
+
+    Plain ASGI rather than BaseHTTPMiddleware so streamed bodies are untouched.
+    """
+
+    def __init__(self, app, skip_paths=("/metrics", "/health", "/live", "/ready")):
+        self.app = app
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope["headers"]).get(REQUEST_ID_HEADER.lower().encode(), b"").decode("latin-1")
+        request_id = incoming[:128] or uuid.uuid4().hex
+        REQUEST_ID.set(request_id)
+        trace = {}
+        TRACE.set(trace)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((REQUEST_ID_HEADER.encode(), request_id.encode("latin-1")))
+                if trace:
+                    timing = ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in trace.items())
+                    headers.append((b"server-timing", timing.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            elapsed = time.perf_counter() - started
+            endpoint = scope.get("endpoint")
+            endpoint = endpoint.__name__ if endpoint is not None else "unmatched"
+            REQUEST_SECONDS.observe(elapsed, method=scope["method"], endpoint=endpoint, status=status["code"])
+            if scope["path"] not in self.skip_paths:
+                print("⏱️  " + json.dumps({
+                    "request_id": request_id,
+                    "path": scope["path"],
+                    "status": status["code"],
+                    "total_ms": round(elapsed * 1000, 1),
+                    "spans_ms": {stage: round(seconds * 1000, 1) for stage, seconds in trace.items()}
+                }))
+# <<< shared: worker telemetry
+
+app.add_middleware(RequestContextMiddleware)
+
+# >>> shared: batching (copies must match, see tests/test_shared_code.py)
+# Micro-batching: requests that share steps/size/guidance are run as one pipe() call
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", "200"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))
+
+# Inference runs in forked worker processes that share the loaded weights copy-on-write
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "16"))
+
+class QueueFullError(Exception):
+    """Raised when too many requests are already waiting for inference"""
+    def __init__(self, retry_after):
+        super().__init__(f"Inference queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+def init_worker(threads):
+    """Split the CPU cores between inference worker processes"""
+    torch.set_num_threads(threads)
+
+class BatchScheduler:
+    """Collects compatible requests for a short window and runs them as one batch"""
+
+    def __init__(self, run_batch, max_batch_size=4, window_ms=200, workers=1, max_queue=16, on_batch=None,
+                 threads_per_worker=None):
+        self.run_batch = run_batch  # blocking fn(params, prompts, seeds, tags) -> one result per prompt
+        self.on_batch = on_batch  # fn(results), called once per finished batch
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker  # None splits the cores evenly between workers
+        self.max_queue = max_queue
+        self._pending = {}  # params -> list of (prompt, seed, future, enqueued_at, tag, context)
+        self._wakeup = asyncio.Event()
+        self._executor = None
+        self._slots = None
+        self._task = None
+        self._pool_ready = asyncio.Event()  # Cleared while a crashed worker pool is rebuilt
+        self._warm_params = None
+        self.recovering = False
+        self.rebuild_retry_s = 5  # Pause between attempts to bring up a replacement pool
+        self.stats = {
+            "batches": 0,
+            "images": 0,
+            "batch_sizes": {},
+            "queue_wait_total_s": 0.0,
+            "queue_wait_max_s": 0.0,
+            "batch_time_total_s": 0.0,
+            "rejected": 0,
+            "pool_rebuilds": 0
+        }
+
+    def _make_executor(self):
+        # Fork only after load_model() so workers inherit the weights instead of reloading them
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_worker,
+            initargs=(self.threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers),)
+        )
+
+    def start(self):
+        self._executor = self._make_executor()
+        self._pool_ready.set()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._task = asyncio.create_task(self._loop())
+
+    def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def retry_after(self):
+        """Rough seconds until the current backlog drains"""
+        batches = self.stats["batches"]
+        avg_batch_s = self.stats["batch_time_total_s"] / batches if batches else 60.0
+        backlog_batches = self.queue_depth() / (self.max_batch_size * self.workers)
+        return max(1, int(avg_batch_s * (backlog_batches + 1)))
+
+    def enqueue(self, prompt, seed, params, tag=None):
+        """Queue one prompt and return a future for its image (raises QueueFullError at once)"""
+        return self.enqueue_many(prompt, [seed], params, tag)[0]
+
+    def enqueue_many(self, prompt, seeds, params, tag=None):
+        """Queue one image per seed side by side so they land in the same batch; all or nothing"""
+        if self.queue_depth() + len(seeds) > self.max_queue:
+            self.stats["rejected"] += 1
+            raise QueueFullError(self.retry_after())
+        loop = asyncio.get_running_loop()
+        enqueued_at = time.perf_counter()
+        # The caller's context goes with the first image so its queue wait lands in the caller's trace once
+        context = contextvars.copy_context()
+        futures = []
+        for index, seed in enumerate(seeds):
+            future = loop.create_future()
+            self._pending.setdefault(params, []).append(
+                (prompt, seed, future, enqueued_at, tag, context if index == 0 else None)
+            )
+            futures.append(future)
+        self._wakeup.set()
+        return futures
+
+    async def submit(self, prompt, seed, params, tag=None):
+        """Queue one prompt and wait for its image"""
+        return await self.enqueue(prompt, seed, params, tag)
+
+    def queue_depth(self):
+        return sum(len(items) for items in self._pending.values())
+
+    def _oldest_params(self):
+        return min(self._pending, key=lambda params: self._pending[params][0][3])
+
+    async def _loop(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Wait for a free worker process; requests keep piling into the batch meanwhile
+            await self._slots.acquire()
+            await self._pool_ready.wait()
+
+            # Give compatible requests until the window closes to join the oldest one's batch
+            params = self._oldest_params()
+            deadline = self._pending[params][0][3] + self.window
+            while len(self._pending[params]) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            items = self._pending[params][:self.max_batch_size]
+            rest = self._pending[params][self.max_batch_size:]
+            if rest:
+                self._pending[params] = rest
+            else:
+                del self._pending[params]
+
+            # Skip callers that went away while queued
+            items = [item for item in items if not item[2].done()]
+            if not items:
+                self._slots.release()
+                continue
+
+            started = time.perf_counter()
+            for _, _, _, enqueued_at, _, context in items:
+                wait = started - enqueued_at
+                if context is not None:
+                    context.run(record, "queue_wait", wait)
+                self.stats["queue_wait_total_s"] += wait
+                self.stats["queue_wait_max_s"] = max(self.stats["queue_wait_max_s"], wait)
+            size = len(items)
+            self.stats["batches"] += 1
+            self.stats["images"] += size
+            self.stats["batch_sizes"][size] = self.stats["batch_sizes"].get(size, 0) + 1
+            print(f"Running batch of {size} with params {params}")
+            asyncio.create_task(self._run(params, items))
+
+    async def _run(self, params, items):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        executor = self._executor
+        try:
+            images = await loop.run_in_executor(
+                executor,
+                self.run_batch,
+                params,
+                [item[0] for item in items],
+                [item[1] for item in items],
+                [item[4] for item in items]
+            )
+            for (_, _, future, _, _, _), image in zip(items, images):
+                if not future.done():
+                    future.set_result(image)
+            if self.on_batch is not None:
+                self.on_batch(images)
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed for memory); the executor is unusable until replaced
+            for _, _, future, _, _, _ in items:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Inference worker crashed: {e}"))
+            if executor is self._executor and not self.recovering:
+                self.recovering = True
+                self._pool_ready.clear()
+                asyncio.create_task(self._rebuild(executor))
+        except Exception as e:
+            for _, _, future, _, _, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.stats["batch_time_total_s"] += time.perf_counter() - started
+            self._slots.release()
+
+    async def _rebuild(self, broken):
+        """Replace a broken worker pool and warm it up again; batches wait until it is done"""
+        print("❌ Inference worker pool broke; rebuilding it")
+        self.stats["pool_rebuilds"] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+        while True:
+            try:
+                self._executor = self._make_executor()
+                if self._warm_params is not None:
+                    await self.warm_up(self._warm_params)
+                break
+            except Exception as e:
+                # Whatever went wrong, keep trying: giving up would leave every batch waiting forever
+                print(f"❌ Rebuilt worker pool failed to warm up ({e!r}); retrying")
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                await asyncio.sleep(self.rebuild_retry_s)
+        self.recovering = False
+        self._pool_ready.set()
+        print("✅ Inference worker pool rebuilt")
+
+    async def warm_up(self, params):
+        """Run one tiny generation in every worker so the first real request is not slow"""
+        self._warm_params = params  # Reused when the pool has to be rebuilt
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self._executor, self.run_batch, params, ["warm-up"], [0], [None])
+            for _ in range(self.workers)
+        ])
+
+    def info(self):
+        images = self.stats["images"]
+        return {
+            "batches": self.stats["batches"],
+            "images": images,
+            "batch_sizes": self.stats["batch_sizes"],
+            "avg_batch_size": round(images / self.stats["batches"], 2) if self.stats["batches"] else 0.0,
+            "avg_queue_wait_s": round(self.stats["queue_wait_total_s"] / images, 3) if images else 0.0,
+            "max_queue_wait_s": round(self.stats["queue_wait_max_s"], 3),
+            "avg_batch_time_s": round(self.stats["batch_time_total_s"] / self.stats["batches"], 2) if self.stats["batches"] else 0.0,
+            "queue_depth": self.queue_depth(),
+            "max_queue": self.max_queue,
+            "rejected": self.stats["rejected"],
+            "workers": self.workers,
+            "pool_rebuilds": self.stats["pool_rebuilds"],
+            "recovering": self.recovering,
+            "max_batch_size": self.max_batch_size,
+            "window_ms": int(self.window * 1000)
+        }
+# <<< shared: batching
+
+def decode_latents(pipeline, latents):
+    """VAE-decode final latents to PIL images, as the pipeline does for PIL output"""
+    with torch.no_grad():
+        decoded = pipeline.vae.decode(latents / pipeline.vae.config.scaling_factor, return_dict=False)[0]
+    return pipeline.image_processor.postprocess(
+        decoded, output_type="pil", do_denormalize=[True] * len(decoded)
+    )
+
+@torch.no_grad()
+def encode_prompts(pipeline, prompts, guidance_scale, lora_scale):
+    """Text encoder pass ahead of the pipeline call, so it is timed on its own"""
+    return pipeline.encode_prompt(
+        prompts, "cpu", num_images_per_prompt=1,
+        do_classifier_free_guidance=guidance_scale > 1.0, lora_scale=lora_scale
+    )
+
+def run_pipeline(pipeline, prompts, guidance_scale, lora_scale, **kwargs):
+    """Encode, denoise and decode with each stage timed.
+
+    Returns (images, latents, stats) where stats holds the batch's peak RSS in
+    MB and its text encode, UNet and VAE decode timings.
+    """
+    with torch.autocast("cpu", dtype=torch.bfloat16, enabled=ENGINE["bf16_autocast"]):
+        encode_started = time.perf_counter()
+        prompt_embeds, negative_prompt_embeds = encode_prompts(pipeline, prompts, guidance_scale, lora_scale)
+        text_encode_s = time.perf_counter() - encode_started
+        timer = StepTimer()
+        latents = pipeline(
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            guidance_scale=guidance_scale,
+            output_type="latent",
+            callback_on_step_end=timer,
+            **kwargs
+        ).images
+        unet_s = time.perf_counter() - timer.started
+        decode_started = time.perf_counter()
+        images = decode_latents(pipeline, latents)
+    stats = {
+        "peak_rss_mb": peak_rss_mb(),
+        "text_encode_s": text_encode_s,
+        "unet_s": unet_s,
+        "unet_steps_s": timer.steps,
+        "vae_decode_s": time.perf_counter() - decode_started
+    }
+    return images, latents, stats
+
+def run_batch(params, prompts, seeds, tags):
+    """Blocking batched pipeline call, run inside a worker process.
+
+    Returns one (image, final latents as a numpy array, stats) tuple per
+    prompt; the latents go back to the server so /refine can start from them.
+    """
+    reset_peak_rss()
+    if params[0] == "refine":
+        return run_refine_batch(params[1:], prompts, seeds)
+    steps, guidance_scale, height, width, scheduler_name = params
+    # Each worker process owns its pipe, so swapping the scheduler and VAE mode here is safe
+    pipe.scheduler = SCHEDULERS[scheduler_name]
+    configure_vae(pipe, height, width, len(prompts))
+    extra = {}
+    lora_scale = None
+    if "lcm" in SCHEDULERS:
+        lora_scale = 1.0 if scheduler_name == "lcm" else 0.0
+        extra["cross_attention_kwargs"] = {"scale": lora_scale}
+    # Per-request seeds stay reproducible inside a batch
+    generators = [
+        torch.Generator("cpu").manual_seed(seed if seed is not None else random.randrange(2**32))
+        for seed in seeds
+    ]
+    images, latents, stats = run_pipeline(
+        pipe, prompts, guidance_scale, lora_scale,
+        num_inference_steps=steps,
+        height=height,
+        width=width,
+        generator=generators,
+        **extra
+    )
+    return [(image, latent, stats) for image, latent in zip(images, latents.float().numpy())]
+
+def run_refine_batch(params, inputs, seeds):
+    """img2img from cached latents; inputs are (prompt, latents) pairs, so nothing goes through the VAE encoder"""
+    steps, guidance_scale, strength, scheduler_name, shape = params
+    img2img.scheduler = SCHEDULERS[scheduler_name]
+    configure_vae(img2img, shape[1] * 8, shape[2] * 8, len(inputs))
+    extra = {}
+    lora_scale = None
+    if "lcm" in SCHEDULERS:
+        lora_scale = 1.0 if scheduler_name == "lcm" else 0.0
+        extra["cross_attention_kwargs"] = {"scale": lora_scale}
+    generators = [torch.Generator("cpu").manual_seed(seed) for seed in seeds]
+    # 4-channel input is taken as init latents as-is
+    init_latents = torch.from_numpy(np.stack([latents for _, latents in inputs]))
+    images, latents, stats = run_pipeline(
+        img2img, [prompt for prompt, _ in inputs], guidance_scale, lora_scale,
+        image=init_latents,
+        strength=strength,
+        num_inference_steps=steps,
+        generator=generators,
+        **extra
+    )
+    return [(image, latent, stats) for image, latent in zip(images, latents.float().numpy())]
+
+# Final latents of recent generations, keyed by the image id handed to the client
+LATENT_CACHE_SIZE = int(os.getenv("LATENT_CACHE_SIZE", "64"))  # one 512x512 latent is 64 KB
+MIN_REFINE_STRENGTH = 0.05
+
+class LatentCache:
+    """LRU of generation results kept in the server process, shared by all workers"""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # image id -> dict with latents, prompt, seed and settings
+        self.stats = {"stored": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    def put(self, latents, **meta):
+        image_id = uuid.uuid4().hex
+        self._entries[image_id] = {"latents": latents, **meta}
+        self.stats["stored"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+        return image_id
+
+    def get(self, image_id):
+        entry = self._entries.get(image_id)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(image_id)
+        self.stats["hits"] += 1
+        return entry
+
+    def info(self):
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries
+        }
+
+latent_cache = LatentCache(LATENT_CACHE_SIZE)
+
+scheduler = BatchScheduler(
+    run_batch,
+    max_batch_size=MAX_BATCH_SIZE,
+    window_ms=BATCH_WINDOW_MS,
+    workers=INFERENCE_WORKERS,
+    max_queue=MAX_QUEUE_SIZE,
+    on_batch=record_batch_stats,
+    threads_per_worker=INTRA_OP_THREADS
+)
+
+# Startup state reported by /ready
+WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "2"))  # 0 disables the warm-up generation
+LOAD_STATE = {
+    "status": "loading",
+    "stage": "starting",
+    "progress": 0.0,
+    "started_at": None,
+    "ready_at": None,
+    "load_seconds": None,
+    "warmup_seconds": None,
+    "error": None
+}
+
+def set_stage(stage, progress):
+    LOAD_STATE["stage"] = stage
+    LOAD_STATE["progress"] = progress
+    print(f"⏳ Startup: {stage} ({int(progress * 100)}%)")
+
+def initialize_model():
+    """Blocking part of startup: load weights and build everything that depends on them"""
+    global pipe, img2img, SCHEDULERS, TIERS, ENGINE
+    set_stage("loading_weights", 0.1)
+    loaded = load_model()
+    if loaded is None:
+        raise RuntimeError("Model failed to load")
+    set_stage("building_schedulers", 0.6)
+    SCHEDULERS = build_schedulers(loaded)
+    TIERS = build_tiers(SCHEDULERS)
+    set_stage("configuring_engine", 0.7)
+    ENGINE = configure_engine(loaded, ENGINE_OPTIONS)
+    # Built after the engine options so it shares the configured unet and text encoder
+    img2img = StableDiffusionImg2ImgPipeline(**loaded.components, requires_safety_checker=False)
+    pipe = loaded
+
+async def load_in_background():
+    LOAD_STATE["started_at"] = time.time()
+    started = time.perf_counter()
+    try:
+        await asyncio.to_thread(initialize_model)
+        LOAD_STATE["load_seconds"] = round(time.perf_counter() - started, 1)
+        # Fork the inference workers only now, so they inherit the loaded weights
+        scheduler.start()
+        if WARMUP_STEPS > 0:
+            set_stage("warming_up", 0.8)
+            warmup_started = time.perf_counter()
+            preset = TIERS[DEFAULT_TIER]
+            await scheduler.warm_up(
+                (WARMUP_STEPS, preset["guidance_scale"], 512, 512, preset["scheduler"])
+            )
+            LOAD_STATE["warmup_seconds"] = round(time.perf_counter() - warmup_started, 1)
+        set_stage("ready", 1.0)
+        LOAD_STATE["status"] = "ready"
+        LOAD_STATE["ready_at"] = time.time()
+        print("✅ Model ready!")
+    except Exception as e:
+        print(f"❌ Startup failed: {e}")
+        LOAD_STATE["status"] = "failed"
+        LOAD_STATE["error"] = str(e)
+
+def load_state():
+    state = dict(LOAD_STATE)
+    if state["status"] == "ready" and scheduler.recovering:
+        # Not ready again until the crashed worker pool is rebuilt and warmed up
+        state["status"] = "recovering"
+        state["stage"] = "rebuilding_workers"
+    if state["started_at"] is not None:
+        state["elapsed_seconds"] = round((state["ready_at"] or time.time()) - state["started_at"], 1)
+    return state
 
 @app.get("/")
 async def root():
@@ -46,47 +1063,145 @@ async def root():
         "model": "Stable Diffusion v1.4",
         "endpoints": {
             "generate": "/generate (POST)",
-            "health": "/health (GET)"
+            "refine": "/refine (POST, img2img from an earlier X-Image-Id)",
+            "health": "/health (GET)",
+            "metrics": "/metrics (GET, Prometheus text format)",
+            "live": "/live (GET)",
+            "ready": "/ready (GET)"
         }
     }
 
+@app.get("/live")
+async def live():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "alive"}
+
+@app.get("/ready")
+async def ready():
+    """Readiness: weights loaded and warm-up done; 503 with progress until then"""
+    state = load_state()
+    return JSONResponse(status_code=200 if state["status"] == "ready" else 503, content=state)
+
 @app.get("/health")
 async def health_check():
+    state = load_state()
     return {
-        "status": "healthy",
+        "status": "healthy" if state["status"] == "ready" else state["status"],
         "model_loaded": pipe is not None,
-        "hardware": "CPU"
+        "startup": state,
+        "hardware": "CPU",
+        "tiers": TIERS,
+        "default_tier": DEFAULT_TIER,
+        "schedulers": list(SCHEDULERS),
+        "engine": ENGINE,
+        "batching": scheduler.info(),
+        "latent_cache": latent_cache.info(),
+        "memory": {**MEMORY_STATS, "max_output_pixels": MAX_OUTPUT_PIXELS, "max_upscaled_pixels": MAX_UPSCALED_PIXELS}
     }
 
-@app.post("/generate")
-async def generate_image(request: PromptRequest):
-    """Generate image with CPU-optimized settings - API endpoint"""
-    if pipe is None:
+REGISTRY.callback("buddy_sd_ready", "1 once the model is loaded and warmed up", lambda: int(load_state()["status"] == "ready"))
+REGISTRY.callback("buddy_sd_queue_depth", "Images waiting for a batch", lambda: scheduler.queue_depth())
+REGISTRY.callback("buddy_sd_batches_total", "Batches run", lambda: scheduler.stats["batches"], kind="counter")
+REGISTRY.callback("buddy_sd_images_total", "Images generated", lambda: scheduler.stats["images"], kind="counter")
+REGISTRY.callback("buddy_sd_rejected_total", "Requests turned away by a full queue", lambda: scheduler.stats["rejected"], kind="counter")
+REGISTRY.callback("buddy_sd_latent_cache_entries", "Latents kept for /refine", lambda: latent_cache.info()["entries"])
+REGISTRY.callback("buddy_sd_max_peak_rss_mb", "Highest worker peak RSS seen for a batch", lambda: MEMORY_STATS["max_peak_rss_mb"])
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of stage timings, queue and cache counters"""
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# >>> shared: request settings (copies must match, see tests/test_shared_code.py)
+MAX_STEPS = int(os.getenv("MAX_STEPS", "100"))  # caps how long one request can hold a worker
+MAX_GUIDANCE_SCALE = float(os.getenv("MAX_GUIDANCE_SCALE", "20"))
+
+def check_settings(steps, guidance_scale):
+    if not 1 <= steps <= MAX_STEPS:
+        raise HTTPException(status_code=400, detail=f"steps must be between 1 and {MAX_STEPS}")
+    if not 0 <= guidance_scale <= MAX_GUIDANCE_SCALE:
+        raise HTTPException(status_code=400, detail=f"guidance_scale must be between 0 and {MAX_GUIDANCE_SCALE}")
+
+def resolve_settings(request):
+    """Turn tier plus explicit overrides into (steps, guidance_scale, scheduler)"""
+    tier = request.tier or DEFAULT_TIER
+    if tier not in TIERS:
+        raise HTTPException(status_code=400, detail=f"Unknown tier '{tier}'. Use one of: {', '.join(TIERS)}")
+    preset = TIERS[tier]
+    scheduler_name = request.scheduler or preset["scheduler"]
+    if scheduler_name not in SCHEDULERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Scheduler '{scheduler_name}' is not available. Use one of: {', '.join(SCHEDULERS)}"
+        )
+    steps = request.steps if request.steps is not None else preset["steps"]
+    guidance_scale = request.guidance_scale if request.guidance_scale is not None else preset["guidance_scale"]
+    check_settings(steps, guidance_scale)
+    return steps, guidance_scale, scheduler_name
+
+def check_ready():
+    state = load_state()
+    if state["status"] == "failed":
         raise HTTPException(
             status_code=500,
             detail="Model not loaded. Please check the logs."
         )
+    if state["status"] == "recovering":
+        raise HTTPException(
+            status_code=503,
+            detail="An inference worker crashed and is being restarted. Please retry shortly.",
+            headers={"Retry-After": "30"}
+        )
+    if state["status"] != "ready":
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model is still loading ({state['stage']}). Please retry shortly.",
+            headers={"Retry-After": "30"}
+        )
+# <<< shared: request settings
+
+@app.post("/generate")
+async def generate_image(request: PromptRequest, http_request: Request):
+    """Generate image with CPU-optimized settings - API endpoint"""
+    check_ready()
     
     try:
         print(f"Generating image for prompt: {request.prompt}")
         
-        # Generate image with CPU-optimized parameters
-        image = pipe(
-            request.prompt,
-            num_inference_steps=20,  # Reduced steps for speed
-            guidance_scale=7.5,
-            height=512,
-            width=512
-        ).images[0]
+        fmt = negotiate_format(request.format, http_request.headers.get("accept"))
+        check_size(request.width, request.height, request.upscale)
         
-        # Convert to bytes for API response
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
+        # Queue for the next batch of requests that share steps, size, guidance and scheduler
+        steps, guidance_scale, scheduler_name = resolve_settings(request)
+        params = (steps, guidance_scale, request.height, request.width, scheduler_name)
+        # Pick the seed here so a later /refine can reuse it
+        seed = request.seed if request.seed is not None else random.randrange(2**32)
+        image, latents, stats = await scheduler.submit(request.prompt, seed, params)
+        trace_worker_stats(stats)
+        image_id = latent_cache.put(
+            latents, prompt=request.prompt, seed=seed, steps=steps,
+            guidance_scale=guidance_scale, scheduler=scheduler_name
+        )
+        if request.upscale:
+            with span("upscale"):
+                image = await asyncio.to_thread(upscale_image, image, request.upscale)
         
         print(f"✅ Image generated successfully for: {request.prompt}")
-        return Response(content=img_byte_arr, media_type="image/png")
+        return await image_response(image, fmt, request.quality, {
+            "X-Image-Id": image_id,
+            "X-Seed": str(seed),
+            "X-Peak-RSS-MB": str(stats["peak_rss_mb"])
+        })
         
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        print(f"⚠️  {e}")
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
         print(f"❌ Generation error: {e}")
         raise HTTPException(
@@ -94,6 +1209,75 @@ async def generate_image(request: PromptRequest):
             detail=f"Image generation failed: {str(e)}"
         )
 
+@app.post("/refine")
+async def refine_image(request: RefineRequest, http_request: Request):
+    """img2img pass over an earlier result's cached latents; costs about strength x steps"""
+    check_ready()
+    source = latent_cache.get(request.image_id)
+    if source is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired image_id, generate the image again.")
+    if not MIN_REFINE_STRENGTH <= request.strength <= 1.0:
+        raise HTTPException(status_code=400, detail=f"strength must be between {MIN_REFINE_STRENGTH} and 1.0")
+    scheduler_name = request.scheduler or source["scheduler"]
+    if scheduler_name not in SCHEDULERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Scheduler '{scheduler_name}' is not available. Use one of: {', '.join(SCHEDULERS)}"
+        )
+    steps = request.steps if request.steps is not None else source["steps"]
+    guidance_scale = request.guidance_scale if request.guidance_scale is not None else source["guidance_scale"]
+    check_settings(steps, guidance_scale)
+    if int(steps * request.strength) < 1:
+        # img2img runs only int(steps x strength) steps; with none it has no schedule to run
+        raise HTTPException(
+            status_code=400,
+            detail=f"steps x strength must cover at least one step (got {steps} x {request.strength})"
+        )
+    
+    try:
+        prompt = request.prompt or source["prompt"]
+        print(f"Refining image {request.image_id} with prompt: {prompt}")
+        fmt = negotiate_format(request.format, http_request.headers.get("accept"))
+        latents = source["latents"]
+        height, width = latents.shape[1] * 8, latents.shape[2] * 8
+        check_size(width, height, request.upscale)
+        seed = request.seed if request.seed is not None else source["seed"]
+        # Latents sharing a shape batch together, like /generate batches by size
+        params = ("refine", steps, guidance_scale, request.strength, scheduler_name, latents.shape)
+        image, refined, stats = await scheduler.submit((prompt, latents), seed, params)
+        trace_worker_stats(stats)
+        image_id = latent_cache.put(
+            refined, prompt=prompt, seed=seed, steps=steps,
+            guidance_scale=guidance_scale, scheduler=scheduler_name
+        )
+        if request.upscale:
+            with span("upscale"):
+                image = await asyncio.to_thread(upscale_image, image, request.upscale)
+        
+        print(f"✅ Image refined successfully for: {prompt}")
+        return await image_response(image, fmt, request.quality, {
+            "X-Image-Id": image_id,
+            "X-Seed": str(seed),
+            "X-Steps-Run": str(int(steps * request.strength)),
+            "X-Peak-RSS-MB": str(stats["peak_rss_mb"])
+        })
+        
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        print(f"⚠️  {e}")
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except Exception as e:
+        print(f"❌ Refine error: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Image refinement failed: {str(e)}"
+        )
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=7860) 
\ No newline at end of file
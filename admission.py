@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Admission Control for BUDDY Backend
+Per-client token buckets, weighted fair queuing across clients with a
+priority lane for cheap requests, and queue-depth load shedding.
+All state is in process memory, so the limits hold for the single
+backend process app.py allows (see BACKEND_LOCK_FILE).
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict
+
+class RateLimited(Exception):
+    """Raised when a client has used up its token bucket"""
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limit exceeded, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class Overloaded(Exception):
+    """Raised when a request is shed because the queue is too deep"""
+    def __init__(self, detail, retry_after):
+        super().__init__(detail)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, amount=1.0):
+        """Take tokens if there are enough; otherwise return the seconds until there will be"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+class RateLimiter:
+    """One token bucket per client, kept in this process; rate_per_min <= 0 disables limiting"""
+
+    def __init__(self, rate_per_min, burst, max_clients=10000):
+        self.rate = rate_per_min / 60
+        self.burst = max(1.0, burst)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # client -> TokenBucket, least recently used first
+        self.stats = {"allowed": 0, "limited": 0}
+
+    def check(self, client):
+        """Charge one request to client, raising RateLimited when its bucket is empty"""
+        if self.rate <= 0:
+            return
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)  # An idle client's bucket would be full again anyway
+        self._buckets.move_to_end(client)
+        wait = bucket.take()
+        if wait > 0:
+            self.stats["limited"] += 1
+            raise RateLimited(max(1, math.ceil(wait)))
+        self.stats["allowed"] += 1
+
+    def info(self):
+        return {
+            **self.stats,
+            "rate_per_min": round(self.rate * 60, 2),
+            "burst": self.burst,
+            "clients": len(self._buckets)
+        }
+
+class FairQueue:
+    """Weighted fair queue across clients (start-time fair queuing), with a priority lane.
+
+    Each client's requests are tagged with a virtual start time that advances
+    by cost / weight, so a client with many queued requests cannot push
+    everyone else back. Priority items are always served before the normal lane.
+    """
+
+    def __init__(self):
+        self._heap = []  # (lane, start tag, seq, client, item)
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_finish = {}  # client -> finish tag of its latest queued item
+        self._depth = {}  # client -> queued items
+
+    def push(self, item, client, cost=1.0, weight=1.0, priority=False):
+        start = max(self._virtual_time, self._last_finish.get(client, 0.0))
+        self._last_finish[client] = start + cost / max(weight, 1e-6)
+        self._depth[client] = self._depth.get(client, 0) + 1
+        heapq.heappush(self._heap, (0 if priority else 1, start, next(self._seq), client, item))
+
+    def pop(self):
+        """Remove and return the next item, or None when empty"""
+        if not self._heap:
+            return None
+        _, start, _, client, item = heapq.heappop(self._heap)
+        self._virtual_time = max(self._virtual_time, start)
+        self._depth[client] -= 1
+        if not self._depth[client]:
+            del self._depth[client]
+            # Behind the virtual clock the tag no longer matters; forget the client
+            if self._last_finish.get(client, 0.0) <= self._virtual_time:
+                self._last_finish.pop(client, None)
+        return item
+
+    def remove(self, item):
+        """Drop a queued item (e.g. a cancelled job); returns False if it is not queued"""
+        for index, entry in enumerate(self._heap):
+            if entry[4] is item:
+                break
+        else:
+            return False
+        self._heap[index] = self._heap[-1]
+        self._heap.pop()
+        heapq.heapify(self._heap)
+        client = entry[3]
+        self._depth[client] -= 1
+        if not self._depth[client]:
+            del self._depth[client]
+        return True
+
+    def ordered(self):
+        """Queued items in the order they will be served"""
+        return [entry[4] for entry in sorted(self._heap)]
+
+    def depth(self, client=None):
+        return len(self._heap) if client is None else self._depth.get(client, 0)
+
+    def depth_by_client(self, top=10):
+        return dict(sorted(self._depth.items(), key=lambda pair: -pair[1])[:top])
+
+    def __len__(self):
+        return len(self._heap)
+
+class AdmissionGate:
+    """Concurrency budget with a fair queue in front of it and load shedding.
+
+    Slots are handed straight to the next waiter on release, so a newcomer
+    cannot take one past the queue. The budget is per process.
+    """
+
+    def __init__(self, name, limit, max_queue=32, shed_depth=None, max_queued_per_client=None):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        # Past shed_depth only priority requests are queued; the rest is shed first
+        self.shed_depth = shed_depth if shed_depth is not None else max_queue
+        self.max_queued_per_client = max_queued_per_client
+        self.active = 0
+        self._queue = FairQueue()
+        self._hold_ewma = None  # Seconds a slot is held, for Retry-After
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "wait_total_s": 0.0, "wait_max_s": 0.0}
+
+    def retry_after(self):
+        hold = self._hold_ewma if self._hold_ewma is not None else 30.0
+        return max(1, math.ceil(hold * (len(self._queue) / self.limit + 1)))
+
+    def check_capacity(self, client, priority=False):
+        """Raise Overloaded if a new request from client would be shed"""
+        depth = len(self._queue)
+        if depth >= self.max_queue or (not priority and depth >= self.shed_depth):
+            self.stats["shed"] += 1
+            raise Overloaded(f"{self.name} queue is full ({depth} waiting)", self.retry_after())
+        if self.max_queued_per_client and self._queue.depth(client) >= self.max_queued_per_client:
+            self.stats["shed"] += 1
+            raise Overloaded(f"Too many queued {self.name} requests from this client", self.retry_after())
+
+    async def acquire(self, client, cost=1.0, weight=1.0, priority=False):
+        """Wait for a slot; returns a release() callable that is safe to call more than once"""
+        started = time.monotonic()
+        if self.active >= self.limit or len(self._queue):
+            self.check_capacity(client, priority)
+            waiter = asyncio.get_running_loop().create_future()
+            self._queue.push(waiter, client, cost, weight, priority)
+            self.stats["queued"] += 1
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()  # Granted just as we were cancelled; pass the slot on
+                else:
+                    self._queue.remove(waiter)
+                raise
+        else:
+            self.active += 1
+        waited = time.monotonic() - started
+        self.stats["admitted"] += 1
+        self.stats["wait_total_s"] += waited
+        self.stats["wait_max_s"] = max(self.stats["wait_max_s"], waited)
+        acquired_at = time.monotonic()
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            held = time.monotonic() - acquired_at
+            self._hold_ewma = held if self._hold_ewma is None else 0.2 * held + 0.8 * self._hold_ewma
+            self._release()
+
+        return release
+
+    def _release(self):
+        while True:
+            waiter = self._queue.pop()
+            if waiter is None:
+                self.active -= 1
+                return
+            if not waiter.done():
+                waiter.set_result(None)  # The slot moves to the waiter; active is unchanged
+                return
+
+    def info(self):
+        admitted = self.stats["admitted"]
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queue_depth": len(self._queue),
+            "max_queue": self.max_queue,
+            "shed_depth": self.shed_depth,
+            "admitted": admitted,
+            "queued": self.stats["queued"],
+            "shed": self.stats["shed"],
+            "avg_wait_s": round(self.stats["wait_total_s"] / admitted, 3) if admitted else 0.0,
+            "max_wait_s": round(self.stats["wait_max_s"], 3),
+            "retry_after_s": self.retry_after(),
+            "queued_by_client": self._queue.depth_by_client()
+        }
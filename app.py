@@ -1,21 +1,41 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
+import asyncio
+import fcntl
+import httpx
+import json
 import os
 import sys
+import time
 from pathlib import Path
+import hashlib
+from typing import Optional
 
-# Secure credential loading
+from admission import AdmissionGate, Overloaded, RateLimited, RateLimiter
+from chat_cache import ChatResponseCache, is_deterministic, normalize_chat_prompt
+from image_cache import ImageResultCache, make_cache_key
+from singleflight import SingleFlight
+from ollama_router import ModelNotAllowed, OllamaRouter
+from sd_pool import NoBackendAvailable, SDBackendPool, overload_retry_after
+from sessions import SessionStore
+from storage import REQUEST_BASE_URL, CloudinaryStorage, LocalImageStore, StorageError, parse_range
+from jobs import JobManager, JobFailed, QueueFullError, SUCCEEDED, CANCELLED, DETACHED, FINISHED_STATES
+from metrics import (
+    REGISTRY, REQUEST_ID, REQUEST_ID_HEADER, TOKENS_PER_SECOND, TRACE, RequestContextMiddleware,
+    log_trace, record, span
+)
+
+# Secure credential loading: nothing is unlocked at import, so workers start without a prompt.
+# The first Cloudinary upload fetches the key from the credential agent (see credential_loader.py).
 try:
-    from credential_loader import load_encrypted_credentials, check_credentials
-    print("🔐 Loading encrypted credentials...")
-    creds_loaded = load_encrypted_credentials()
-    if not creds_loaded:
-        print("⚠️  Failed to load encrypted credentials. Cloudinary may not work.")
-    else:
-        print("✅ Credentials loaded successfully!")
+    from credential_loader import credential_status, ensure_credentials
 except ImportError as e:
     print(f"⚠️  Could not import credential loader: {e}")
     print("Cloudinary credentials may not be loaded securely.")
+    ensure_credentials = credential_status = None
 
 # Set up environment variables for Hugging Face Spaces
 os.environ["TRANSFORMERS_CACHE"] = "/tmp/transformers_cache"
@@ -26,31 +46,306 @@ os.environ["HF_DATASETS_CACHE"] = "/tmp/datasets_cache"
 for cache_dir in ["/tmp/transformers_cache", "/tmp/hf_home", "/tmp/datasets_cache"]:
     Path(cache_dir).mkdir(parents=True, exist_ok=True)
 
-# Import required libraries
-try:
-    import cloudinary
-    import cloudinary.uploader
-    cloudinary_available = True
-except ImportError as e:
-    print(f"Import error: {e}")
-    print("Cloudinary not available - image upload will fail")
-    cloudinary_available = False
-
-app = FastAPI(title="BUDDY Image Generation API", version="1.0.0")
-
-# Cloudinary config (set your env vars in the Space settings for security)
-if cloudinary_available:
-    cloudinary.config(
-        cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
-        api_key=os.getenv("CLOUDINARY_API_KEY"),
-        api_secret=os.getenv("CLOUDINARY_API_SECRET")
+# Upstream services
+# SD backends as comma-separated name=url pairs; the first is the primary
+SD_BACKENDS = [
+    tuple(part.strip() for part in entry.split("=", 1))
+    for entry in os.getenv("SD_BACKENDS", "primary=https://chiefmaybe-buddy-sd.hf.space").split(",")
+    if entry.strip()
+]
+SD_FAILOVER_BACKEND = os.getenv("SD_FAILOVER_BACKEND", "fast")  # Takes over when the primary queue is long
+SD_FAILOVER_QUEUE_DEPTH = int(os.getenv("SD_FAILOVER_QUEUE_DEPTH", "4"))
+SD_PROBE_INTERVAL = float(os.getenv("SD_PROBE_INTERVAL", "15"))
+SD_HEDGE_AFTER = float(os.getenv("SD_HEDGE_AFTER", "0"))  # Seconds before a hedged second request, 0 disables
+SD_BREAKER_FAILURES = int(os.getenv("SD_BREAKER_FAILURES", "3"))
+SD_BREAKER_RESET = float(os.getenv("SD_BREAKER_RESET", "30"))
+# Comma-separated Ollama base URLs; requests go to the least loaded one
+OLLAMA_URLS = [url.strip() for url in os.getenv("OLLAMA_URLS", "http://localhost:11434").split(",") if url.strip()]
+# Allowlisted chat models, the first is the default
+OLLAMA_MODELS = [model.strip() for model in os.getenv("OLLAMA_MODELS", "mistral").split(",") if model.strip()]
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # duration ("30m") or seconds; "-1" pins models in memory
+OLLAMA_MAX_IN_FLIGHT = int(os.getenv("OLLAMA_MAX_IN_FLIGHT", "2"))  # Per model, per endpoint
+OLLAMA_PRELOAD = os.getenv("OLLAMA_PRELOAD", "true").lower() == "true"
+OLLAMA_PROBE_INTERVAL = float(os.getenv("OLLAMA_PROBE_INTERVAL", "15"))
+OLLAMA_COOLDOWN = float(os.getenv("OLLAMA_COOLDOWN", "30"))  # Seconds a failed endpoint is skipped without a probe
+
+# Defaults the HF Space uses when a request leaves a parameter unset
+# (steps and guidance depend on the Space's tier presets, so unset values are keyed as-is)
+SD_MODEL = "CompVis/stable-diffusion-v1-4"
+SD_DEFAULT_SIZE = 512
+SD_TIER_STEPS = {"draft": 8, "standard": 20, "quality": 50}  # Upper bounds; draft is 4 steps with LCM
+SD_DEFAULT_TIER = os.getenv("SD_DEFAULT_TIER", "quality")
+
+# Generated image cache (memory LRU in front of an on-disk index)
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "true").lower() == "true"
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "/tmp/buddy_image_cache")
+IMAGE_CACHE_MEMORY_ENTRIES = int(os.getenv("IMAGE_CACHE_MEMORY_ENTRIES", "256"))
+IMAGE_CACHE_DISK_ENTRIES = int(os.getenv("IMAGE_CACHE_DISK_ENTRIES", "10000"))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Background image jobs
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", "50"))
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))  # Keep finished jobs pollable for an hour
+JOB_RETRY_AFTER = int(os.getenv("JOB_RETRY_AFTER", "60"))  # Until a job has finished to estimate from
+JOB_SHED_DEPTH = int(os.getenv("JOB_SHED_DEPTH", "40"))  # Past this only priority (cheap) jobs are queued
+JOB_MAX_PER_CLIENT = int(os.getenv("JOB_MAX_PER_CLIENT", "10"))  # Queued jobs per client, 0 for no limit
+
+# Admission control: per-client token buckets, fair queuing across clients and load shedding.
+# Clients are keyed by X-API-Key (as key:<hash prefix>) or else by IP (as ip:<address>).
+# Only keys listed in ADMISSION_API_KEYS count; any other key is ignored, or a client could
+# get a fresh token bucket by sending a new one with each request.
+ADMISSION_API_KEYS = {key.strip() for key in os.getenv("ADMISSION_API_KEYS", "").split(",") if key.strip()}
+ADMISSION_TRUST_PROXY = os.getenv("ADMISSION_TRUST_PROXY", "false").lower() == "true"  # Use X-Forwarded-For
+# Comma-separated client=weight pairs; a weight of 2 gets twice the share of a busy queue
+ADMISSION_CLIENT_WEIGHTS = {
+    client.strip(): float(weight)
+    for client, weight in (
+        entry.rsplit("=", 1) for entry in os.getenv("ADMISSION_CLIENT_WEIGHTS", "").split(",") if "=" in entry
+    )
+}
+IMAGE_RATE_PER_MIN = float(os.getenv("IMAGE_RATE_PER_MIN", "10"))  # 0 disables
+IMAGE_RATE_BURST = float(os.getenv("IMAGE_RATE_BURST", "5"))
+IMAGE_PRIORITY_MAX_COST = float(os.getenv("IMAGE_PRIORITY_MAX_COST", "0.2"))  # A 512x512 draft is 0.16
+CHAT_RATE_PER_MIN = float(os.getenv("CHAT_RATE_PER_MIN", "30"))  # 0 disables
+CHAT_RATE_BURST = float(os.getenv("CHAT_RATE_BURST", "10"))
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", "8"))  # Chat requests admitted at once, all models
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "32"))
+CHAT_MAX_PER_CLIENT = int(os.getenv("CHAT_MAX_PER_CLIENT", "8"))  # Queued chats per client, 0 for no limit
+
+# Image bodies stay in memory up to this size, then spill to a temp file
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Where generated images are stored: "cloudinary" or "local" (served from /images)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "cloudinary").lower()
+LOCAL_STORE_DIR = os.getenv("LOCAL_STORE_DIR", "/tmp/buddy_images")
+LOCAL_STORE_BASE_URL = os.getenv("LOCAL_STORE_BASE_URL", "")  # Empty: the URL the client used to reach us
+LOCAL_STORE_MAX_BYTES = int(os.getenv("LOCAL_STORE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+# Chat sessions (Ollama context kept between turns)
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "1000"))
+CHAT_SESSION_TTL = int(os.getenv("CHAT_SESSION_TTL", "3600"))
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "4096"))  # Per-session context budget
+
+# Chat response cache, used only for requests with deterministic options (temperature 0, or a temperature and seed)
+CHAT_CACHE_ENABLED = os.getenv("CHAT_CACHE_ENABLED", "true").lower() == "true"
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1000"))
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", str(24 * 3600)))
+# Also match rewordings whose character trigrams overlap by at least CHAT_CACHE_MIN_SIMILARITY (Jaccard)
+CHAT_CACHE_NEAR_DUPLICATES = os.getenv("CHAT_CACHE_NEAR_DUPLICATES", "false").lower() == "true"
+CHAT_CACHE_MIN_SIMILARITY = float(os.getenv("CHAT_CACHE_MIN_SIMILARITY", "0.85"))
+CHAT_CACHE_HEADER = "X-Chat-Cache"  # hit, near-hit, miss or bypass on cacheable requests
+
+# Connection pool sizing (per upstream host)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+# Jobs, chat sessions and admission limits live in this process's memory, so exactly one
+# backend process may serve a given state; the work itself is async I/O that one process handles
+BACKEND_LOCK_FILE = os.getenv("BACKEND_LOCK_FILE", "/tmp/buddy_backend.lock")
+
+def _claim_single_process():
+    """Hold an exclusive lock for the process lifetime; a second worker (e.g. --workers 4) fails to start"""
+    lock = open(BACKEND_LOCK_FILE, "a+")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.seek(0)
+        holder = lock.read().strip() or "another process"
+        lock.close()
+        raise RuntimeError(
+            f"BUDDY backend already running (pid {holder}, lock {BACKEND_LOCK_FILE}). Jobs, chat sessions and "
+            "rate limits are kept in memory, so run a single worker; set BACKEND_LOCK_FILE to run a separate instance."
+        )
+    lock.seek(0)
+    lock.truncate()
+    lock.write(str(os.getpid()))
+    lock.flush()
+    return lock
+
+def _make_client(timeout):
+    """Create a pooled async HTTP client for a single upstream host"""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout, connect=10.0),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    )
+
+@asynccontextmanager
+async def lifespan(app):
+    """Open shared HTTP clients on startup and close them on shutdown"""
+    process_lock = _claim_single_process()
+    # One client per upstream so each host gets its own connection limits
+    app.state.sd_pool = SDBackendPool(
+        SD_BACKENDS,
+        lambda: _make_client(2000.0),  # 33-minute timeout for CPU generation
+        probe_interval=SD_PROBE_INTERVAL,
+        hedge_after=SD_HEDGE_AFTER,
+        failover_backend=SD_FAILOVER_BACKEND,
+        failover_queue_depth=SD_FAILOVER_QUEUE_DEPTH,
+        failure_threshold=SD_BREAKER_FAILURES,
+        reset_timeout=SD_BREAKER_RESET,
+        spool_bytes=UPLOAD_SPOOL_BYTES,
+        chunk_size=STREAM_CHUNK_SIZE
+    )
+    await app.state.sd_pool.start()
+    app.state.ollama = OllamaRouter(
+        OLLAMA_URLS,
+        OLLAMA_MODELS,
+        lambda: _make_client(30.0),
+        keep_alive=OLLAMA_KEEP_ALIVE,
+        max_in_flight=OLLAMA_MAX_IN_FLIGHT,
+        probe_interval=OLLAMA_PROBE_INTERVAL,
+        cooldown=OLLAMA_COOLDOWN
+    )
+    await app.state.ollama.start()
+    # Load chat models in the background so startup is not held up by Ollama
+    preload = asyncio.create_task(app.state.ollama.preload()) if OLLAMA_PRELOAD else None
+    if STORAGE_BACKEND == "local":
+        app.state.storage = LocalImageStore(
+            LOCAL_STORE_DIR, LOCAL_STORE_BASE_URL, max_bytes=LOCAL_STORE_MAX_BYTES, chunk_size=STREAM_CHUNK_SIZE
+        )
+    else:
+        # Credentials come from env vars (e.g. Space secrets) or are unlocked on the first upload
+        app.state.storage = CloudinaryStorage(unlock=ensure_credentials)
+    print(f"[BACKEND] Image storage backend: {app.state.storage.name}")
+    app.state.chat_sessions = SessionStore(
+        max_sessions=CHAT_MAX_SESSIONS, ttl=CHAT_SESSION_TTL, token_budget=CHAT_CONTEXT_TOKENS
+    )
+    app.state.chat_cache = None
+    if CHAT_CACHE_ENABLED:
+        app.state.chat_cache = ChatResponseCache(
+            max_entries=CHAT_CACHE_MAX_ENTRIES,
+            ttl=CHAT_CACHE_TTL,
+            near_duplicates=CHAT_CACHE_NEAR_DUPLICATES,
+            min_similarity=CHAT_CACHE_MIN_SIMILARITY
+        )
+    app.state.image_flights = SingleFlight()
+    app.state.image_cache = None
+    if IMAGE_CACHE_ENABLED:
+        app.state.image_cache = ImageResultCache(
+            IMAGE_CACHE_DIR,
+            memory_entries=IMAGE_CACHE_MEMORY_ENTRIES,
+            disk_entries=IMAGE_CACHE_DISK_ENTRIES,
+            ttl=IMAGE_CACHE_TTL
+        )
+    app.state.jobs = JobManager(
+        _run_image_job,
+        workers=JOB_WORKERS,
+        max_queue=JOB_MAX_QUEUE,
+        ttl=JOB_TTL,
+        shed_depth=JOB_SHED_DEPTH,
+        max_queued_per_client=JOB_MAX_PER_CLIENT or None
+    )
+    app.state.image_limiter = RateLimiter(IMAGE_RATE_PER_MIN, IMAGE_RATE_BURST)
+    app.state.chat_limiter = RateLimiter(CHAT_RATE_PER_MIN, CHAT_RATE_BURST)
+    app.state.chat_gate = AdmissionGate(
+        "chat", CHAT_CONCURRENCY, max_queue=CHAT_MAX_QUEUE, max_queued_per_client=CHAT_MAX_PER_CLIENT or None
     )
+    await app.state.jobs.start()
+    try:
+        yield
+    finally:
+        if preload is not None:
+            preload.cancel()
+        await app.state.jobs.stop()
+        await app.state.sd_pool.aclose()
+        await app.state.ollama.aclose()
+        if app.state.image_cache is not None:
+            app.state.image_cache.close()
+        process_lock.close()
+
+app = FastAPI(title="BUDDY Image Generation API", version="1.0.0", lifespan=lifespan)
+# Request ids (passed on to the SD backends), Server-Timing and per-request trace logs
+app.add_middleware(RequestContextMiddleware)
+
+# Scrape-time views of the stats already reported by /health
+REGISTRY.callback(
+    "buddy_jobs", "Image jobs by state", lambda: {
+        ("queued",): app.state.jobs.info()["queued"], ("running",): app.state.jobs.info()["running"]
+    }, ("state",)
+)
+REGISTRY.callback(
+    "buddy_sd_backend_in_flight", "Requests in flight per SD backend",
+    lambda: {(b.name,): b.in_flight for b in app.state.sd_pool.backends}, ("backend",)
+)
+REGISTRY.callback(
+    "buddy_sd_backend_queue_depth", "Queue depth last reported by each SD backend",
+    lambda: {(b.name,): b.queue_depth for b in app.state.sd_pool.backends}, ("backend",)
+)
+REGISTRY.callback(
+    "buddy_sd_backend_circuit_open", "1 while an SD backend's circuit breaker is not closed",
+    lambda: {(b.name,): int(b.breaker.state != "closed") for b in app.state.sd_pool.backends}, ("backend",)
+)
+REGISTRY.callback(
+    "buddy_sd_backend_requests_total", "Requests sent to each SD backend by outcome",
+    lambda: {
+        (b.name, outcome): b.stats[outcome]
+        for b in app.state.sd_pool.backends for outcome in ("successes", "failures")
+    }, ("backend", "outcome"), kind="counter"
+)
+REGISTRY.callback(
+    "buddy_ollama_in_flight", "Chat requests in flight per Ollama endpoint",
+    lambda: {(e.base_url,): e.in_flight for e in app.state.ollama.endpoints}, ("endpoint",)
+)
+REGISTRY.callback(
+    "buddy_image_cache_lookups_total", "Image cache lookups by outcome",
+    lambda: {
+        (outcome,): app.state.image_cache.stats[outcome] for outcome in ("memory_hits", "disk_hits", "misses")
+    }, ("outcome",), kind="counter"
+)
+REGISTRY.callback(
+    "buddy_chat_cache_lookups_total", "Chat response cache lookups by outcome",
+    lambda: {
+        (outcome,): app.state.chat_cache.stats[outcome] for outcome in ("hits", "near_hits", "misses", "bypassed")
+    }, ("outcome",), kind="counter"
+)
+REGISTRY.callback(
+    "buddy_admission_queue_depth", "Requests waiting for admission by queue",
+    lambda: {("image",): app.state.jobs.info()["queued"], ("chat",): app.state.chat_gate.info()["queue_depth"]},
+    ("queue",)
+)
+REGISTRY.callback(
+    "buddy_admission_shed_total", "Requests shed because a queue was too deep",
+    lambda: {("image",): app.state.jobs.stats["rejected"], ("chat",): app.state.chat_gate.stats["shed"]},
+    ("queue",), kind="counter"
+)
+REGISTRY.callback(
+    "buddy_admission_rate_limited_total", "Requests refused by a client's token bucket",
+    lambda: {
+        ("image",): app.state.image_limiter.stats["limited"], ("chat",): app.state.chat_limiter.stats["limited"]
+    }, ("queue",), kind="counter"
+)
+REGISTRY.callback(
+    "buddy_admission_priority_jobs_total", "Image jobs queued in the priority lane",
+    lambda: app.state.jobs.stats["priority"], kind="counter"
+)
 
 class PromptRequest(BaseModel):
     prompt: str
+    tier: Optional[str] = None  # draft, standard or quality (see the SD Space)
+    steps: Optional[int] = None
+    scheduler: Optional[str] = None
+    guidance_scale: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    seed: Optional[int] = None
+    format: Optional[str] = None  # png (default), webp, jpeg or avif
+    quality: Optional[int] = None
+    upscale: Optional[int] = None  # 2 or 4: render at width x height, then upscale on the Space
 
 class ChatRequest(BaseModel):
     prompt: str
+    model: Optional[str] = None  # One of OLLAMA_MODELS, defaults to the first
+    stream: bool = False  # Relay tokens as NDJSON as they are generated
+    session_id: Optional[str] = None  # Continue a session from POST /chat/sessions
+    temperature: Optional[float] = None  # Ollama sampling options; 0, or a temperature with a seed, is cacheable
+    seed: Optional[int] = None
 
 @app.get("/")
 async def root():
@@ -60,8 +355,11 @@ async def root():
         "mode": "proxy_to_huggingface",
         "endpoints": {
             "generate": "/generate (POST)",
+            "jobs": "/jobs/generate (POST), /jobs/{id} (GET, DELETE), /jobs/{id}/events (GET, SSE)",
             "health": "/health (GET)",
-            "chat": "/chat (POST)"
+            "chat": "/chat (POST, set \"stream\": true for NDJSON tokens)",
+            "chat_sessions": "/chat/sessions (POST), /chat/sessions/{id} (GET, DELETE)",
+            "metrics": "/metrics (GET, Prometheus text format)"
         }
     }
 
@@ -70,64 +368,83 @@ async def health_check():
     return {
         "status": "healthy",
         "mode": "proxy_to_huggingface",
-        "cloudinary_configured": bool(os.getenv("CLOUDINARY_CLOUD_NAME"))
+        # Credentials load on the first upload; "available" says whether that load can succeed
+        "cloudinary_credentials": credential_status() if credential_status is not None else None,
+        "storage": app.state.storage.info(),
+        "chat_sessions": app.state.chat_sessions.info(),
+        "chat_cache": app.state.chat_cache.info() if app.state.chat_cache else None,
+        "ollama": app.state.ollama.info(),
+        "image_cache": app.state.image_cache.info() if app.state.image_cache else None,
+        "image_generations": app.state.image_flights.info(),
+        "sd_backends": app.state.sd_pool.info(),
+        "jobs": app.state.jobs.info(),
+        "admission": {
+            "chat": app.state.chat_gate.info(),
+            "image_rate_limit": app.state.image_limiter.info(),
+            "chat_rate_limit": app.state.chat_limiter.info()
+        }
     }
 
-@app.post("/generate")
-async def generate_image(request: PromptRequest):
-    """Proxy image generation request to Hugging Face Space"""
-    import requests
-    import json
-    
-    print(f"[BACKEND] Received image generation request: {request.prompt}")
-    # Hugging Face Space URL
-    hf_url = "https://chiefmaybe-buddy-sd.hf.space/generate"
-    
-    # Prepare the request for Hugging Face Space
-    json_data = {"prompt": request.prompt}
-    headers = {"Content-Type": "application/json"}
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of stage timings, latencies and pool state"""
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+async def _generate_and_upload(request: PromptRequest, cache_key: str):
+    """Run one HF Space generation plus storage upload; returns (image URL, routing info)"""
+    # Prepare the request for Hugging Face Space (only forward parameters the client set)
+    json_data = request.model_dump(exclude_none=True)
+    # The SD server logs and echoes the same request id, so the two traces can be joined
+    headers = {"Content-Type": "application/json", REQUEST_ID_HEADER: REQUEST_ID.get() or ""}
     
     try:
         print(f"[BACKEND] Forwarding to Hugging Face Space: {request.prompt}")
-        # Send request to Hugging Face Space with 33-minute timeout
-        response = requests.post(hf_url, json=json_data, headers=headers, timeout=2000)
-        response.raise_for_status()
-        print(f"[BACKEND] Received image bytes from Hugging Face Space for: {request.prompt}")
-        
-        # Get the image bytes from Hugging Face Space
-        image_bytes = response.content
+        # The pool picks a backend and spools the image chunk by chunk
+        started = time.perf_counter()
+        image_file, content_type, route = await app.state.sd_pool.generate(json_data, headers)
+        record("sd_round_trip", time.perf_counter() - started, route["served_by"])
+        print(f"[BACKEND] Received image bytes from SD backend {route['served_by']} for: {request.prompt}")
         
-        # Upload to Cloudinary
-        if not all([os.getenv("CLOUDINARY_CLOUD_NAME"), 
-                    os.getenv("CLOUDINARY_API_KEY"), 
-                    os.getenv("CLOUDINARY_API_SECRET")]):
-            print("[BACKEND] Cloudinary configuration missing.")
-            raise HTTPException(
-                status_code=500, 
-                detail="Cloudinary configuration missing. Please set CLOUDINARY_* environment variables."
-            )
-        print(f"[BACKEND] Uploading image to Cloudinary...")
-        # Upload image bytes to Cloudinary
-        result = cloudinary.uploader.upload(
-            image_bytes, 
-            resource_type="image",
-            folder="buddy-generated"
-        )
-        print(f"[BACKEND] Cloudinary upload result: {result}")
-        print(f"[BACKEND] Returning image URL to frontend: {result['secure_url']}")
-        return {
-            "url": result["secure_url"],
-            "prompt": request.prompt,
-            "status": "success"
-        }
+        # Store with the configured backend (Cloudinary or the local image store)
+        with image_file, span("upload", app.state.storage.name):
+            url = await app.state.storage.save(image_file, content_type)
+        if app.state.image_cache is not None:
+            await app.state.image_cache.put(cache_key, url)
+        return url, route
         
-    except requests.exceptions.Timeout:
+    except HTTPException:
+        raise
+    except NoBackendAvailable as e:
+        print(f"[BACKEND] {e}")
+        raise HTTPException(status_code=503, detail=f"{e}, please retry shortly.")
+    except StorageError as e:
+        print(f"[BACKEND] {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    except httpx.TimeoutException:
         print(f"[BACKEND] Timeout generating image for: {request.prompt}")
         raise HTTPException(
             status_code=408, 
             detail="Image generation timed out. Please try again."
         )
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPStatusError as e:
+        print(f"[BACKEND] Error calling Hugging Face Space: {e}")
+        retry_after = overload_retry_after(e)
+        if e.response.status_code < 500 or retry_after is not None:
+            # The Space rejected the request itself (e.g. unknown tier) or is shedding load, pass its answer through
+            try:
+                detail = e.response.json().get("detail", e.response.text)
+            except ValueError:
+                detail = e.response.text
+            raise HTTPException(
+                status_code=e.response.status_code,
+                detail=detail,
+                headers={"Retry-After": retry_after} if retry_after is not None else None
+            )
+        raise HTTPException(
+            status_code=503, 
+            detail=f"Hugging Face Space is not available: {str(e)}"
+        )
+    except httpx.HTTPError as e:
         print(f"[BACKEND] Error calling Hugging Face Space: {e}")
         raise HTTPException(
             status_code=503, 
@@ -140,45 +457,510 @@ async def generate_image(request: PromptRequest):
             detail=f"Image generation failed: {str(e)}"
         )
 
-@app.post("/chat")
-async def chat_with_ollama(request: ChatRequest):
-    """Chat endpoint that communicates with local Ollama instance"""
+def _image_cache_key(request: PromptRequest):
+    return make_cache_key(
+        request.prompt,
+        SD_MODEL,
+        steps=request.steps,
+        guidance_scale=request.guidance_scale,
+        width=request.width or SD_DEFAULT_SIZE,
+        height=request.height or SD_DEFAULT_SIZE,
+        seed=request.seed,
+        tier=request.tier,
+        scheduler=request.scheduler,
+        format=request.format,
+        quality=request.quality,
+        upscale=request.upscale
+    )
+
+async def _cached_image_result(request: PromptRequest):
+    """Return a finished result from the image cache, or None on a miss"""
+    if app.state.image_cache is None:
+        return None
+    with span("cache_lookup"):
+        cached_url = await app.state.image_cache.get(_image_cache_key(request))
+    if not cached_url or not app.state.storage.contains(cached_url):
+        return None
+    cached_url = app.state.storage.public_url(cached_url)
+    print(f"[BACKEND] Cache hit, returning stored image URL: {cached_url}")
+    return {
+        "url": cached_url,
+        "prompt": request.prompt,
+        "status": "success",
+        "cached": True
+    }
+
+async def _run_image_job(job):
+    """Job runner: generate (or join an identical in-flight generation) and upload"""
+    request = job.payload
+    cache_key = _image_cache_key(request)
+    # Runs in the submitting request's context, so this lands in its trace
+    record("queue_wait", job.started_at - job.created_at)
+    try:
+        # Identical concurrent requests (e.g. client retries) share one generation
+        url, route = await app.state.image_flights.do(
+            cache_key, lambda: _generate_and_upload(request, cache_key)
+        )
+    except HTTPException as e:
+        raise JobFailed(e.status_code, e.detail, (e.headers or {}).get("Retry-After"))
+    finally:
+        log_trace(REQUEST_ID.get(), TRACE.get() or {}, job=job.id)
+    print(f"[BACKEND] Returning image URL to frontend: {url}")
+    return {
+        "url": url,
+        "prompt": request.prompt,
+        "status": "success",
+        "cached": False,
+        "backend": route
+    }
+
+def _client_key(http_request: Request):
+    """Who to charge a request to: its API key if it is a known one, otherwise its IP"""
+    api_key = http_request.headers.get("x-api-key")
+    if api_key and api_key in ADMISSION_API_KEYS:
+        # Hashed so keys never show up in /health or the logs
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+    forwarded = http_request.headers.get("x-forwarded-for") if ADMISSION_TRUST_PROXY else None
+    if forwarded:
+        return "ip:" + forwarded.split(",")[0].strip()
+    return "ip:" + (http_request.client.host if http_request.client else "unknown")
+
+def _check_rate(limiter, client):
+    try:
+        limiter.check(client)
+    except RateLimited as e:
+        print(f"[BACKEND] Rate limiting {client}: {e}")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def _image_cost(request: PromptRequest):
+    """Expected SD work relative to a 512x512 quality-tier image"""
+    steps = request.steps or SD_TIER_STEPS.get(request.tier or SD_DEFAULT_TIER, SD_TIER_STEPS["quality"])
+    pixels = (request.width or SD_DEFAULT_SIZE) * (request.height or SD_DEFAULT_SIZE)
+    cost = steps / SD_TIER_STEPS["quality"] * pixels / (SD_DEFAULT_SIZE * SD_DEFAULT_SIZE)
+    if request.upscale:
+        cost += 0.5  # The upscaler runs after the UNet on the same CPU
+    return cost
+
+def _submit_image_job(request: PromptRequest, client: str):
+    """Queue an image job, or return the unfinished job already queued for the same image"""
+    cache_key = _image_cache_key(request)
+    # Queued duplicates share one job; each requester is a holder, so one cancelling doesn't cancel the others
+    existing = app.state.jobs.find(cache_key)
+    if existing is not None:
+        print(f"[BACKEND] Attaching to queued job {existing.id} for: {request.prompt}")
+        app.state.jobs.attach(existing, client)
+        return existing
+    cost = _image_cost(request)
+    # Cheap renders (drafts, small images) go in a lane ahead of the queue and are shed last
+    priority = cost <= IMAGE_PRIORITY_MAX_COST and not request.upscale
+    try:
+        job = app.state.jobs.submit(
+            "generate", request, client=client, cost=cost,
+            weight=ADMISSION_CLIENT_WEIGHTS.get(client, 1.0), priority=priority, key=cache_key
+        )
+        return job
+    except QueueFullError as e:
+        print(f"[BACKEND] Rejecting image request from {client}, {e}")
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after or JOB_RETRY_AFTER)}
+        )
+
+@app.post("/generate")
+async def generate_image(request: PromptRequest, http_request: Request):
+    """Proxy image generation request to Hugging Face Space (waits for the job to finish)"""
+    print(f"[BACKEND] Received image generation request: {request.prompt}")
+    REQUEST_BASE_URL.set(str(http_request.base_url))
+    
+    cached = await _cached_image_result(request)
+    if cached is not None:
+        return cached
+    
+    client = _client_key(http_request)
+    _check_rate(app.state.image_limiter, client)
+    job = _submit_image_job(request, client)
+    await job.done.wait()
+    if job.status == SUCCEEDED:
+        return job.result
+    if job.status == CANCELLED:
+        raise HTTPException(status_code=409, detail="Image generation was cancelled.")
+    raise HTTPException(
+        status_code=job.status_code or 500,
+        detail=job.error,
+        headers={"Retry-After": job.retry_after} if job.retry_after is not None else None
+    )
+
+@app.post("/jobs/generate", status_code=202)
+async def submit_generate_job(request: PromptRequest, http_request: Request):
+    """Queue an image generation and return its job id immediately"""
+    print(f"[BACKEND] Received image job request: {request.prompt}")
+    REQUEST_BASE_URL.set(str(http_request.base_url))  # The job runs in this context
+    cached = await _cached_image_result(request)
+    if cached is not None:
+        job = app.state.jobs.complete("generate", request, cached)
+    else:
+        client = _client_key(http_request)
+        _check_rate(app.state.image_limiter, client)
+        job = _submit_image_job(request, client)
+    return {
+        **job.to_dict(),
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events"
+    }
+
+def _get_job_or_404(job_id: str):
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Poll a job's status, queue position and result"""
+    return _get_job_or_404(job_id).to_dict()
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, http_request: Request):
+    """Cancel a queued or running job, or stop waiting on it if other requesters share it"""
+    job = _get_job_or_404(job_id)
+    try:
+        outcome = app.state.jobs.cancel(job_id, _client_key(http_request))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=f"{e}.")
+    if outcome is None:
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}.")
+    return {**job.to_dict(), "detached": outcome == DETACHED}
+
+async def _job_events(http_request: Request, job):
+    queue = job.subscribe()
+    try:
+        while True:
+            try:
+                snapshot = await asyncio.wait_for(queue.get(), timeout=15)
+            except asyncio.TimeoutError:
+                if await http_request.is_disconnected():
+                    return
+                yield ": keep-alive\n\n"  # stop proxies from closing an idle stream
+                continue
+            yield f"event: status\ndata: {json.dumps(snapshot)}\n\n"
+            if snapshot["status"] in FINISHED_STATES:
+                return
+    finally:
+        job.unsubscribe(queue)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, http_request: Request):
+    """Server-sent events stream of a job's state changes"""
+    job = _get_job_or_404(job_id)
+    return StreamingResponse(
+        _job_events(http_request, job),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+def _record_ollama_timings(model, final_chunk):
+    """Ollama reports prompt-eval and eval durations (in ns) on its final chunk"""
+    prompt_eval_ns = final_chunk.get("prompt_eval_duration")
+    eval_ns = final_chunk.get("eval_duration")
+    if prompt_eval_ns:
+        record("ollama_prompt_eval", prompt_eval_ns / 1e9, model)
+    if eval_ns:
+        record("ollama_eval", eval_ns / 1e9, model)
+        TOKENS_PER_SECOND.observe(final_chunk.get("eval_count", 0) / (eval_ns / 1e9), model=model)
+
+async def _stream_ollama(http_request: Request, response: httpx.Response, started: float, model: str, session=None,
+                         on_complete=None):
+    """Relay Ollama NDJSON chunks to the client, ending with a timing trailer.
+
+    on_complete(text, final_chunk) is called once a reply has been streamed in full.
+    """
+    first_token_at = None
+    token_count = 0
+    tokens = []
+    final_chunk = {}
     try:
-        import requests
-        import json
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            # Stop pulling tokens (and drop the upstream connection) once the client is gone
+            if await http_request.is_disconnected():
+                print("[BACKEND] Chat client disconnected, cancelling Ollama generation")
+                return
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                yield json.dumps({"error": chunk["error"], "done": True, "status": "error"}) + "\n"
+                return
+            if chunk.get("done"):
+                final_chunk = chunk
+                break
+            token = chunk.get("response", "")
+            if token:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                token_count += 1
+                if on_complete is not None:
+                    tokens.append(token)
+                yield json.dumps({"response": token, "done": False}) + "\n"
         
-        # Ollama API endpoint
-        ollama_url = "http://localhost:11434/api/generate"
+        finished = time.perf_counter()
+        _record_ollama_timings(model, final_chunk)
+        if first_token_at is not None:
+            record("ollama_first_token", first_token_at - started, model)
+        # Prefer Ollama's own eval counters, fall back to what we observed
+        eval_count = final_chunk.get("eval_count", token_count)
+        eval_duration_ns = final_chunk.get("eval_duration")
+        if eval_duration_ns:
+            tokens_per_sec = eval_count / (eval_duration_ns / 1e9)
+        elif first_token_at is not None and finished > first_token_at:
+            tokens_per_sec = token_count / (finished - first_token_at)
+        else:
+            tokens_per_sec = 0.0
         
+        trailer = {
+            "done": True,
+            "status": "success",
+            "time_to_first_token_ms": round((first_token_at - started) * 1000, 1) if first_token_at else None,
+            "total_time_ms": round((finished - started) * 1000, 1),
+            "eval_count": eval_count,
+            "tokens_per_sec": round(tokens_per_sec, 2)
+        }
+        if session is not None:
+            trailer["session_id"] = session.id
+            trailer["turn"] = app.state.chat_sessions.record_turn(session, final_chunk)
+        if on_complete is not None and final_chunk:
+            on_complete("".join(tokens), final_chunk)
+        yield json.dumps(trailer) + "\n"
+    finally:
+        # Closing the upstream response aborts generation on the Ollama side
+        await response.aclose()
+
+async def _replay_cached_chat(entry, started: float):
+    """A cached reply streamed back as a single chunk, then the usual trailer"""
+    yield json.dumps({"response": entry.response, "done": False}) + "\n"
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    yield json.dumps({
+        "done": True,
+        "status": "success",
+        "cached": True,
+        "time_to_first_token_ms": elapsed_ms,
+        "total_time_ms": elapsed_ms,
+        "eval_count": entry.counters.get("eval_count"),
+        "tokens_per_sec": None
+    }) + "\n"
+
+@app.post("/chat")
+async def chat_with_ollama(request: ChatRequest, http_request: Request, http_response: Response):
+    """Chat endpoint that communicates with local Ollama instance"""
+    router = app.state.ollama
+    try:
+        model = router.resolve_model(request.model)
+    except ModelNotAllowed as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    session = None
+    if request.session_id is not None:
+        session = app.state.chat_sessions.get(request.session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Chat session not found or expired.")
+        # Context tokens only make sense to the model that produced them
+        if session.model is not None and session.model != model:
+            raise HTTPException(status_code=409, detail=f"Chat session belongs to model '{session.model}'.")
+        session.model = model
+    
+    # Repeated deterministic prompts are answered from the cache; sessions depend on earlier turns, so never are
+    cache = app.state.chat_cache
+    cache_scope = None
+    cache_headers = {}
+    if cache is not None and session is None and is_deterministic(request.temperature, request.seed):
+        cache_scope = cache.scope(model, temperature=request.temperature, seed=request.seed)
+        cache_control = http_request.headers.get("cache-control", "").lower()
+        if "no-store" in cache_control or "no-cache" in cache_control:
+            cache.bypass()
+            cache_headers[CHAT_CACHE_HEADER] = "bypass"
+            if "no-store" in cache_control:
+                cache_scope = None  # Don't keep this reply either
+        else:
+            with span("chat_cache_lookup"):
+                entry = cache.get(cache_scope, request.prompt)
+            if entry is not None:
+                status = "hit" if entry.prompt == normalize_chat_prompt(request.prompt) else "near-hit"
+                print(f"[BACKEND] Chat cache {status} for: {request.prompt}")
+                if request.stream:
+                    return StreamingResponse(
+                        _replay_cached_chat(entry, time.perf_counter()),
+                        media_type="application/x-ndjson",
+                        headers={CHAT_CACHE_HEADER: status}
+                    )
+                http_response.headers[CHAT_CACHE_HEADER] = status
+                return {"response": entry.response, "status": "success", "model": model, "cached": True}
+            cache_headers[CHAT_CACHE_HEADER] = "miss"
+    
+    def remember(text, final_chunk):
+        if cache_scope is not None and text:
+            cache.put(cache_scope, request.prompt, text, final_chunk)
+    
+    client = _client_key(http_request)
+    _check_rate(app.state.chat_limiter, client)
+    try:
+        # A share of the chat budget first, served fairly across clients
+        admitted = await app.state.chat_gate.acquire(client, weight=ADMISSION_CLIENT_WEIGHTS.get(client, 1.0))
+    except Overloaded as e:
+        print(f"[BACKEND] Shedding chat request from {client}, {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    
+    # Wait for a free slot for this model; the lease picks the endpoint
+    try:
+        lease = await router.acquire(model)
+    except BaseException:
+        admitted()
+        raise
+    endpoint = lease.endpoint
+    
+    def release():
+        lease.release()
+        admitted()
+    
+    try:
         # Prepare the request for Ollama
         ollama_request = {
-            "model": "mistral",  # Using the mistral model
+            "model": model,
             "prompt": request.prompt,
-            "stream": False
+            "stream": request.stream,
+            "keep_alive": router.keep_alive  # Keep the model loaded between requests
         }
+        if session is not None and session.context:
+            # Ollama continues from these tokens, so only the new prompt is evaluated
+            ollama_request["context"] = session.context
+        options = {"temperature": request.temperature, "seed": request.seed}
+        options = {name: value for name, value in options.items() if value is not None}
+        if options:
+            ollama_request["options"] = options
+        
+        if request.stream:
+            started = time.perf_counter()
+            upstream = endpoint.client.build_request("POST", endpoint.generate_url, json=ollama_request)
+            response = await endpoint.client.send(upstream, stream=True)
+            router.mark(endpoint, model, True)
+            if response.is_error:
+                await response.aread()
+                await response.aclose()
+                response.raise_for_status()
+            
+            async def finish_stream():
+                await response.aclose()
+                release()
+            
+            # The background task also runs if the client disconnects before streaming starts
+            return StreamingResponse(
+                _stream_ollama(
+                    http_request, response, started, model, session, remember if cache_scope is not None else None
+                ),
+                media_type="application/x-ndjson",
+                headers=cache_headers,
+                background=BackgroundTask(finish_stream)
+            )
         
         # Send request to Ollama
-        response = requests.post(ollama_url, json=ollama_request, timeout=30)
-        response.raise_for_status()
+        try:
+            with span("ollama_round_trip", model):
+                response = await endpoint.client.post(endpoint.generate_url, json=ollama_request)
+            router.mark(endpoint, model, True)
+            response.raise_for_status()
+        finally:
+            release()
         
         # Parse Ollama response
         ollama_response = response.json()
+        _record_ollama_timings(model, ollama_response)
         generated_text = ollama_response.get("response", "Sorry, I couldn't generate a response.")
         
-        return {
+        result = {
             "response": generated_text,
-            "status": "success"
+            "status": "success",
+            "model": model,
+            "cached": False
         }
+        if "response" in ollama_response:
+            remember(generated_text, ollama_response)
+        http_response.headers.update(cache_headers)
+        if session is not None:
+            result["session_id"] = session.id
+            result["turn"] = app.state.chat_sessions.record_turn(session, ollama_response)
+        return result
         
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
+        release()
+        router.mark(endpoint, model, False)
         raise HTTPException(
             status_code=503,
-            detail="Ollama service is not available. Please make sure Ollama is running with 'ollama run mistral'"
+            detail=f"Ollama service is not available at {endpoint.base_url}. Please make sure Ollama is running with 'ollama run {model}'"
         )
     except Exception as e:
+        release()
         print(f"Chat error: {e}")
         raise HTTPException(status_code=500, detail=f"Chat failed: {str(e)}")
 
+@app.post("/chat/sessions", status_code=201)
+async def create_chat_session():
+    """Start a chat session; pass its session_id to /chat to keep context between turns"""
+    return app.state.chat_sessions.create().to_dict()
+
+@app.get("/chat/sessions/{session_id}")
+async def get_chat_session(session_id: str):
+    session = app.state.chat_sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Chat session not found or expired.")
+    return session.to_dict()
+
+@app.delete("/chat/sessions/{session_id}")
+async def delete_chat_session(session_id: str):
+    if not app.state.chat_sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Chat session not found or expired.")
+    return {"session_id": session_id, "status": "deleted"}
+
+@app.get("/images/{name}")
+async def serve_image(name: str, http_request: Request):
+    """Serve an image from the local store with ETag and Range support"""
+    storage = app.state.storage
+    found = storage.lookup(name) if isinstance(storage, LocalImageStore) else None
+    if found is None:
+        raise HTTPException(status_code=404, detail="Image not found.")
+    path, content_type, etag = found
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # Names are content hashes, so the bytes behind a URL never change
+        "Cache-Control": "public, max-age=31536000, immutable"
+    }
+    if_none_match = http_request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    
+    storage.touch(path)
+    size = os.path.getsize(path)
+    try:
+        byte_range = parse_range(http_request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    start, end = byte_range if byte_range else (0, size - 1)
+    
+    async def body():
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return StreamingResponse(body(), status_code=206, media_type=content_type, headers=headers)
+    return StreamingResponse(body(), media_type=content_type, headers=headers)
+
 @app.get("/test-image")
 async def test_image():
     return {
@@ -189,4 +971,7 @@ async def test_image():
 
 if __name__ == "__main__":
     import uvicorn
+    # Single process started by hand: unlock up front, prompting if no agent is running
+    if ensure_credentials is not None and STORAGE_BACKEND == "cloudinary":
+        ensure_credentials(interactive=True)
     uvicorn.run(app, host="0.0.0.0", port=7860) 
\ No newline at end of file
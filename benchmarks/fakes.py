@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for BUDDY's upstream services
+Fake Ollama, HF Space and Cloudinary servers with tunable latency, so the
+backend can be load tested offline.
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def make_ollama_app(tokens_per_sec=30.0, response_tokens=40, prompt_eval_ms=50.0):
+    """Mimics /api/generate: streamed NDJSON tokens at a fixed rate, or one JSON body; /api/tags for probes"""
+    app = FastAPI()
+    app.state.stats = {"requests": 0, "preloads": 0}
+
+    def final_chunk(body, prompt_eval_s, eval_s):
+        context = (body.get("context") or []) + list(range(response_tokens))
+        return {
+            "model": body.get("model"),
+            "done": True,
+            "context": context,
+            "prompt_eval_count": len(body.get("prompt", "").split()),
+            "prompt_eval_duration": int(prompt_eval_s * 1e9),
+            "eval_count": response_tokens,
+            "eval_duration": int(eval_s * 1e9)
+        }
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        if "prompt" not in body:
+            # keep_alive preload: no prompt means just load the model
+            app.state.stats["preloads"] += 1
+            return {"model": body.get("model"), "done": True}
+        app.state.stats["requests"] += 1
+        prompt_eval_s = prompt_eval_ms / 1000
+        token_interval = 1 / tokens_per_sec
+
+        if not body.get("stream", True):
+            await asyncio.sleep(prompt_eval_s + response_tokens * token_interval)
+            return {
+                **final_chunk(body, prompt_eval_s, response_tokens * token_interval),
+                "response": " ".join(["token"] * response_tokens)
+            }
+
+        async def tokens():
+            await asyncio.sleep(prompt_eval_s)
+            for _ in range(response_tokens):
+                await asyncio.sleep(token_interval)
+                yield json.dumps({"model": body.get("model"), "response": "token ", "done": False}) + "\n"
+            yield json.dumps(final_chunk(body, prompt_eval_s, response_tokens * token_interval)) + "\n"
+
+        return StreamingResponse(tokens(), media_type="application/x-ndjson")
+
+    @app.get("/api/tags")
+    async def tags():
+        # The backend's health probe
+        return {"models": []}
+
+    return app
+
+def make_space_app(latency_s=2.0, jitter_s=0.5, image_bytes=400 * 1024, workers=2):
+    """Mimics an SD Space: /generate returns image bytes after a delay, /health reports queue depth"""
+    app = FastAPI()
+    app.state.stats = {"requests": 0, "queued": 0}
+    slots = asyncio.Semaphore(workers)  # Like INFERENCE_WORKERS: extra requests wait their turn
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy", "batching": {"queue_depth": app.state.stats["queued"]}}
+
+    @app.post("/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        app.state.stats["requests"] += 1
+        app.state.stats["queued"] += 1
+        try:
+            async with slots:
+                app.state.stats["queued"] -= 1
+                await asyncio.sleep(max(0.0, latency_s + random.uniform(-jitter_s, jitter_s)))
+        except asyncio.CancelledError:
+            app.state.stats["queued"] -= 1
+            raise
+        # Random bytes behind a PNG signature: the size is what matters for the proxy path
+        content = PNG_SIGNATURE + os.urandom(max(0, image_bytes - len(PNG_SIGNATURE)))
+        return Response(content=content, media_type="image/png", headers={"X-Prompt-Chars": str(len(body.get("prompt", "")))})
+
+    return app
+
+def make_cloudinary_app(latency_s=0.2):
+    """Mimics the Cloudinary upload API the SDK posts to (point CLOUDINARY_UPLOAD_PREFIX here)"""
+    app = FastAPI()
+    app.state.stats = {"uploads": 0, "bytes": 0}
+
+    @app.post("/v1_1/{cloud_name}/image/upload")
+    async def upload(cloud_name: str, request: Request):
+        body = await request.body()
+        app.state.stats["uploads"] += 1
+        app.state.stats["bytes"] += len(body)
+        await asyncio.sleep(latency_s)
+        public_id = f"buddy-generated/{uuid.uuid4().hex}"
+        return JSONResponse({
+            "public_id": public_id,
+            "bytes": len(body),
+            "format": "png",
+            "secure_url": f"https://res.cloudinary.example/{cloud_name}/image/upload/{public_id}.png"
+        })
+
+    return app
+
+class ServerThread:
+    """Runs a FastAPI app under uvicorn in a background thread"""
+
+    def __init__(self, app, port, host="127.0.0.1"):
+        self.app = app
+        self.url = f"http://{host}:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout=10.0):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Fake server on {self.url} did not start")
+            time.sleep(0.05)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
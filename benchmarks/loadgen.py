@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Closed-loop load generator for the BUDDY backend
+Keeps a fixed number of requests in flight against one endpoint and
+summarizes throughput, latency percentiles and errors.
+"""
+
+import asyncio
+import math
+import time
+import uuid
+
+import httpx
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+def make_prompt(prompt_pool, worker, sequence):
+    """Unique prompts by default; a pool of N repeats them so coalescing and caching kick in"""
+    if prompt_pool:
+        return f"benchmark prompt {(worker * 7919 + sequence) % prompt_pool}"
+    return f"benchmark prompt {uuid.uuid4().hex}"
+
+async def chat(client, prompt):
+    response = await client.post("/chat", json={"prompt": prompt})
+    return response.status_code, None
+
+async def chat_stream(client, prompt):
+    """Time to first token is measured at the first NDJSON line"""
+    started = time.perf_counter()
+    first_token = None
+    async with client.stream("POST", "/chat", json={"prompt": prompt, "stream": True}) as response:
+        async for line in response.aiter_lines():
+            if line and first_token is None:
+                first_token = time.perf_counter() - started
+    return response.status_code, first_token
+
+async def generate(client, prompt):
+    response = await client.post("/generate", json={"prompt": prompt})
+    return response.status_code, None
+
+SCENARIOS = {"chat": chat, "chat_stream": chat_stream, "generate": generate}
+
+async def run_level(client, scenario, concurrency, duration, prompt_pool=0):
+    """Run one scenario at one concurrency level for duration seconds; returns raw samples"""
+    request = SCENARIOS[scenario]
+    samples = []  # (latency_s, status, time_to_first_token_s)
+    stop_at = time.monotonic() + duration
+
+    async def worker(index):
+        sequence = 0
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                status, first_token = await request(client, make_prompt(prompt_pool, index, sequence))
+            except httpx.HTTPError as e:
+                status, first_token = type(e).__name__, None
+            samples.append((time.perf_counter() - started, status, first_token))
+            sequence += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+def summarize(scenario, concurrency, samples, elapsed):
+    ok = sorted(latency for latency, status, _ in samples if status == 200)
+    first_tokens = sorted(first for _, status, first in samples if status == 200 and first is not None)
+    status_codes = {}
+    for _, status, _ in samples:
+        status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+    errors = len(samples) - len(ok)
+
+    def ms(values):
+        return {
+            "p50": round(percentile(values, 50) * 1000, 1) if values else None,
+            "p95": round(percentile(values, 95) * 1000, 1) if values else None,
+            "p99": round(percentile(values, 99) * 1000, 1) if values else None,
+            "mean": round(sum(values) / len(values) * 1000, 1) if values else None,
+            "max": round(values[-1] * 1000, 1) if values else None
+        }
+
+    summary = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        "elapsed_s": round(elapsed, 2),
+        "latency_ms": ms(ok),
+        "status_codes": status_codes
+    }
+    if first_tokens:
+        summary["time_to_first_token_ms"] = ms(first_tokens)
+    return summary
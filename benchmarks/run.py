@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+BUDDY Backend Benchmark
+Starts fake Ollama/HF Space/Cloudinary servers, runs app.py against them,
+drives /chat and /generate at several concurrency levels and writes the
+results as JSON.
+
+    python benchmarks/run.py --scenarios chat,generate --concurrency 1,8,32 --duration 10
+    python benchmarks/run.py --compare benchmarks/results/<earlier run>.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from fakes import ServerThread, make_cloudinary_app, make_ollama_app, make_space_app
+from loadgen import SCENARIOS, run_level, summarize
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT, text=True).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for the BUDDY backend")
+    parser.add_argument("--scenarios", default="chat,chat_stream,generate",
+                        help=f"comma-separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario and level")
+    parser.add_argument("--prompt-pool", type=int, default=0,
+                        help="reuse N prompts (exercises coalescing and caching); 0 makes every prompt unique")
+    parser.add_argument("--image-cache", action="store_true", help="leave the backend's image cache on")
+    parser.add_argument("--ollama-tokens-per-sec", type=float, default=30.0)
+    parser.add_argument("--ollama-tokens", type=int, default=40, help="tokens per chat response")
+    parser.add_argument("--ollama-prompt-eval-ms", type=float, default=50.0)
+    parser.add_argument("--space-latency", type=float, default=2.0, help="seconds per image")
+    parser.add_argument("--space-jitter", type=float, default=0.5)
+    parser.add_argument("--space-workers", type=int, default=2, help="images the fake Space renders at once")
+    parser.add_argument("--image-kb", type=int, default=400)
+    parser.add_argument("--cloudinary-latency", type=float, default=0.2)
+    parser.add_argument("--base-url", help="benchmark an already running backend instead of starting app.py")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to print a comparison against")
+    return parser.parse_args()
+
+def start_backend(args, fakes, log_file):
+    """Run app.py under uvicorn with every upstream pointed at the fakes"""
+    port = free_port()
+    env = {
+        **os.environ,
+        "SD_BACKENDS": f"primary={fakes['space'].url}",
+        "OLLAMA_URLS": fakes["ollama"].url,
+        "STORAGE_BACKEND": "cloudinary",
+        "CLOUDINARY_CLOUD_NAME": "benchmark",
+        "CLOUDINARY_API_KEY": "benchmark",
+        "CLOUDINARY_API_SECRET": "benchmark",
+        "CLOUDINARY_UPLOAD_PREFIX": fakes["cloudinary"].url,
+        "IMAGE_CACHE_ENABLED": "true" if args.image_cache else "false",
+        "IMAGE_CACHE_DIR": tempfile.mkdtemp(prefix="buddy-bench-cache-"),
+        "BACKEND_LOCK_FILE": os.path.join(tempfile.gettempdir(), f"buddy-bench-{port}.lock"),  # Runs beside a live backend
+        # Every simulated client comes from one IP, so per-client limits would only measure themselves
+        "IMAGE_RATE_PER_MIN": "0",
+        "CHAT_RATE_PER_MIN": "0",
+        "JOB_MAX_PER_CLIENT": "0",
+        "CHAT_MAX_PER_CLIENT": "0",
+        **{name: os.environ[name] for name in ("IMAGE_RATE_PER_MIN", "CHAT_RATE_PER_MIN") if name in os.environ}
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+        start_new_session=True  # No controlling terminal, so nothing can stop to prompt for input
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Backend exited with code {process.returncode}, see {log_file.name}")
+        try:
+            if httpx.get(f"{url}/health", timeout=1.0).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"Backend did not become healthy, see {log_file.name}")
+
+async def run_all(base_url, scenarios, levels, args):
+    results = []
+    limits = httpx.Limits(max_connections=max(levels) * 2, max_keepalive_connections=max(levels) * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=600.0, limits=limits) as client:
+        for scenario in scenarios:
+            for concurrency in levels:
+                samples, elapsed = await run_level(client, scenario, concurrency, args.duration, args.prompt_pool)
+                summary = summarize(scenario, concurrency, samples, elapsed)
+                latency = summary["latency_ms"]
+                print(
+                    f"{scenario:<12} c={concurrency:<4} {summary['throughput_rps']:>8.2f} req/s  "
+                    f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms  "
+                    f"errors={summary['error_rate']:.1%}"
+                )
+                results.append(summary)
+        health = (await client.get("/health")).json()
+    return results, health
+
+def compare(previous_path, results):
+    with open(previous_path) as f:
+        previous = {(row["scenario"], row["concurrency"]): row for row in json.load(f)["results"]}
+
+    def change(old, new):
+        if old in (None, 0) or new is None:
+            return "n/a"
+        return f"{(new - old) / old:+.1%}"
+
+    print(f"\nCompared with {previous_path}:")
+    for row in results:
+        old = previous.get((row["scenario"], row["concurrency"]))
+        if old is None:
+            continue
+        print(
+            f"{row['scenario']:<12} c={row['concurrency']:<4} "
+            f"throughput {change(old['throughput_rps'], row['throughput_rps'])}  "
+            f"p95 {change(old['latency_ms']['p95'], row['latency_ms']['p95'])}  "
+            f"errors {old['error_rate']:.1%} -> {row['error_rate']:.1%}"
+        )
+
+def main():
+    args = parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    fakes = {
+        "ollama": ServerThread(make_ollama_app(
+            args.ollama_tokens_per_sec, args.ollama_tokens, args.ollama_prompt_eval_ms
+        ), free_port()).start(),
+        "space": ServerThread(make_space_app(
+            args.space_latency, args.space_jitter, args.image_kb * 1024, args.space_workers
+        ), free_port()).start(),
+        "cloudinary": ServerThread(make_cloudinary_app(args.cloudinary_latency), free_port()).start()
+    }
+    backend = None
+    log_file = tempfile.NamedTemporaryFile("w", prefix="buddy-bench-backend-", suffix=".log", delete=False)
+    try:
+        base_url = args.base_url
+        if base_url is None:
+            backend, base_url = start_backend(args, fakes, log_file)
+            print(f"Backend running at {base_url} (log: {log_file.name})")
+        results, health = asyncio.run(run_all(base_url, scenarios, levels, args))
+    finally:
+        if backend is not None:
+            backend.terminate()
+            backend.wait(timeout=10)
+        for server in fakes.values():
+            server.stop()
+
+    commit, dirty = git_revision()
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": commit,
+            "dirty": dirty,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args)
+        },
+        "results": results,
+        "backend_health": health,
+        "fakes": {name: server.app.state.stats for name, server in fakes.items()}
+    }
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{commit or 'nogit'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nResults written to {output}")
+    if args.compare:
+        compare(args.compare, results)
+
+if __name__ == "__main__":
+    main()
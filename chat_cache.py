@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Chat Response Cache for BUDDY Backend
+Replays Ollama replies for repeated deterministic prompts (fixed temperature
+and seed), matched on normalized text and optionally on near-duplicates
+through MinHash fingerprints of character trigrams.
+"""
+
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+
+from image_cache import normalize_prompt
+
+MINHASH_BANDS = 8  # Prompts with trigram Jaccard 0.85 share a band with probability > 0.9999
+MINHASH_ROWS = 2
+_MERSENNE = (1 << 61) - 1
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE | 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE)
+    for i in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+# Words that flip an answer while barely changing the text; near-duplicates must agree on these exactly
+_NEGATIONS = {"no", "not", "never", "t", "dont", "cant", "wont", "isnt", "arent", "doesnt", "didnt", "without"}
+
+def normalize_chat_prompt(prompt):
+    """Case, whitespace and trailing punctuation don't change what is being asked"""
+    return normalize_prompt(prompt).rstrip(" ?!.")
+
+def is_deterministic(temperature, seed):
+    """Greedy decoding, or sampling from a fixed seed"""
+    return temperature is not None and (temperature == 0 or seed is not None)
+
+class Fingerprint:
+    """Character trigrams within words, their MinHash signature and the tokens that must match exactly"""
+
+    def __init__(self, text):
+        words = re.findall(r"\w+", text)
+        self.shingles = frozenset(
+            padded[i:i + 3] for padded in (f"<{word}>" for word in words) for i in range(len(padded) - 2)
+        )
+        # Numbers, operators and negations change the answer, so they are compared as-is
+        self.guard = tuple(sorted(
+            [word for word in words if word in _NEGATIONS or any(c.isdigit() for c in word)]
+            + re.findall(r"[-+*/^%=<>]", text)
+        ))
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in self.shingles]
+        signature = [min(((a * h + b) % _MERSENNE for h in hashes), default=0) for a, b in _PERMUTATIONS]
+        self.bands = [
+            tuple(signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]) for band in range(MINHASH_BANDS)
+        ]
+
+    def similarity(self, other):
+        if self.guard != other.guard:
+            return 0.0
+        union = self.shingles | other.shingles
+        return len(self.shingles & other.shingles) / len(union) if union else 1.0
+
+class CachedReply:
+    def __init__(self, key, scope, prompt, response, counters, fingerprint):
+        self.key = key
+        self.scope = scope  # model and options; near-duplicates only match within one scope
+        self.prompt = prompt
+        self.response = response
+        self.counters = counters  # Ollama's counters from the original generation
+        self.fingerprint = fingerprint
+        self.created = time.time()
+        self.hits = 0
+        self.near_hits = 0
+        self.last_hit = None
+
+    def to_dict(self):
+        return {
+            "prompt": self.prompt[:80],
+            "options": json.loads(self.scope),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "age_s": round(time.time() - self.created, 1),
+            "last_hit": self.last_hit
+        }
+
+class ChatResponseCache:
+    def __init__(self, max_entries=1000, ttl=24 * 3600, near_duplicates=False, min_similarity=0.85):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.near_duplicates = near_duplicates
+        self.min_similarity = min_similarity
+        self._entries = OrderedDict()  # key -> CachedReply, least recently used first
+        self._bands = {}  # (scope, band index, band values) -> set of keys
+        self.stats = {"hits": 0, "near_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "bypassed": 0}
+
+    @staticmethod
+    def scope(model, **options):
+        return json.dumps({"model": model, **options}, sort_keys=True)
+
+    @staticmethod
+    def make_key(scope, prompt):
+        return hashlib.sha256(f"{scope}\n{normalize_chat_prompt(prompt)}".encode()).hexdigest()
+
+    @staticmethod
+    def _band_keys(scope, fingerprint):
+        return [(scope, index, band) for index, band in enumerate(fingerprint.bands)]
+
+    def _drop(self, entry):
+        del self._entries[entry.key]
+        if entry.fingerprint is not None:
+            for band_key in self._band_keys(entry.scope, entry.fingerprint):
+                keys = self._bands.get(band_key)
+                if keys is not None:
+                    keys.discard(entry.key)
+                    if not keys:
+                        del self._bands[band_key]
+
+    def _live(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry.created > self.ttl:
+            self._drop(entry)
+            self.stats["expired"] += 1
+            return None
+        return entry
+
+    def _nearest(self, scope, fingerprint):
+        """Most similar cached prompt at or above min_similarity; only entries sharing a band are compared"""
+        best, best_similarity = None, self.min_similarity
+        candidates = set()
+        for band_key in self._band_keys(scope, fingerprint):
+            candidates |= self._bands.get(band_key, set())
+        for key in candidates:
+            entry = self._live(key)
+            if entry is None:
+                continue
+            similarity = fingerprint.similarity(entry.fingerprint)
+            if similarity >= best_similarity:
+                best, best_similarity = entry, similarity
+        return best
+
+    def get(self, scope, prompt):
+        """Cached reply for prompt within scope, or None on a miss"""
+        key = self.make_key(scope, prompt)
+        entry = self._live(key)
+        if entry is not None:
+            entry.hits += 1
+            self.stats["hits"] += 1
+        elif self.near_duplicates:
+            entry = self._nearest(scope, Fingerprint(normalize_chat_prompt(prompt)))
+            if entry is not None:
+                entry.near_hits += 1
+                self.stats["near_hits"] += 1
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        entry.last_hit = time.time()
+        self._entries.move_to_end(entry.key)
+        return entry
+
+    def bypass(self):
+        """Count a request that skipped the lookup (Cache-Control: no-cache or no-store)"""
+        self.stats["bypassed"] += 1
+
+    def put(self, scope, prompt, response, final_chunk):
+        key = self.make_key(scope, prompt)
+        existing = self._entries.get(key)
+        if existing is not None:
+            self._drop(existing)
+        normalized = normalize_chat_prompt(prompt)
+        fingerprint = Fingerprint(normalized) if self.near_duplicates else None
+        counters = {name: final_chunk[name] for name in ("eval_count", "eval_duration") if name in final_chunk}
+        entry = CachedReply(key, scope, normalized, response, counters, fingerprint)
+        self._entries[key] = entry
+        if fingerprint is not None:
+            for band_key in self._band_keys(scope, fingerprint):
+                self._bands.setdefault(band_key, set()).add(key)
+        self.stats["stores"] += 1
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries.values())))
+            self.stats["evictions"] += 1
+
+    def info(self, top=10):
+        lookups = self.stats["hits"] + self.stats["near_hits"] + self.stats["misses"]
+        hits = self.stats["hits"] + self.stats["near_hits"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "near_duplicates": self.near_duplicates,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "top_entries": [
+                entry.to_dict() for entry in
+                sorted(self._entries.values(), key=lambda e: -(e.hits + e.near_hits))[:top]
+            ]
+        }
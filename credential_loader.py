@@ -2,87 +2,293 @@
 """
 Credential Loader for BUDDY Backend
 Loads encrypted credentials and sets them as environment variables.
+
+The master password is only needed once per host. `agent` (or `run -- <command>`)
+derives the key once and hands the decrypted data key to backend workers over
+a Unix socket only this user can reach, so workers start without a prompt:
+
+    python credential_loader.py agent                 # unlock once, keep serving the key
+    python credential_loader.py run -- uvicorn app:app --host 0.0.0.0
 """
 
 import os
+import sys
 import json
+import stat
 import base64
-from cryptography.fernet import Fernet
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+import time
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import getpass
 
-def load_encrypted_credentials():
-    """Load encrypted credentials and set as environment variables"""
-    key_file = ".buddy_key"
-    cred_file = ".buddy_creds"
-    
-    if not os.path.exists(key_file) or not os.path.exists(cred_file):
+KEY_FILE = ".buddy_key"
+CRED_FILE = ".buddy_creds"
+KEY_FD_ENV = "BUDDY_KEY_FD"  # A launcher may hand the data key over on an inherited pipe instead
+SOCKET_ENV = "BUDDY_KEY_SOCKET"
+REQUIRED_VARS = ["CLOUDINARY_CLOUD_NAME", "CLOUDINARY_API_KEY", "CLOUDINARY_API_SECRET"]
+
+_lock = threading.Lock()
+_loaded = False
+
+def socket_path():
+    """Agent socket, inside a per-user directory"""
+    if os.getenv(SOCKET_ENV):
+        return os.getenv(SOCKET_ENV)
+    base = os.getenv("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(base, f"buddy-{os.getuid()}", "key.sock")
+
+def unlock_with_password(password=None):
+    """The slow path: prompt, run PBKDF2 and decrypt the stored data key"""
+    with open(KEY_FILE, 'rb') as f:
+        data = f.read()
+        salt = data[:16]
+        encrypted_key = data[16:]
+
+    if password is None:
+        print("💡 Password hint: your apple id pass")
+        password = getpass.getpass("Enter master password for credentials: ")
+
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=100000,
+    )
+    key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
+    return Fernet(key).decrypt(encrypted_key)
+
+def read_key_fd():
+    """Data key from the pipe named in BUDDY_KEY_FD; read once, then closed"""
+    fd = os.environ.pop(KEY_FD_ENV, None)  # Popped so child processes don't reuse a closed fd
+    if fd is None:
+        return None
+    try:
+        with os.fdopen(int(fd), 'rb') as f:
+            return f.read().strip() or None
+    except (OSError, ValueError) as e:
+        print(f"⚠️  Could not read credential key from fd {fd}: {e}")
+        return None
+
+def fetch_key_from_agent(path=None, timeout=2.0):
+    """Data key from a running agent, or None if there is none"""
+    path = path or socket_path()
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+        print(f"⚠️  Ignoring {path}: not a socket owned by this user")
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            chunks = []
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return b"".join(chunks).strip() or None
+    except OSError:
+        return None
+
+def agent_running(path=None):
+    """Whether an agent socket owned by this user is in place; unlike fetch_key_from_agent, fetches nothing"""
+    try:
+        info = os.stat(path or socket_path())
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+def decrypt_credentials(data_key):
+    with open(CRED_FILE, 'rb') as f:
+        encrypted_data = f.read()
+    return json.loads(Fernet(data_key).decrypt(encrypted_data).decode())
+
+def load_encrypted_credentials(interactive=True):
+    """Load encrypted credentials and set as environment variables.
+
+    The data key comes from BUDDY_KEY_FD or a running agent; only when neither
+    has it, and interactive is set with a terminal attached, is the password prompted for.
+    """
+    if not os.path.exists(KEY_FILE) or not os.path.exists(CRED_FILE):
         print("⚠️  No encrypted credentials found.")
         print("Run 'python secure_credentials.py' to set up credentials.")
         return False
-    
+
     try:
-        # Load the encryption key
-        with open(key_file, 'rb') as f:
-            data = f.read()
-            salt = data[:16]
-            encrypted_key = data[16:]
-        
-        # Get password from user
-        print("💡 Password hint: your apple id pass")
-        password = getpass.getpass("Enter master password for credentials: ")
-        
-        # Generate key from password
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        
-        # Decrypt the stored key
-        temp_fernet = Fernet(key)
-        stored_key = temp_fernet.decrypt(encrypted_key)
-        fernet = Fernet(stored_key)
-        
-        # Load and decrypt credentials
-        with open(cred_file, 'rb') as f:
-            encrypted_data = f.read()
-        
-        decrypted_data = fernet.decrypt(encrypted_data)
-        credentials = json.loads(decrypted_data.decode())
-        
+        data_key = read_key_fd() or fetch_key_from_agent()
+        if data_key is None and interactive and sys.stdin.isatty():
+            data_key = unlock_with_password()
+        if data_key is None:
+            print("⚠️  Credentials are locked. Start 'python credential_loader.py agent' once per host,")
+            print("   or launch with 'python credential_loader.py run -- <command>'.")
+            return False
+
         # Set environment variables
-        for key, value in credentials.items():
+        for key, value in decrypt_credentials(data_key).items():
             os.environ[key] = value
-        
+
         print("✅ Credentials loaded successfully!")
         return True
-        
+
     except Exception as e:
         print(f"❌ Error loading credentials: {e}")
         return False
 
+def ensure_credentials(interactive=False):
+    """Load credentials once per process, on first use. Safe to call from several threads."""
+    global _loaded
+    with _lock:
+        if not _loaded:
+            # Plain environment variables (e.g. Space secrets) need no unlocking
+            _loaded = all(os.getenv(var) for var in REQUIRED_VARS) or load_encrypted_credentials(interactive)
+        return _loaded
+
+def credential_status():
+    """Whether credentials are loaded, and whether a first use could load them without a prompt"""
+    loaded = all(os.getenv(var) for var in REQUIRED_VARS)
+    encrypted = os.path.exists(KEY_FILE) and os.path.exists(CRED_FILE)
+    unlockable = encrypted and (KEY_FD_ENV in os.environ or agent_running())
+    return {"loaded": loaded, "available": loaded or unlockable, "encrypted_file": encrypted}
+
 def check_credentials():
     """Check if credentials are available"""
-    required_vars = [
-        "CLOUDINARY_CLOUD_NAME",
-        "CLOUDINARY_API_KEY", 
-        "CLOUDINARY_API_SECRET"
-    ]
-    
-    missing = [var for var in required_vars if not os.getenv(var)]
-    
+    missing = [var for var in REQUIRED_VARS if not os.getenv(var)]
+
     if missing:
         print(f"⚠️  Missing environment variables: {', '.join(missing)}")
         return False
-    
+
     return True
 
-if __name__ == "__main__":
+def _peer_uid(conn):
+    """uid of the connecting process where the OS reports it (Linux)"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None  # Elsewhere the 0700 directory and 0600 socket are the gate
+    _, uid, _ = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid
+
+def bind_agent_socket(path):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{directory} must belong to you and be closed to other users (chmod 700)")
+    if os.path.exists(path):
+        if fetch_key_from_agent(path) is not None:
+            raise RuntimeError(f"An agent is already serving {path}")
+        os.unlink(path)  # Left over from an agent that did not shut down cleanly
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    previous_umask = os.umask(0o177)  # Socket is created 0600
+    try:
+        server.bind(path)
+    finally:
+        os.umask(previous_umask)
+    server.listen(16)
+    return server
+
+def serve_key(server, data_key, stop):
+    """Answer every connection from this user with the data key until stop is set"""
+    server.settimeout(0.5)
+    served = 0
+    while not stop.is_set():
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        except OSError:
+            break
+        with conn:
+            uid = _peer_uid(conn)
+            if uid is not None and uid != os.getuid():
+                print(f"⚠️  Refused credential request from uid {uid}")
+                continue
+            conn.sendall(data_key + b"\n")
+            served += 1
+    return served
+
+def start_agent(path):
+    """Unlock once and serve the key from a background thread; returns (stop, thread)"""
+    try:
+        data_key = unlock_with_password()
+        decrypt_credentials(data_key)  # Fail now on a wrong password, not in every worker
+    except InvalidToken:
+        raise SystemExit("❌ Wrong master password.")
+    try:
+        server = bind_agent_socket(path)
+    except (OSError, RuntimeError) as e:
+        raise SystemExit(f"❌ {e}")
+    stop = threading.Event()
+
+    def run():
+        try:
+            serve_key(server, data_key, stop)
+        finally:
+            server.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    print(f"🔓 Credential agent listening on {path}")
+    return stop, thread
+
+def main():
+    parser = argparse.ArgumentParser(description="Unlock BUDDY's encrypted credentials")
+    sub = parser.add_subparsers(dest="mode")
+    agent = sub.add_parser("agent", help="unlock once and serve the key to backend workers")
+    agent.add_argument("--ttl", type=float, default=0, help="exit after this many seconds (0 runs until Ctrl-C)")
+    run = sub.add_parser("run", help="serve the key only while a command runs, e.g. run -- uvicorn app:app")
+    run.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    path = socket_path()
+
+    if args.mode == "agent":
+        stop, thread = start_agent(path)
+        try:
+            thread.join(args.ttl or None)
+        except KeyboardInterrupt:
+            pass
+        stop.set()
+        thread.join()
+        return 0
+
+    if args.mode == "run":
+        command = args.command[1:] if args.command[:1] == ["--"] else args.command
+        if not command:
+            parser.error("run needs a command")
+        stop = thread = None
+        if fetch_key_from_agent(path) is None:
+            stop, thread = start_agent(path)
+        try:
+            process = subprocess.Popen(command, env={**os.environ, SOCKET_ENV: path})
+            while True:
+                try:
+                    return process.wait()
+                except KeyboardInterrupt:
+                    pass  # The command got the same Ctrl-C; let it shut down cleanly
+        finally:
+            if stop is not None:
+                stop.set()
+                thread.join()
+
+    started = time.perf_counter()
     if load_encrypted_credentials():
-        print("Credentials loaded and environment variables set.")
-    else:
-        print("Failed to load credentials.") 
\ No newline at end of file
+        print(f"Credentials loaded and environment variables set ({time.perf_counter() - started:.2f}s).")
+        return 0
+    print("Failed to load credentials.")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,24 +1,61 @@
 # Hugging Face Space FastAPI App
 # This file should be uploaded to your Hugging Face Space
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional
 from pydantic import BaseModel
-from diffusers import StableDiffusionPipeline
+from diffusers import (
+    StableDiffusionPipeline,
+    AutoencoderTiny,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    LCMScheduler
+)
 import torch
-from PIL import Image
+from PIL import Image, ImageFilter
 import io
+import os
+import resource
+import time
+import asyncio
+import contextvars
+import random
+import multiprocessing
+import threading
+import base64
+import json
+import uuid
+import zipfile
 
-app = FastAPI(title="BUDDY-SD CPU Generator", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app):
+    """Bind the port right away and load the model in the background"""
+    loader = asyncio.create_task(load_in_background())
+    yield
+    loader.cancel()
+    scheduler.shutdown()
 
-# Load model once at startup
+app = FastAPI(title="BUDDY-SD CPU Generator", version="1.0.0", lifespan=lifespan)
+
+# Keep downloaded weights on persistent storage (/data on Spaces) so restarts skip the download
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR") or ("/data/hf_cache" if os.path.isdir("/data") else None)
+
+# Load model (called from the background loader)
 def load_model():
     """Load Stable Diffusion model"""
     try:
         pipe = StableDiffusionPipeline.from_pretrained(
             "CompVis/stable-diffusion-v1-4",
             torch_dtype=torch.float32,  # Use float32 for CPU
-            use_safetensors=True,
-            safety_checker=None  # Disable safety checker for speed
+            use_safetensors=True,  # memory-mapped, zero-copy weight loading
+            cache_dir=MODEL_CACHE_DIR,
+            safety_checker=None,  # Disable safety checker for speed
+            low_cpu_mem_usage=True  # Load weights straight from the safetensors files
         )
         print("✅ Model loaded successfully!")
         return pipe
@@ -26,11 +63,996 @@ def load_model():
         print(f"❌ Error loading model: {e}")
         return None
 
-# Load the model
-pipe = load_model()
+# Filled in by the background loader once the server is up
+pipe = None
+
+# Optional LCM LoRA for few-step drafts, e.g. latent-consistency/lcm-lora-sdv1-5
+LCM_LORA = os.getenv("LCM_LORA")
+
+def build_schedulers(pipe):
+    """Build the fast schedulers once from the pipeline config so requests can swap them in"""
+    if pipe is None:
+        return {}
+    config = pipe.scheduler.config
+    schedulers = {
+        "default": pipe.scheduler,
+        "dpm++": DPMSolverMultistepScheduler.from_config(
+            config, algorithm_type="dpmsolver++", use_karras_sigmas=True
+        ),
+        "euler_a": EulerAncestralDiscreteScheduler.from_config(config)
+    }
+    if LCM_LORA:
+        try:
+            # LoRA layers stay loaded; non-LCM requests run them at scale 0
+            pipe.load_lora_weights(LCM_LORA)
+            schedulers["lcm"] = LCMScheduler.from_config(config)
+            print(f"✅ LCM LoRA loaded: {LCM_LORA}")
+        except Exception as e:
+            print(f"⚠️  Could not load LCM LoRA {LCM_LORA}: {e}")
+    return schedulers
+
+SCHEDULERS = build_schedulers(pipe)
+
+def build_tiers(schedulers):
+    """Speed/quality tiers; explicit steps/scheduler/guidance in a request override the preset"""
+    return {
+        "draft": (
+            {"steps": 4, "scheduler": "lcm", "guidance_scale": 1.0}
+            if "lcm" in schedulers
+            else {"steps": 8, "scheduler": "dpm++", "guidance_scale": 7.5}
+        ),
+        "standard": {"steps": 20, "scheduler": "dpm++", "guidance_scale": 7.5},
+        "quality": {"steps": 50, "scheduler": "default", "guidance_scale": 7.5}
+    }
+
+TIERS = build_tiers(SCHEDULERS)
+DEFAULT_TIER = os.getenv("DEFAULT_TIER", "quality")  # 50-step renders with the default scheduler, as before
 
 class PromptRequest(BaseModel):
     prompt: str
+    tier: Optional[str] = None  # draft, standard or quality
+    steps: Optional[int] = None
+    scheduler: Optional[str] = None  # default, dpm++, euler_a or lcm
+    guidance_scale: Optional[float] = None
+    width: int = 512
+    height: int = 512
+    seed: Optional[int] = None
+    format: Optional[str] = None  # png, webp, jpeg or avif; otherwise negotiated from Accept
+    quality: Optional[int] = None  # lossy formats only
+    num_images: int = 1  # variations of the same prompt, generated as one batch
+    seeds: Optional[List[int]] = None  # one per image; otherwise counted up from seed
+    bundle: Optional[str] = None  # multipart (default) or zip when num_images > 1
+    upscale: Optional[int] = None  # fast large mode: render width x height, then upscale 2x or 4x
+
+# >>> shared: output encoding (copies must match, see tests/test_shared_code.py)
+# Output encoding: format comes from the request or the Accept header, encoded off the event loop
+try:
+    import pillow_avif  # noqa: F401  registers the AVIF plugin when installed
+except ImportError:
+    pass
+
+IMAGE_FORMATS = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+if "AVIF" in Image.registered_extensions().values():
+    IMAGE_FORMATS["avif"] = "image/avif"
+DEFAULT_QUALITY = {"webp": 85, "jpeg": 90, "avif": 60}
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))  # zlib level; 1 is far faster than Pillow's 6
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def negotiate_format(requested, accept):
+    """Pick the output format: explicit request field first, then the Accept header, else PNG"""
+    if requested:
+        fmt = "jpeg" if requested.lower() == "jpg" else requested.lower()
+        if fmt not in IMAGE_FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported format '{requested}'. Use one of: {', '.join(IMAGE_FORMATS)}"
+            )
+        return fmt
+    ranges = []
+    for position, part in enumerate((accept or "").split(",")):
+        media_type, _, options = part.strip().partition(";")
+        q = 1.0
+        for option in options.split(";"):
+            name, _, value = option.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges.append((-q, position, media_type.strip().lower()))
+    for neg_q, _, media_type in sorted(ranges):
+        if neg_q >= 0:
+            break
+        for fmt, format_type in IMAGE_FORMATS.items():
+            if media_type == format_type:
+                return fmt
+        if media_type in ("image/*", "*/*"):
+            return "png"
+    return "png"
+
+def encode_image(image, fmt, quality=None):
+    """Blocking encode into a BytesIO buffer"""
+    quality = quality or DEFAULT_QUALITY.get(fmt)
+    buffer = io.BytesIO()
+    if fmt == "png":
+        image.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    elif fmt == "webp":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    elif fmt == "jpeg":
+        image.save(buffer, format="JPEG", quality=quality)
+    else:
+        image.save(buffer, format="AVIF", quality=quality, speed=8)
+    return buffer
+
+async def image_response(image, fmt, quality=None, headers=None):
+    """Encode in a worker thread and stream straight from the encoder's buffer"""
+    with span("image_encode"):
+        buffer = await asyncio.to_thread(encode_image, image, fmt, quality)
+    return buffer_response(buffer, IMAGE_FORMATS[fmt], headers)
+
+def buffer_response(buffer, media_type, headers=None):
+    """Stream a BytesIO in chunks without copying it into one bytes object first"""
+    view = buffer.getbuffer()
+    size = len(view)
+
+    async def body():
+        try:
+            for start in range(0, size, STREAM_CHUNK_SIZE):
+                yield bytes(view[start:start + STREAM_CHUNK_SIZE])
+        finally:
+            view.release()
+
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        headers={**(headers or {}), "Content-Length": str(size)}
+    )
+
+# Output size: native generation up to MAX_OUTPUT_PIXELS, bigger images by upscaling a base render
+MAX_OUTPUT_PIXELS = int(os.getenv("MAX_OUTPUT_PIXELS", str(768 * 768)))
+MAX_UPSCALED_PIXELS = int(os.getenv("MAX_UPSCALED_PIXELS", str(2048 * 2048)))
+VAE_TILING_PIXELS = int(os.getenv("VAE_TILING_PIXELS", str(512 * 512)))  # decode in tiles above this
+UPSCALE_FACTORS = (2, 4)
+
+def check_size(width, height, upscale=None):
+    """Reject sizes the UNet cannot take or that would blow the memory ceiling"""
+    if width % 8 or height % 8:
+        raise HTTPException(status_code=400, detail="width and height must be multiples of 8")
+    if width * height > MAX_OUTPUT_PIXELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{width}x{height} is over the {MAX_OUTPUT_PIXELS} pixel limit, generate smaller and set upscale"
+        )
+    if upscale is not None:
+        if upscale not in UPSCALE_FACTORS:
+            raise HTTPException(status_code=400, detail=f"upscale must be one of: {', '.join(map(str, UPSCALE_FACTORS))}")
+        if width * height * upscale ** 2 > MAX_UPSCALED_PIXELS:
+            raise HTTPException(status_code=400, detail=f"Upscaled output is over the {MAX_UPSCALED_PIXELS} pixel limit")
+
+def upscale_image(image, factor):
+    """Cheap CPU upscale: Lanczos resize plus a light unsharp mask to restore edges"""
+    large = image.resize((image.width * factor, image.height * factor), Image.LANCZOS)
+    return large.filter(ImageFilter.UnsharpMask(radius=2, percent=60, threshold=2))
+# <<< shared: output encoding
+
+def configure_vae(pipeline, height, width, batch_size):
+    """Tile the VAE decode for large outputs and decode big batches one image at a time"""
+    if height * width > VAE_TILING_PIXELS:
+        pipeline.enable_vae_tiling()
+        if batch_size > 1:
+            pipeline.enable_vae_slicing()
+    else:
+        pipeline.disable_vae_tiling()
+        if batch_size > 1:
+            pipeline.disable_vae_slicing()
+
+# >>> shared: worker telemetry (copies must match, see tests/test_shared_code.py)
+# Peak memory per batch, measured inside the worker and reported per request and in /health
+MEMORY_STATS = {"last_peak_rss_mb": None, "max_peak_rss_mb": 0.0, "max_peak_rss_mb_by_size": {}}
+
+def reset_peak_rss():
+    """Start a fresh peak-RSS window for this process (Linux; otherwise the lifetime peak is reported)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def record_peak_rss(width, height, peak):
+    size = f"{width}x{height}"
+    by_size = MEMORY_STATS["max_peak_rss_mb_by_size"]
+    by_size[size] = max(by_size.get(size, 0.0), peak)
+    MEMORY_STATS["last_peak_rss_mb"] = peak
+    MEMORY_STATS["max_peak_rss_mb"] = max(MEMORY_STATS["max_peak_rss_mb"], peak)
+
+# Timing spans and Prometheus metrics; the backend's X-Request-ID is echoed and logged so traces join up
+REQUEST_ID_HEADER = "X-Request-ID"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+REQUEST_ID = contextvars.ContextVar("request_id", default=None)
+TRACE = contextvars.ContextVar("trace", default=None)  # stage -> seconds for the current request
+
+# >>> shared: metric types (copies must match, see tests/test_shared_code.py)
+def _escape(value):
+    # The text format needs backslash, double quote and newline escaped inside label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                labels = _labels(self.labelnames + ("le",), key + (str(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class CallbackMetric:
+    """Gauge or counter read at scrape time from existing stats.
+
+    fn() returns a number, or a dict of label value tuple -> number.
+    """
+
+    def __init__(self, name, documentation, fn, labelnames=(), kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.fn()
+        except Exception:
+            return []  # e.g. state not set up yet; skip rather than break the scrape
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {float(value)}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def callback(self, *args, **kwargs):
+        metric = CallbackMetric(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+# <<< shared: metric types
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram("buddy_sd_stage_duration_seconds", "Time spent in each request stage", ("stage",))
+UNET_STEP_SECONDS = REGISTRY.histogram(
+    "buddy_sd_unet_step_seconds", "Wall time of one denoising step for the whole batch", ("size",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "buddy_sd_request_duration_seconds", "HTTP request latency by endpoint", ("method", "endpoint", "status")
+)
+
+def record(stage, seconds):
+    """Observe a stage duration and add it to the current request's trace"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = TRACE.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0.0) + seconds
+
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+class StepTimer:
+    """Pipeline step callback that times each denoising step, then chains to another callback"""
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.started = self.last = time.perf_counter()
+        self.steps = []
+
+    def __call__(self, pipeline, step, timestep, callback_kwargs):
+        self.steps.append(time.perf_counter() - self.last)
+        if self.inner is not None:
+            callback_kwargs = self.inner(pipeline, step, timestep, callback_kwargs)
+        self.last = time.perf_counter()  # Preview decoding is not UNet time
+        return callback_kwargs
+
+WORKER_STAGES = ("text_encode", "unet", "vae_decode")
+
+def record_batch_stats(results):
+    """Stage timings and peak RSS measured inside the worker, recorded once per batch"""
+    # Every image in a batch shares one stats dict
+    image, stats = results[0][0], results[0][-1]
+    width, height = image.size
+    record_peak_rss(width, height, stats["peak_rss_mb"])
+    for stage in WORKER_STAGES:
+        STAGE_SECONDS.observe(stats[f"{stage}_s"], stage=stage)
+    for seconds in stats["unet_steps_s"]:
+        UNET_STEP_SECONDS.observe(seconds, size=f"{width}x{height}")
+
+def trace_worker_stats(stats):
+    """Add the batch's worker stages to the current request's trace; the metrics have them once per batch"""
+    trace = TRACE.get()
+    if trace is not None:
+        for stage in WORKER_STAGES:
+            trace[stage] = trace.get(stage, 0.0) + stats[f"{stage}_s"]
+
+class RequestContextMiddleware:
+    """Request ids, Server-Timing, the latency histogram and one JSON timing line per request.
+
+    Plain ASGI rather than BaseHTTPMiddleware so streamed bodies are untouched.
+    """
+
+    def __init__(self, app, skip_paths=("/metrics", "/health", "/live", "/ready")):
+        self.app = app
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope["headers"]).get(REQUEST_ID_HEADER.lower().encode(), b"").decode("latin-1")
+        request_id = incoming[:128] or uuid.uuid4().hex
+        REQUEST_ID.set(request_id)
+        trace = {}
+        TRACE.set(trace)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((REQUEST_ID_HEADER.encode(), request_id.encode("latin-1")))
+                if trace:
+                    timing = ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in trace.items())
+                    headers.append((b"server-timing", timing.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            elapsed = time.perf_counter() - started
+            endpoint = scope.get("endpoint")
+            endpoint = endpoint.__name__ if endpoint is not None else "unmatched"
+            REQUEST_SECONDS.observe(elapsed, method=scope["method"], endpoint=endpoint, status=status["code"])
+            if scope["path"] not in self.skip_paths:
+                print("⏱️  " + json.dumps({
+                    "request_id": request_id,
+                    "path": scope["path"],
+                    "status": status["code"],
+                    "total_ms": round(elapsed * 1000, 1),
+                    "spans_ms": {stage: round(seconds * 1000, 1) for stage, seconds in trace.items()}
+                }))
+# <<< shared: worker telemetry
+
+app.add_middleware(RequestContextMiddleware)
+
+# Several images per request come back as one multipart/mixed body or a zip archive
+MAX_IMAGES_PER_REQUEST = int(os.getenv("MAX_IMAGES_PER_REQUEST", "4"))
+BUNDLE_TYPES = ("multipart", "zip")
+
+def resolve_seeds(request):
+    """One seed per image: explicit seeds, else counting up from seed, else random"""
+    if not 1 <= request.num_images <= MAX_IMAGES_PER_REQUEST:
+        raise HTTPException(
+            status_code=400,
+            detail=f"num_images must be between 1 and {MAX_IMAGES_PER_REQUEST}"
+        )
+    if request.seeds is not None:
+        if len(request.seeds) != request.num_images:
+            raise HTTPException(status_code=400, detail="seeds must have one entry per image")
+        return request.seeds
+    if request.seed is not None:
+        return [request.seed + index for index in range(request.num_images)]
+    if request.num_images == 1:
+        return [None]
+    # Pick random seeds here rather than in the worker so they can be reported back
+    return [random.randrange(2**32) for _ in range(request.num_images)]
+
+def resolve_bundle(requested, accept):
+    bundle = requested or ("zip" if "application/zip" in (accept or "") else "multipart")
+    if bundle not in BUNDLE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported bundle '{requested}'. Use one of: {', '.join(BUNDLE_TYPES)}")
+    return bundle
+
+def encode_bundle(images, seeds, fmt, quality, bundle):
+    """Blocking encode of several images into one body; returns (buffer, media type)"""
+    ext = "jpg" if fmt == "jpeg" else fmt
+    encoded = [encode_image(image, fmt, quality).getvalue() for image in images]
+    buffer = io.BytesIO()
+    if bundle == "zip":
+        # Stored, not deflated: the images are already compressed
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+            for index, (data, seed) in enumerate(zip(encoded, seeds)):
+                archive.writestr(f"image-{index}-seed-{seed}.{ext}", data)
+        return buffer, "application/zip"
+    boundary = uuid.uuid4().hex
+    for index, (data, seed) in enumerate(zip(encoded, seeds)):
+        buffer.write((
+            f"--{boundary}\r\n"
+            f"Content-Type: {IMAGE_FORMATS[fmt]}\r\n"
+            f"Content-Disposition: attachment; filename=\"image-{index}.{ext}\"\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"X-Seed: {seed}\r\n\r\n"
+        ).encode())
+        buffer.write(data)
+        buffer.write(b"\r\n")
+    buffer.write(f"--{boundary}--\r\n".encode())
+    return buffer, f"multipart/mixed; boundary={boundary}"
+
+async def bundle_response(images, seeds, fmt, quality, bundle, headers=None):
+    with span("image_encode"):
+        buffer, media_type = await asyncio.to_thread(encode_bundle, images, seeds, fmt, quality, bundle)
+    return buffer_response(buffer, media_type, {**(headers or {}), "X-Seeds": ",".join(str(seed) for seed in seeds)})
+
+# >>> shared: batching (copies must match, see tests/test_shared_code.py)
+# Micro-batching: requests that share steps/size/guidance are run as one pipe() call
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", "200"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))
+
+# Inference runs in forked worker processes that share the loaded weights copy-on-write
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "16"))
+
+class QueueFullError(Exception):
+    """Raised when too many requests are already waiting for inference"""
+    def __init__(self, retry_after):
+        super().__init__(f"Inference queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+def init_worker(threads):
+    """Split the CPU cores between inference worker processes"""
+    torch.set_num_threads(threads)
+
+class BatchScheduler:
+    """Collects compatible requests for a short window and runs them as one batch"""
+
+    def __init__(self, run_batch, max_batch_size=4, window_ms=200, workers=1, max_queue=16, on_batch=None,
+                 threads_per_worker=None):
+        self.run_batch = run_batch  # blocking fn(params, prompts, seeds, tags) -> one result per prompt
+        self.on_batch = on_batch  # fn(results), called once per finished batch
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker  # None splits the cores evenly between workers
+        self.max_queue = max_queue
+        self._pending = {}  # params -> list of (prompt, seed, future, enqueued_at, tag, context)
+        self._wakeup = asyncio.Event()
+        self._executor = None
+        self._slots = None
+        self._task = None
+        self._pool_ready = asyncio.Event()  # Cleared while a crashed worker pool is rebuilt
+        self._warm_params = None
+        self.recovering = False
+        self.rebuild_retry_s = 5  # Pause between attempts to bring up a replacement pool
+        self.stats = {
+            "batches": 0,
+            "images": 0,
+            "batch_sizes": {},
+            "queue_wait_total_s": 0.0,
+            "queue_wait_max_s": 0.0,
+            "batch_time_total_s": 0.0,
+            "rejected": 0,
+            "pool_rebuilds": 0
+        }
+
+    def _make_executor(self):
+        # Fork only after load_model() so workers inherit the weights instead of reloading them
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_worker,
+            initargs=(self.threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers),)
+        )
+
+    def start(self):
+        self._executor = self._make_executor()
+        self._pool_ready.set()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._task = asyncio.create_task(self._loop())
+
+    def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def retry_after(self):
+        """Rough seconds until the current backlog drains"""
+        batches = self.stats["batches"]
+        avg_batch_s = self.stats["batch_time_total_s"] / batches if batches else 60.0
+        backlog_batches = self.queue_depth() / (self.max_batch_size * self.workers)
+        return max(1, int(avg_batch_s * (backlog_batches + 1)))
+
+    def enqueue(self, prompt, seed, params, tag=None):
+        """Queue one prompt and return a future for its image (raises QueueFullError at once)"""
+        return self.enqueue_many(prompt, [seed], params, tag)[0]
+
+    def enqueue_many(self, prompt, seeds, params, tag=None):
+        """Queue one image per seed side by side so they land in the same batch; all or nothing"""
+        if self.queue_depth() + len(seeds) > self.max_queue:
+            self.stats["rejected"] += 1
+            raise QueueFullError(self.retry_after())
+        loop = asyncio.get_running_loop()
+        enqueued_at = time.perf_counter()
+        # The caller's context goes with the first image so its queue wait lands in the caller's trace once
+        context = contextvars.copy_context()
+        futures = []
+        for index, seed in enumerate(seeds):
+            future = loop.create_future()
+            self._pending.setdefault(params, []).append(
+                (prompt, seed, future, enqueued_at, tag, context if index == 0 else None)
+            )
+            futures.append(future)
+        self._wakeup.set()
+        return futures
+
+    async def submit(self, prompt, seed, params, tag=None):
+        """Queue one prompt and wait for its image"""
+        return await self.enqueue(prompt, seed, params, tag)
+
+    def queue_depth(self):
+        return sum(len(items) for items in self._pending.values())
+
+    def _oldest_params(self):
+        return min(self._pending, key=lambda params: self._pending[params][0][3])
+
+    async def _loop(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Wait for a free worker process; requests keep piling into the batch meanwhile
+            await self._slots.acquire()
+            await self._pool_ready.wait()
+
+            # Give compatible requests until the window closes to join the oldest one's batch
+            params = self._oldest_params()
+            deadline = self._pending[params][0][3] + self.window
+            while len(self._pending[params]) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            items = self._pending[params][:self.max_batch_size]
+            rest = self._pending[params][self.max_batch_size:]
+            if rest:
+                self._pending[params] = rest
+            else:
+                del self._pending[params]
+
+            # Skip callers that went away while queued
+            items = [item for item in items if not item[2].done()]
+            if not items:
+                self._slots.release()
+                continue
+
+            started = time.perf_counter()
+            for _, _, _, enqueued_at, _, context in items:
+                wait = started - enqueued_at
+                if context is not None:
+                    context.run(record, "queue_wait", wait)
+                self.stats["queue_wait_total_s"] += wait
+                self.stats["queue_wait_max_s"] = max(self.stats["queue_wait_max_s"], wait)
+            size = len(items)
+            self.stats["batches"] += 1
+            self.stats["images"] += size
+            self.stats["batch_sizes"][size] = self.stats["batch_sizes"].get(size, 0) + 1
+            print(f"Running batch of {size} with params {params}")
+            asyncio.create_task(self._run(params, items))
+
+    async def _run(self, params, items):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        executor = self._executor
+        try:
+            images = await loop.run_in_executor(
+                executor,
+                self.run_batch,
+                params,
+                [item[0] for item in items],
+                [item[1] for item in items],
+                [item[4] for item in items]
+            )
+            for (_, _, future, _, _, _), image in zip(items, images):
+                if not future.done():
+                    future.set_result(image)
+            if self.on_batch is not None:
+                self.on_batch(images)
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed for memory); the executor is unusable until replaced
+            for _, _, future, _, _, _ in items:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Inference worker crashed: {e}"))
+            if executor is self._executor and not self.recovering:
+                self.recovering = True
+                self._pool_ready.clear()
+                asyncio.create_task(self._rebuild(executor))
+        except Exception as e:
+            for _, _, future, _, _, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.stats["batch_time_total_s"] += time.perf_counter() - started
+            self._slots.release()
+
+    async def _rebuild(self, broken):
+        """Replace a broken worker pool and warm it up again; batches wait until it is done"""
+        print("❌ Inference worker pool broke; rebuilding it")
+        self.stats["pool_rebuilds"] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+        while True:
+            try:
+                self._executor = self._make_executor()
+                if self._warm_params is not None:
+                    await self.warm_up(self._warm_params)
+                break
+            except Exception as e:
+                # Whatever went wrong, keep trying: giving up would leave every batch waiting forever
+                print(f"❌ Rebuilt worker pool failed to warm up ({e!r}); retrying")
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                await asyncio.sleep(self.rebuild_retry_s)
+        self.recovering = False
+        self._pool_ready.set()
+        print("✅ Inference worker pool rebuilt")
+
+    async def warm_up(self, params):
+        """Run one tiny generation in every worker so the first real request is not slow"""
+        self._warm_params = params  # Reused when the pool has to be rebuilt
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self._executor, self.run_batch, params, ["warm-up"], [0], [None])
+            for _ in range(self.workers)
+        ])
+
+    def info(self):
+        images = self.stats["images"]
+        return {
+            "batches": self.stats["batches"],
+            "images": images,
+            "batch_sizes": self.stats["batch_sizes"],
+            "avg_batch_size": round(images / self.stats["batches"], 2) if self.stats["batches"] else 0.0,
+            "avg_queue_wait_s": round(self.stats["queue_wait_total_s"] / images, 3) if images else 0.0,
+            "max_queue_wait_s": round(self.stats["queue_wait_max_s"], 3),
+            "avg_batch_time_s": round(self.stats["batch_time_total_s"] / self.stats["batches"], 2) if self.stats["batches"] else 0.0,
+            "queue_depth": self.queue_depth(),
+            "max_queue": self.max_queue,
+            "rejected": self.stats["rejected"],
+            "workers": self.workers,
+            "pool_rebuilds": self.stats["pool_rebuilds"],
+            "recovering": self.recovering,
+            "max_batch_size": self.max_batch_size,
+            "window_ms": int(self.window * 1000)
+        }
+# <<< shared: batching
+
+# Live previews: workers decode intermediate latents with a tiny approximate decoder
+PREVIEW_EVERY = int(os.getenv("PREVIEW_EVERY", "5"))  # steps between preview images
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "256"))
+PREVIEW_DECODER = os.getenv("PREVIEW_DECODER", "taesd")  # taesd or linear
+TAESD_MODEL = os.getenv("TAESD_MODEL", "madebyollin/taesd")
+
+# Approximate SD 1.x latent -> RGB projection, used when TAESD is unavailable
+LATENT_RGB_FACTORS = torch.tensor([
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473]
+])
+
+# Created before the workers fork so they inherit it; carries progress back to the server
+PREVIEW_QUEUE = multiprocessing.get_context("fork").Queue()
+PREVIEW_SUBSCRIBERS = {}  # tag -> asyncio.Queue of progress events
+PREVIEW_STATS = {"previews": 0, "decode_time_total_s": 0.0, "generation_time_total_s": 0.0}
+preview_decoder = None
+
+def load_preview_decoder():
+    if PREVIEW_DECODER != "taesd":
+        return None
+    try:
+        decoder = AutoencoderTiny.from_pretrained(
+            TAESD_MODEL, torch_dtype=torch.float32, cache_dir=MODEL_CACHE_DIR
+        )
+        print(f"✅ Preview decoder loaded: {TAESD_MODEL}")
+        return decoder
+    except Exception as e:
+        print(f"⚠️  Could not load TAESD ({e}), using linear latent previews")
+        return None
+
+@torch.no_grad()
+def decode_preview(latents):
+    """Cheap low-resolution RGB preview of one latent (4 x h x w), as JPEG bytes"""
+    if preview_decoder is not None:
+        # Halve the latent first; TAESD then outputs at half the final resolution
+        small = torch.nn.functional.interpolate(latents[None], scale_factor=0.5, mode="bilinear")
+        rgb = preview_decoder.decode(small).sample[0]
+    else:
+        rgb = torch.einsum("chw,cr->rhw", latents, LATENT_RGB_FACTORS)
+    rgb = ((rgb.clamp(-1, 1) + 1) * 127.5).byte().permute(1, 2, 0).numpy()
+    image = Image.fromarray(rgb)
+    image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=60)
+    return buffer.getvalue()
+
+def make_progress_callback(tags, total_steps):
+    """Per-step pipeline callback that reports progress and periodic previews for tagged requests"""
+    started = time.perf_counter()
+
+    def callback(pipeline, step, timestep, callback_kwargs):
+        done = step + 1
+        elapsed = time.perf_counter() - started
+        eta = elapsed / done * (total_steps - done)
+        want_preview = PREVIEW_EVERY > 0 and done % PREVIEW_EVERY == 0 and done < total_steps
+        latents = callback_kwargs["latents"]
+        for index, tag in enumerate(tags):
+            if tag is None:
+                continue
+            preview, decode_s = None, 0.0
+            if want_preview:
+                decode_started = time.perf_counter()
+                preview = decode_preview(latents[index])
+                decode_s = time.perf_counter() - decode_started
+            PREVIEW_QUEUE.put((tag, done, total_steps, round(eta, 1), preview, decode_s))
+        return callback_kwargs
+
+    return callback
+
+def dispatch_previews(loop):
+    """Reader thread: forward worker progress messages to the waiting SSE streams"""
+    while True:
+        tag, done, total, eta, preview, decode_s = PREVIEW_QUEUE.get()
+        if preview is not None:
+            PREVIEW_STATS["previews"] += 1
+            PREVIEW_STATS["decode_time_total_s"] += decode_s
+        queue = PREVIEW_SUBSCRIBERS.get(tag)
+        if queue is not None:
+            event = {"step": done, "total_steps": total, "eta_s": eta, "preview": None}
+            if preview is not None:
+                event["preview"] = "data:image/jpeg;base64," + base64.b64encode(preview).decode()
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+# Prompt embedding cache: each worker keeps the CLIP encodings of recent prompts
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "256"))  # prompts per worker, 0 disables
+# Created before the workers fork like PREVIEW_QUEUE; workers count, /health reads
+EMBED_STATS = multiprocessing.get_context("fork").Array("q", 3)  # hits, misses, evictions
+EMBED_CACHE = OrderedDict()  # (normalized prompt, lora scale) -> embedding, private to each worker
+
+def normalize_prompt(prompt):
+    """CLIP's tokenizer lowercases and collapses whitespace, so these variants encode identically"""
+    return " ".join(prompt.lower().split())
+
+def count_embed(index):
+    with EMBED_STATS.get_lock():
+        EMBED_STATS[index] += 1
+
+@torch.no_grad()
+def prompt_embedding(prompt, lora_scale):
+    """Text encoder output for one prompt, from the worker's LRU when possible"""
+    key = (normalize_prompt(prompt), lora_scale)
+    embedding = EMBED_CACHE.get(key)
+    if embedding is not None:
+        EMBED_CACHE.move_to_end(key)
+        count_embed(0)
+        return embedding
+    count_embed(1)
+    embedding, _ = pipe.encode_prompt(
+        key[0], "cpu", num_images_per_prompt=1, do_classifier_free_guidance=False, lora_scale=lora_scale
+    )
+    if EMBED_CACHE_SIZE > 0:
+        EMBED_CACHE[key] = embedding
+        while len(EMBED_CACHE) > EMBED_CACHE_SIZE:
+            EMBED_CACHE.popitem(last=False)
+            count_embed(2)
+    return embedding
+
+def encode_batch(prompts, lora_scale):
+    """(prompt_embeds, negative_prompt_embeds) for a batch; the empty negative prompt is cached too"""
+    prompt_embeds = torch.cat([prompt_embedding(prompt, lora_scale) for prompt in prompts])
+    negative_prompt_embeds = prompt_embedding("", lora_scale).expand(len(prompts), -1, -1)
+    return prompt_embeds, negative_prompt_embeds
+
+def embed_cache_info():
+    hits, misses, evictions = EMBED_STATS[:]
+    return {
+        "hits": hits,
+        "misses": misses,
+        "evictions": evictions,
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+        "size_per_worker": EMBED_CACHE_SIZE
+    }
+
+def run_batch(params, prompts, seeds, tags):
+    """Blocking batched pipeline call, run inside a worker process.
+
+    Returns one (image, stats) pair per prompt, where stats holds the batch's
+    peak RSS in MB and its text encode, UNet and VAE decode timings.
+    """
+    steps, guidance_scale, height, width, scheduler_name = params
+    reset_peak_rss()
+    # Each worker process owns its pipe, so swapping the scheduler and VAE mode here is safe
+    pipe.scheduler = SCHEDULERS[scheduler_name]
+    configure_vae(pipe, height, width, len(prompts))
+    extra = {}
+    lora_scale = None
+    if "lcm" in SCHEDULERS:
+        lora_scale = 1.0 if scheduler_name == "lcm" else 0.0
+        extra["cross_attention_kwargs"] = {"scale": lora_scale}
+    # Repeated prompts (and variations of one prompt) skip the text encoder
+    encode_started = time.perf_counter()
+    prompt_embeds, negative_prompt_embeds = encode_batch(prompts, lora_scale)
+    text_encode_s = time.perf_counter() - encode_started
+    # Per-request seeds stay reproducible inside a batch
+    generators = [
+        torch.Generator("cpu").manual_seed(seed if seed is not None else random.randrange(2**32))
+        for seed in seeds
+    ]
+    progress = make_progress_callback(tags, steps) if any(tag is not None for tag in tags) else None
+    timer = StepTimer(progress)
+    images = pipe(
+        prompt_embeds=prompt_embeds,
+        negative_prompt_embeds=negative_prompt_embeds,
+        num_inference_steps=steps,
+        guidance_scale=guidance_scale,
+        height=height,
+        width=width,
+        generator=generators,
+        callback_on_step_end=timer,
+        callback_on_step_end_tensor_inputs=["latents"],
+        **extra
+    ).images
+    # After the last step callback the pipeline only decodes and converts to PIL
+    stats = {
+        "peak_rss_mb": peak_rss_mb(),
+        "text_encode_s": text_encode_s,
+        "unet_s": timer.last - timer.started,
+        "unet_steps_s": timer.steps,
+        "vae_decode_s": time.perf_counter() - timer.last
+    }
+    return [(image, stats) for image in images]
+
+scheduler = BatchScheduler(
+    run_batch,
+    max_batch_size=MAX_BATCH_SIZE,
+    window_ms=BATCH_WINDOW_MS,
+    workers=INFERENCE_WORKERS,
+    max_queue=MAX_QUEUE_SIZE,
+    on_batch=record_batch_stats
+)
+
+# Startup state reported by /ready
+WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "2"))  # 0 disables the warm-up generation
+LOAD_STATE = {
+    "status": "loading",
+    "stage": "starting",
+    "progress": 0.0,
+    "started_at": None,
+    "ready_at": None,
+    "load_seconds": None,
+    "warmup_seconds": None,
+    "error": None
+}
+
+def set_stage(stage, progress):
+    LOAD_STATE["stage"] = stage
+    LOAD_STATE["progress"] = progress
+    print(f"⏳ Startup: {stage} ({int(progress * 100)}%)")
+
+def initialize_model():
+    """Blocking part of startup: load weights and build everything that depends on them"""
+    global pipe, SCHEDULERS, TIERS, preview_decoder
+    set_stage("loading_weights", 0.1)
+    loaded = load_model()
+    if loaded is None:
+        raise RuntimeError("Model failed to load")
+    set_stage("building_schedulers", 0.6)
+    SCHEDULERS = build_schedulers(loaded)
+    TIERS = build_tiers(SCHEDULERS)
+    set_stage("loading_preview_decoder", 0.7)
+    preview_decoder = load_preview_decoder()
+    pipe = loaded
+
+async def load_in_background():
+    LOAD_STATE["started_at"] = time.time()
+    started = time.perf_counter()
+    try:
+        await asyncio.to_thread(initialize_model)
+        LOAD_STATE["load_seconds"] = round(time.perf_counter() - started, 1)
+        # Fork the inference workers only now, so they inherit the loaded weights
+        scheduler.start()
+        threading.Thread(
+            target=dispatch_previews, args=(asyncio.get_running_loop(),), daemon=True
+        ).start()
+        if WARMUP_STEPS > 0:
+            set_stage("warming_up", 0.8)
+            warmup_started = time.perf_counter()
+            preset = TIERS[DEFAULT_TIER]
+            await scheduler.warm_up(
+                (WARMUP_STEPS, preset["guidance_scale"], 512, 512, preset["scheduler"])
+            )
+            LOAD_STATE["warmup_seconds"] = round(time.perf_counter() - warmup_started, 1)
+        set_stage("ready", 1.0)
+        LOAD_STATE["status"] = "ready"
+        LOAD_STATE["ready_at"] = time.time()
+        print("✅ Model ready!")
+    except Exception as e:
+        print(f"❌ Startup failed: {e}")
+        LOAD_STATE["status"] = "failed"
+        LOAD_STATE["error"] = str(e)
+
+def load_state():
+    state = dict(LOAD_STATE)
+    if state["status"] == "ready" and scheduler.recovering:
+        # Not ready again until the crashed worker pool is rebuilt and warmed up
+        state["status"] = "recovering"
+        state["stage"] = "rebuilding_workers"
+    if state["started_at"] is not None:
+        state["elapsed_seconds"] = round((state["ready_at"] or time.time()) - state["started_at"], 1)
+    return state
 
 @app.get("/")
 async def root():
@@ -41,53 +1063,229 @@ async def root():
         "model": "Stable Diffusion v1.4",
         "endpoints": {
             "generate": "/generate (POST)",
-            "health": "/health (GET)"
+            "generate_stream": "/generate/stream (POST, SSE progress + previews)",
+            "health": "/health (GET)",
+            "metrics": "/metrics (GET, Prometheus text format)",
+            "live": "/live (GET)",
+            "ready": "/ready (GET)"
         }
     }
 
+@app.get("/live")
+async def live():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "alive"}
+
+@app.get("/ready")
+async def ready():
+    """Readiness: weights loaded and warm-up done; 503 with progress until then"""
+    state = load_state()
+    return JSONResponse(status_code=200 if state["status"] == "ready" else 503, content=state)
+
 @app.get("/health")
 async def health_check():
+    state = load_state()
     return {
-        "status": "healthy",
+        "status": "healthy" if state["status"] == "ready" else state["status"],
         "model_loaded": pipe is not None,
-        "hardware": "CPU"
+        "startup": state,
+        "hardware": "CPU",
+        "tiers": TIERS,
+        "default_tier": DEFAULT_TIER,
+        "schedulers": list(SCHEDULERS),
+        "batching": scheduler.info(),
+        "embedding_cache": embed_cache_info(),
+        "memory": {**MEMORY_STATS, "max_output_pixels": MAX_OUTPUT_PIXELS, "max_upscaled_pixels": MAX_UPSCALED_PIXELS},
+        "previews": preview_info()
     }
 
-@app.post("/generate")
-async def generate_image(request: PromptRequest):
-    """Generate image and return as raw bytes"""
-    if pipe is None:
+REGISTRY.callback("buddy_sd_ready", "1 once the model is loaded and warmed up", lambda: int(load_state()["status"] == "ready"))
+REGISTRY.callback("buddy_sd_queue_depth", "Images waiting for a batch", lambda: scheduler.queue_depth())
+REGISTRY.callback("buddy_sd_batches_total", "Batches run", lambda: scheduler.stats["batches"], kind="counter")
+REGISTRY.callback("buddy_sd_images_total", "Images generated", lambda: scheduler.stats["images"], kind="counter")
+REGISTRY.callback("buddy_sd_rejected_total", "Requests turned away by a full queue", lambda: scheduler.stats["rejected"], kind="counter")
+REGISTRY.callback(
+    "buddy_sd_embedding_cache_lookups_total", "Prompt embedding cache lookups by outcome",
+    lambda: {("hit",): EMBED_STATS[0], ("miss",): EMBED_STATS[1]}, ("outcome",), kind="counter"
+)
+REGISTRY.callback("buddy_sd_max_peak_rss_mb", "Highest worker peak RSS seen for a batch", lambda: MEMORY_STATS["max_peak_rss_mb"])
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of stage timings, queue and cache counters"""
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# >>> shared: request settings (copies must match, see tests/test_shared_code.py)
+MAX_STEPS = int(os.getenv("MAX_STEPS", "100"))  # caps how long one request can hold a worker
+MAX_GUIDANCE_SCALE = float(os.getenv("MAX_GUIDANCE_SCALE", "20"))
+
+def check_settings(steps, guidance_scale):
+    if not 1 <= steps <= MAX_STEPS:
+        raise HTTPException(status_code=400, detail=f"steps must be between 1 and {MAX_STEPS}")
+    if not 0 <= guidance_scale <= MAX_GUIDANCE_SCALE:
+        raise HTTPException(status_code=400, detail=f"guidance_scale must be between 0 and {MAX_GUIDANCE_SCALE}")
+
+def resolve_settings(request):
+    """Turn tier plus explicit overrides into (steps, guidance_scale, scheduler)"""
+    tier = request.tier or DEFAULT_TIER
+    if tier not in TIERS:
+        raise HTTPException(status_code=400, detail=f"Unknown tier '{tier}'. Use one of: {', '.join(TIERS)}")
+    preset = TIERS[tier]
+    scheduler_name = request.scheduler or preset["scheduler"]
+    if scheduler_name not in SCHEDULERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Scheduler '{scheduler_name}' is not available. Use one of: {', '.join(SCHEDULERS)}"
+        )
+    steps = request.steps if request.steps is not None else preset["steps"]
+    guidance_scale = request.guidance_scale if request.guidance_scale is not None else preset["guidance_scale"]
+    check_settings(steps, guidance_scale)
+    return steps, guidance_scale, scheduler_name
+
+def check_ready():
+    state = load_state()
+    if state["status"] == "failed":
         raise HTTPException(
             status_code=500,
             detail="Model not loaded. Please check the logs."
         )
+    if state["status"] == "recovering":
+        raise HTTPException(
+            status_code=503,
+            detail="An inference worker crashed and is being restarted. Please retry shortly.",
+            headers={"Retry-After": "30"}
+        )
+    if state["status"] != "ready":
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model is still loading ({state['stage']}). Please retry shortly.",
+            headers={"Retry-After": "30"}
+        )
+# <<< shared: request settings
+
+def preview_info():
+    generation_s = PREVIEW_STATS["generation_time_total_s"]
+    return {
+        "decoder": "taesd" if preview_decoder is not None else "linear",
+        "every_n_steps": PREVIEW_EVERY,
+        "previews": PREVIEW_STATS["previews"],
+        "avg_decode_ms": round(PREVIEW_STATS["decode_time_total_s"] / PREVIEW_STATS["previews"] * 1000, 1) if PREVIEW_STATS["previews"] else 0.0,
+        # Share of streamed generation time spent decoding previews
+        "overhead_pct": round(PREVIEW_STATS["decode_time_total_s"] / generation_s * 100, 2) if generation_s else 0.0
+    }
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/generate/stream")
+async def generate_image_stream(request: PromptRequest):
+    """Generate an image, streaming step progress, ETA and low-res previews as server-sent events"""
+    check_ready()
+    fmt = negotiate_format(request.format, None)
+    seeds = resolve_seeds(request)
+    if len(seeds) > 1:
+        raise HTTPException(status_code=400, detail="Streaming supports one image per request, use /generate for num_images > 1")
+    check_size(request.width, request.height, request.upscale)
+    steps, guidance_scale, scheduler_name = resolve_settings(request)
+    params = (steps, guidance_scale, request.height, request.width, scheduler_name)
+    tag = uuid.uuid4().hex
+    events = asyncio.Queue()
+    PREVIEW_SUBSCRIBERS[tag] = events
+    try:
+        future = scheduler.enqueue(request.prompt, seeds[0], params, tag)
+    except QueueFullError as e:
+        del PREVIEW_SUBSCRIBERS[tag]
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    print(f"Generating image with previews for prompt: {request.prompt}")
+
+    async def stream():
+        try:
+            yield sse("queued", {"queue_depth": scheduler.queue_depth()})
+            while not future.done():
+                next_event = asyncio.ensure_future(events.get())
+                await asyncio.wait({future, next_event}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event.done():
+                    yield sse("progress", next_event.result())
+                else:
+                    next_event.cancel()
+            try:
+                image, stats = future.result()
+            except Exception as e:
+                print(f"❌ Generation error: {e}")
+                yield sse("error", {"detail": f"Image generation failed: {str(e)}"})
+                return
+            # The worker's own timing, so queue wait does not dilute the preview overhead
+            PREVIEW_STATS["generation_time_total_s"] += stats["text_encode_s"] + stats["unet_s"] + stats["vae_decode_s"]
+            trace_worker_stats(stats)
+            if request.upscale:
+                with span("upscale"):
+                    image = await asyncio.to_thread(upscale_image, image, request.upscale)
+            with span("image_encode"):
+                buffer = await asyncio.to_thread(encode_image, image, fmt, request.quality)
+            yield sse("image", {
+                "image": f"data:{IMAGE_FORMATS[fmt]};base64," + base64.b64encode(buffer.getbuffer()).decode(),
+                "steps": steps,
+                "peak_rss_mb": stats["peak_rss_mb"]
+            })
+            print(f"✅ Image generated successfully for: {request.prompt}")
+        finally:
+            PREVIEW_SUBSCRIBERS.pop(tag, None)
+            if not future.done():
+                future.cancel()  # drops the request if its batch has not started yet
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/generate")
+async def generate_image(request: PromptRequest, http_request: Request):
+    """Generate image and return as raw bytes"""
+    check_ready()
     
     try:
         print(f"Generating image for prompt: {request.prompt}")
         
-        # Generate image
-        image = pipe(
-            request.prompt,
-            num_inference_steps=50,  # Standard steps for CPU
-            guidance_scale=7.5,
-            height=512,
-            width=512
-        ).images[0]
+        fmt = negotiate_format(request.format, http_request.headers.get("accept"))
+        
+        seeds = resolve_seeds(request)
+        check_size(request.width, request.height, request.upscale)
         
-        # Convert to bytes for API response
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
+        # Queue for the next batch of requests that share steps, size, guidance and scheduler
+        steps, guidance_scale, scheduler_name = resolve_settings(request)
+        params = (steps, guidance_scale, request.height, request.width, scheduler_name)
+        if len(seeds) > 1:
+            bundle = resolve_bundle(request.bundle, http_request.headers.get("accept"))
+            results = await asyncio.gather(*scheduler.enqueue_many(request.prompt, seeds, params))
+            images = [image for image, _ in results]
+            # Images from one batch share a stats dict; count each batch once
+            for stats in {id(stats): stats for _, stats in results}.values():
+                trace_worker_stats(stats)
+            peak = max(stats["peak_rss_mb"] for _, stats in results)
+            if request.upscale:
+                with span("upscale"):
+                    images = await asyncio.gather(*[
+                        asyncio.to_thread(upscale_image, image, request.upscale) for image in images
+                    ])
+            print(f"✅ {len(images)} images generated successfully for: {request.prompt}")
+            return await bundle_response(images, seeds, fmt, request.quality, bundle, {"X-Peak-RSS-MB": str(peak)})
+        image, stats = await scheduler.submit(request.prompt, seeds[0], params)
+        trace_worker_stats(stats)
+        if request.upscale:
+            with span("upscale"):
+                image = await asyncio.to_thread(upscale_image, image, request.upscale)
         
         print(f"✅ Image generated successfully for: {request.prompt}")
         
         # Return raw image bytes (not JSON)
-        from fastapi.responses import Response
-        return Response(
-            content=img_byte_arr,
-            media_type="image/png"
-        )
+        return await image_response(image, fmt, request.quality, {"X-Peak-RSS-MB": str(stats["peak_rss_mb"])})
         
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        print(f"⚠️  {e}")
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
         print(f"❌ Generation error: {e}")
         raise HTTPException(
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Image Result Cache for BUDDY Backend
+Content-addressed cache of generated image URLs with an in-memory LRU
+in front of a persistent SQLite index.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+def normalize_prompt(prompt):
+    """Normalize prompt text so trivially different prompts share a cache key"""
+    return " ".join(prompt.lower().split())
+
+def make_cache_key(prompt, model, **params):
+    """Build a content-addressed key from everything that affects the image"""
+    params = {**params, "prompt": normalize_prompt(prompt), "model": model}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+class ImageResultCache:
+    def __init__(self, cache_dir, memory_entries=256, disk_entries=10000, ttl=7 * 24 * 3600):
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()  # key -> (url, created)
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "image_cache.sqlite3")
+        # check_same_thread=False: disk access happens in worker threads
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self._db.commit()
+
+    def _remember(self, key, url, created):
+        """Insert into the memory tier, evicting the least recently used entry"""
+        self._memory[key] = (url, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            url, created = row
+            if now - created > self.ttl:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute(
+                "UPDATE results SET accessed = ?, hits = hits + 1 WHERE key = ?", (now, key)
+            )
+            self._db.commit()
+            return url, created
+
+    def _disk_put(self, key, url, created):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, url, created, accessed, hits) VALUES (?, ?, ?, ?, 0)",
+                (key, url, created, created)
+            )
+            # TTL eviction, then size-based eviction of the least recently accessed rows
+            expired = self._db.execute(
+                "DELETE FROM results WHERE created < ?", (created - self.ttl,)
+            ).rowcount
+            overflow = self._db.execute(
+                """DELETE FROM results WHERE key IN (
+                    SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.disk_entries,)
+            ).rowcount
+            self._db.commit()
+        self.stats["evictions"] += max(expired, 0) + max(overflow, 0)
+
+    async def get(self, key):
+        """Return the cached URL for key, or None on a miss"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            url, created = entry
+            if time.time() - created <= self.ttl:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return url
+            del self._memory[key]
+
+        entry = await asyncio.to_thread(self._disk_get, key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        url, created = entry
+        self._remember(key, url, created)
+        self.stats["disk_hits"] += 1
+        return url
+
+    async def put(self, key, url):
+        """Store a generated image URL in both tiers"""
+        created = time.time()
+        self._remember(key, url, created)
+        await asyncio.to_thread(self._disk_put, key, url, created)
+        self.stats["stores"] += 1
+
+    def info(self):
+        """Cache counters and sizes for health reporting"""
+        with self._lock:
+            disk_size = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        return {
+            **self.stats,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": disk_size
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Background Job Manager for BUDDY Backend
+Runs long image generations on a bounded worker pool so clients can
+submit, poll and subscribe instead of holding a connection open.
+"""
+
+import asyncio
+import contextvars
+import math
+import time
+import uuid
+
+from admission import FairQueue
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+DETACHED = "detached"  # cancel() outcome when other requesters keep the job alive
+
+class QueueFullError(Exception):
+    """Raised when the job queue cannot accept more work"""
+    def __init__(self, detail, retry_after=None):
+        super().__init__(detail)
+        self.retry_after = retry_after
+
+class JobFailed(Exception):
+    """Raised by a job runner to fail a job with an HTTP status code"""
+    def __init__(self, status_code, detail, retry_after=None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+class Job:
+    def __init__(self, kind, payload, client="", key=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.client = client
+        self.key = key  # Identical submissions attach to this job instead of queueing another
+        self.holders = {client}  # Clients waiting on the result; the job is cancelled once none are left
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.retry_after = None  # Seconds to wait before resubmitting a job that failed on an overloaded backend
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.queue_position = None
+        self.task = None
+        self.cancel_requested = False
+        self.done = asyncio.Event()
+        self._subscribers = set()
+        # The runner sees the submitter's context vars (request id, timing trace)
+        self.context = contextvars.copy_context()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "queue_position": self.queue_position,
+            "requesters": len(self.holders),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+            "retry_after": self.retry_after
+        }
+
+    def subscribe(self):
+        """Return a queue that receives a snapshot on every state change"""
+        queue = asyncio.Queue()
+        queue.put_nowait(self.to_dict())
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def publish(self):
+        snapshot = self.to_dict()
+        for queue in self._subscribers:
+            queue.put_nowait(snapshot)
+
+class JobManager:
+    def __init__(self, runner, workers=2, max_queue=100, ttl=3600, shed_depth=None, max_queued_per_client=None):
+        """runner(job) is awaited by a worker and returns the job result.
+
+        Queued jobs are served fairly across clients rather than first come,
+        first served. Past shed_depth only priority jobs are accepted.
+        """
+        self.runner = runner
+        self.workers = workers
+        self.max_queue = max_queue
+        self.shed_depth = shed_depth if shed_depth is not None else max_queue
+        self.max_queued_per_client = max_queued_per_client
+        self.ttl = ttl
+        self.jobs = {}
+        self._keyed = {}  # key -> unfinished job
+        self._queue = FairQueue()
+        self._ready = asyncio.Semaphore(0)  # One permit per queued job
+        self._tasks = []
+        self._stopping = False
+        self._duration_ewma = None  # Seconds per job, for Retry-After
+        self.stats = {
+            "submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "rejected": 0, "expired": 0,
+            "priority": 0, "attached": 0, "detached": 0
+        }
+
+    async def start(self):
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweeper()))
+
+    async def stop(self):
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, kind, payload, client="", cost=1.0, weight=1.0, priority=False, key=None):
+        """Queue a new job, raising QueueFullError when it has to be shed.
+
+        cost is the job's expected work relative to a typical job, weight the
+        client's share of the workers; priority jobs skip ahead of the normal lane.
+        A job submitted with a key can be found (and attached to) with find(key) until it finishes.
+        """
+        depth = len(self._queue)
+        if depth >= self.max_queue or (not priority and depth >= self.shed_depth):
+            self.stats["rejected"] += 1
+            raise QueueFullError(f"Job queue is full ({depth} waiting)", self.retry_after())
+        if self.max_queued_per_client and self._queue.depth(client) >= self.max_queued_per_client:
+            self.stats["rejected"] += 1
+            raise QueueFullError(
+                f"Too many queued jobs for this client ({self.max_queued_per_client} waiting)", self.retry_after()
+            )
+        job = Job(kind, payload, client, key)
+        self.jobs[job.id] = job
+        if key is not None:
+            self._keyed[key] = job
+        self._queue.push(job, client, cost, weight, priority)
+        self._update_positions()
+        self._ready.release()
+        self.stats["submitted"] += 1
+        if priority:
+            self.stats["priority"] += 1
+        return job
+
+    def complete(self, kind, payload, result):
+        """Record a job that finished without queueing (e.g. served from cache)"""
+        job = Job(kind, payload)
+        self.jobs[job.id] = job
+        job.started_at = job.created_at
+        self.stats["submitted"] += 1
+        self._finish(job, SUCCEEDED, result=result)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def find(self, key):
+        """The unfinished job submitted with key, or None"""
+        return self._keyed.get(key)
+
+    def attach(self, job, client=""):
+        """Add a requester to an unfinished job so cancelling is left to the last one"""
+        job.holders.add(client)
+        self.stats["attached"] += 1
+        job.publish()
+
+    def cancel(self, job_id, client=None):
+        """Cancel a queued or running job for client.
+
+        Returns CANCELLED, or DETACHED when other requesters still wait on the
+        job and only client was removed from it; None if it already finished.
+        With client=None the job is cancelled for everyone.
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.status in FINISHED_STATES:
+            return None
+        if client is not None:
+            if client not in job.holders:
+                raise PermissionError("Job belongs to another client")
+            if len(job.holders) > 1:
+                job.holders.discard(client)
+                self.stats["detached"] += 1
+                job.publish()
+                return DETACHED
+        if job.status == QUEUED:
+            self._queue.remove(job)
+            self._update_positions()
+            self._finish(job, CANCELLED)
+        elif job.task is not None:
+            job.cancel_requested = True
+            job.task.cancel()
+        return CANCELLED
+
+    def retry_after(self):
+        """Seconds until a newly shed job would likely be accepted"""
+        duration = self._duration_ewma if self._duration_ewma is not None else 60.0
+        return max(1, math.ceil(duration * (len(self._queue) / self.workers + 1)))
+
+    def _update_positions(self):
+        # Fair ordering can put a new job ahead of ones already waiting
+        for position, job in enumerate(self._queue.ordered(), start=1):
+            if job.queue_position != position:
+                job.queue_position = position
+                job.publish()
+
+    def _finish(self, job, status, result=None, error=None, status_code=None, retry_after=None):
+        if job.key is not None and self._keyed.get(job.key) is job:
+            del self._keyed[job.key]
+        job.status = status
+        job.result = result
+        job.error = error
+        job.status_code = status_code
+        job.retry_after = retry_after
+        job.queue_position = None
+        job.finished_at = time.time()
+        self.stats[status] += 1
+        job.publish()
+        job.done.set()
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            job = self._queue.pop()
+            if job is None or job.status != QUEUED:
+                continue  # cancelled while waiting
+            self._update_positions()
+
+            job.status = RUNNING
+            job.queue_position = None
+            job.started_at = time.time()
+            job.publish()
+
+            job.task = job.context.run(asyncio.create_task, self.runner(job))
+            try:
+                result = await job.task
+                self._finish(job, SUCCEEDED, result=result)
+            except asyncio.CancelledError:
+                if not job.cancel_requested or self._stopping:
+                    raise  # the worker itself is shutting down
+                self._finish(job, CANCELLED)
+            except JobFailed as e:
+                self._finish(job, FAILED, error=e.detail, status_code=e.status_code, retry_after=e.retry_after)
+            except Exception as e:
+                print(f"[JOBS] Job {job.id} failed: {e}")
+                self._finish(job, FAILED, error=str(e), status_code=500)
+            finally:
+                job.task = None
+                duration = time.time() - job.started_at
+                self._duration_ewma = duration if self._duration_ewma is None else 0.2 * duration + 0.8 * self._duration_ewma
+
+    async def _sweeper(self):
+        """Drop finished jobs once they are older than the TTL"""
+        while True:
+            await asyncio.sleep(min(60, self.ttl))
+            cutoff = time.time() - self.ttl
+            expired = [
+                job_id for job_id, job in self.jobs.items()
+                if job.status in FINISHED_STATES and job.finished_at < cutoff
+            ]
+            for job_id in expired:
+                del self.jobs[job_id]
+            self.stats["expired"] += len(expired)
+
+    def info(self):
+        running = sum(1 for job in self.jobs.values() if job.status == RUNNING)
+        return {
+            **self.stats,
+            "queued": len(self._queue),
+            "running": running,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "shed_depth": self.shed_depth,
+            "retry_after_s": self.retry_after(),
+            "queued_by_client": self._queue.depth_by_client()
+        }
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Metrics and Request Tracing for BUDDY Backend
+Prometheus-style histograms and gauges, per-request timing spans and the
+X-Request-ID header that is passed on to the SD servers.
+"""
+
+import contextvars
+import json
+import time
+import uuid
+from contextlib import contextmanager
+
+REQUEST_ID_HEADER = "X-Request-ID"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+REQUEST_ID = contextvars.ContextVar("request_id", default=None)
+TRACE = contextvars.ContextVar("trace", default=None)  # stage -> seconds for the current request
+
+# >>> shared: metric types (copies must match, see tests/test_shared_code.py)
+def _escape(value):
+    # The text format needs backslash, double quote and newline escaped inside label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                labels = _labels(self.labelnames + ("le",), key + (str(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class CallbackMetric:
+    """Gauge or counter read at scrape time from existing stats.
+
+    fn() returns a number, or a dict of label value tuple -> number.
+    """
+
+    def __init__(self, name, documentation, fn, labelnames=(), kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.fn()
+        except Exception:
+            return []  # e.g. state not set up yet; skip rather than break the scrape
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {float(value)}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def callback(self, *args, **kwargs):
+        metric = CallbackMetric(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+# <<< shared: metric types
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "buddy_stage_duration_seconds", "Time spent in each request stage", ("stage", "target")
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "buddy_request_duration_seconds", "HTTP request latency by endpoint", ("method", "endpoint", "status")
+)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "buddy_ollama_tokens_per_second", "Ollama generation speed", ("model",),
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+)
+
+def record(stage, seconds, target=""):
+    """Observe a stage duration and add it to the current request's trace"""
+    STAGE_SECONDS.observe(seconds, stage=stage, target=target)
+    trace = TRACE.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0.0) + seconds
+
+@contextmanager
+def span(stage, target=""):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started, target)
+
+def start_trace(request_id=None):
+    """Begin a trace for work that runs outside the request (e.g. a background job)"""
+    request_id = request_id or uuid.uuid4().hex
+    REQUEST_ID.set(request_id)
+    trace = {}
+    TRACE.set(trace)
+    return request_id, trace
+
+def log_trace(request_id, trace, **fields):
+    """One structured line per request instead of free-form prints"""
+    spans = {stage: round(seconds * 1000, 1) for stage, seconds in trace.items()}
+    print("[BACKEND] " + json.dumps({"request_id": request_id, **fields, "spans_ms": spans}))
+
+def server_timing(trace):
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in trace.items())
+
+class RequestContextMiddleware:
+    """Request ids, Server-Timing, the latency histogram and one trace log line per request.
+
+    Plain ASGI rather than BaseHTTPMiddleware so streaming responses and
+    disconnect detection behave exactly as without it.
+    """
+
+    def __init__(self, app, skip_paths=("/metrics", "/health")):
+        self.app = app
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope["headers"]).get(REQUEST_ID_HEADER.lower().encode(), b"").decode("latin-1")
+        request_id, trace = start_trace(incoming[:128] or None)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((REQUEST_ID_HEADER.encode(), request_id.encode("latin-1")))
+                if trace:
+                    headers.append((b"server-timing", server_timing(trace).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            elapsed = time.perf_counter() - started
+            endpoint = scope.get("endpoint")
+            endpoint = endpoint.__name__ if endpoint is not None else "unmatched"
+            REQUEST_SECONDS.observe(elapsed, method=scope["method"], endpoint=endpoint, status=status["code"])
+            if scope["path"] not in self.skip_paths:
+                log_trace(
+                    request_id, trace, method=scope["method"], path=scope["path"],
+                    status=status["code"], total_ms=round(elapsed * 1000, 1)
+                )
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Ollama Model Router for BUDDY Backend
+Routes chat requests to allowlisted models across one or more Ollama
+endpoints, keeps models loaded and caps in-flight generations per model.
+Unreachable endpoints are skipped until a health probe or a cooldown
+brings them back.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+def parse_keep_alive(value):
+    """Ollama takes keep_alive as a duration string ("30m") or a number of seconds.
+
+    A bare number has to go out as a JSON number: Ollama parses strings as Go
+    durations, which need a unit, so "-1" or "3600" would be rejected.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+class ModelNotAllowed(Exception):
+    """Raised when a request names a model outside the allowlist"""
+
+class ModelGate:
+    """Limits concurrent generations for one model; waiters are admitted first come, first served"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = deque()
+
+    async def acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # the slot was handed over just as we were cancelled, pass it on
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self):
+        # Hand the slot straight to the oldest waiter so newcomers cannot jump the queue,
+        # unless the limit was lowered below what is in use
+        while self._waiters and self.active <= self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def set_limit(self, limit):
+        """Change the limit; a lower one takes effect as slots are released"""
+        self.limit = limit
+        while self._waiters and self.active < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def info(self):
+        return {"active": self.active, "waiting": len(self._waiters), "limit": self.limit}
+
+class OllamaEndpoint:
+    def __init__(self, base_url, client):
+        self.base_url = base_url.rstrip("/")
+        self.generate_url = f"{self.base_url}/api/generate"
+        self.client = client
+        self.in_flight = 0
+        self.healthy = True
+        self.retry_at = 0.0  # While unhealthy, monotonic time after which requests may try it again
+        self.loaded = set()
+        self.last_probe = None
+
+    def available(self, now):
+        return self.healthy or now >= self.retry_at
+
+    def info(self):
+        return {
+            "url": self.base_url,
+            "in_flight": self.in_flight,
+            "healthy": self.healthy,
+            "loaded": sorted(self.loaded),
+            "last_probe": self.last_probe
+        }
+
+class Lease:
+    """A gate slot on one endpoint; release() is safe to call more than once"""
+    def __init__(self, router, model, endpoint):
+        self.router = router
+        self.model = model
+        self.endpoint = endpoint
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.endpoint.in_flight -= 1
+        self.router.gates[self.model].release()
+
+class OllamaRouter:
+    def __init__(self, base_urls, models, client_factory, keep_alive="30m", max_in_flight=2,
+                 probe_interval=15.0, cooldown=30.0):
+        """client_factory() returns a new httpx.AsyncClient; each endpoint gets its own pool.
+
+        An endpoint that fails is skipped for cooldown seconds, or until the
+        /api/tags probe (every probe_interval seconds) finds it up again.
+        """
+        self.models = list(models)
+        self.default_model = self.models[0]
+        self.keep_alive = parse_keep_alive(keep_alive)
+        self.max_in_flight = max_in_flight
+        self.probe_interval = probe_interval
+        self.cooldown = cooldown
+        self.endpoints = [OllamaEndpoint(url, client_factory()) for url in base_urls]
+        self.gates = {model: ModelGate(self._gate_limit()) for model in self.models}
+        self.stats = {"requests": 0, "rejected_models": 0, "connect_errors": 0, "recoveries": 0}
+        self._probe_task = None
+
+    def _gate_limit(self):
+        # max_in_flight is per endpoint, so only endpoints that are up add to each model's limit
+        return self.max_in_flight * max(1, sum(1 for endpoint in self.endpoints if endpoint.healthy))
+
+    def _set_health(self, endpoint, healthy):
+        if healthy:
+            if not endpoint.healthy:
+                self.stats["recoveries"] += 1
+                print(f"[BACKEND] Ollama endpoint {endpoint.base_url} is back")
+        else:
+            endpoint.retry_at = time.monotonic() + self.cooldown
+        if healthy == endpoint.healthy:
+            return
+        endpoint.healthy = healthy
+        limit = self._gate_limit()
+        for gate in self.gates.values():
+            gate.set_limit(limit)
+
+    def resolve_model(self, model):
+        """Return the model to use, raising ModelNotAllowed for anything off the allowlist"""
+        if model is None:
+            return self.default_model
+        if model not in self.gates:
+            self.stats["rejected_models"] += 1
+            raise ModelNotAllowed(f"Unknown model '{model}'. Choose from: {', '.join(self.models)}")
+        return model
+
+    def _pick_endpoint(self, model):
+        # Least loaded healthy endpoint, preferring ones that already have the model loaded;
+        # an unhealthy one gets a request again once its cooldown has passed
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.available(now)] or self.endpoints
+        return min(candidates, key=lambda endpoint: (endpoint.in_flight, model not in endpoint.loaded))
+
+    async def acquire(self, model):
+        """Wait for a slot for model and return a Lease on the chosen endpoint"""
+        await self.gates[model].acquire()
+        endpoint = self._pick_endpoint(model)
+        endpoint.in_flight += 1
+        self.stats["requests"] += 1
+        return Lease(self, model, endpoint)
+
+    def mark(self, endpoint, model, ok):
+        """Record the outcome of a request so routing avoids unreachable endpoints"""
+        self._set_health(endpoint, ok)
+        if ok:
+            endpoint.loaded.add(model)
+        else:
+            self.stats["connect_errors"] += 1
+
+    async def _preload(self, endpoint, model):
+        try:
+            # A request with no prompt just loads the model and applies keep_alive
+            response = await endpoint.client.post(
+                endpoint.generate_url,
+                json={"model": model, "keep_alive": self.keep_alive},
+                timeout=300.0  # Loading weights from disk can take a while
+            )
+            response.raise_for_status()
+            self.mark(endpoint, model, True)
+            print(f"[BACKEND] Preloaded {model} on {endpoint.base_url} (keep_alive={self.keep_alive})")
+        except Exception as e:
+            print(f"[BACKEND] Could not preload {model} on {endpoint.base_url}: {e}")
+
+    async def preload(self):
+        """Load every allowlisted model on every endpoint so first requests skip the load"""
+        await asyncio.gather(*(
+            self._preload(endpoint, model) for endpoint in self.endpoints for model in self.models
+        ))
+
+    async def start(self):
+        self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def aclose(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+        for endpoint in self.endpoints:
+            await endpoint.client.aclose()
+
+    async def _probe(self, endpoint):
+        try:
+            # Lists local models; cheap, and answers as soon as the server is up
+            response = await endpoint.client.get(f"{endpoint.base_url}/api/tags", timeout=5.0)
+            healthy = response.status_code == 200
+        except Exception as e:
+            if endpoint.healthy:
+                print(f"[BACKEND] Health probe failed for Ollama endpoint {endpoint.base_url}: {e}")
+            healthy = False
+        endpoint.last_probe = time.time()
+        self._set_health(endpoint, healthy)
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            await asyncio.gather(*(self._probe(endpoint) for endpoint in self.endpoints))
+
+    def info(self):
+        return {
+            **self.stats,
+            "models": self.models,
+            "default_model": self.default_model,
+            "keep_alive": self.keep_alive,
+            "probe_interval": self.probe_interval,
+            "cooldown": self.cooldown,
+            "endpoints": [endpoint.info() for endpoint in self.endpoints],
+            "gates": {model: gate.info() for model, gate in self.gates.items()}
+        }
@@ -7,6 +7,8 @@ pkill -f "uvicorn app:app"
 # Wait a moment to ensure processes are stopped
 sleep 2
 
-# Start the backend with 4 workers for parallel requests (no --reload for true parallelism)
-echo "Starting backend with 4 workers (no reload)..."
-uvicorn app:app --host 0.0.0.0 --port 8000 --workers 4 
\ No newline at end of file
+# Start the backend as a single process (no --reload). Jobs, chat sessions and rate limits are kept
+# in memory, so extra workers would each see their own copy; the backend is async I/O and one process keeps up.
+echo "Starting backend (single worker, no reload)..."
+# Prompts for the credentials password once (not at all if a credential agent is running)
+python credential_loader.py run -- uvicorn app:app --host 0.0.0.0 --port 8000
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Stable Diffusion Backend Pool for BUDDY Backend
+Spreads image requests over several SD Spaces using health probes and
+in-flight counts, with per-backend circuit breakers, optional hedging and
+failover to the fast backend when the primary's queue is long.
+"""
+
+import asyncio
+import tempfile
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class NoBackendAvailable(Exception):
+    """Raised when every backend is excluded or has its circuit open"""
+
+def overload_retry_after(error):
+    """Retry-After of a deliberate 503 (queue full, model still loading), or None for any other error"""
+    response = getattr(error, "response", None)
+    if response is None or response.status_code != 503:
+        return None
+    return response.headers.get("retry-after")
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def allows(self):
+        """Whether a request may be sent now (half-open lets one trial request through)"""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            return not self.trial_in_flight
+        return self.state == CLOSED
+
+    def on_start(self):
+        if self.state == HALF_OPEN:
+            self.trial_in_flight = True
+
+    def on_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def on_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+class SDBackend:
+    def __init__(self, name, base_url, client, breaker):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.client = client
+        self.breaker = breaker
+        self.in_flight = 0
+        self.healthy = True  # Until the first probe says otherwise
+        self.queue_depth = 0
+        self.latency_ewma = None  # Seconds per successful generation
+        self.last_probe = None
+        self.stats = {"requests": 0, "successes": 0, "failures": 0, "overloaded": 0, "hedges_won": 0}
+
+    def expected_wait(self, default_latency):
+        """Rough seconds until a new request here would finish"""
+        latency = self.latency_ewma if self.latency_ewma is not None else default_latency
+        return (self.queue_depth + self.in_flight + 1) * latency
+
+    def record_latency(self, seconds, alpha=0.3):
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma = alpha * seconds + (1 - alpha) * self.latency_ewma
+
+    def info(self):
+        return {
+            **self.stats,
+            "url": self.base_url,
+            "healthy": self.healthy,
+            "circuit": self.breaker.state,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "latency_ewma_s": round(self.latency_ewma, 2) if self.latency_ewma is not None else None,
+            "last_probe": self.last_probe
+        }
+
+class SDBackendPool:
+    def __init__(self, backends, client_factory, probe_interval=15.0, hedge_after=0.0,
+                 failover_backend=None, failover_queue_depth=4, failure_threshold=3,
+                 reset_timeout=30.0, default_latency=120.0, spool_bytes=1024 * 1024, chunk_size=64 * 1024):
+        """backends is a list of (name, base_url); the first one is the primary"""
+        self.backends = [
+            SDBackend(name, url, client_factory(), CircuitBreaker(failure_threshold, reset_timeout))
+            for name, url in backends
+        ]
+        self.primary = self.backends[0]
+        self.failover = next((backend for backend in self.backends if backend.name == failover_backend), None)
+        self.probe_interval = probe_interval
+        self.hedge_after = hedge_after
+        self.failover_queue_depth = failover_queue_depth
+        self.default_latency = default_latency
+        self.spool_bytes = spool_bytes
+        self.chunk_size = chunk_size
+        self._probe_task = None
+        self.stats = {"requests": 0, "hedged": 0, "failovers": 0, "retries": 0}
+
+    async def start(self):
+        self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def aclose(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+        for backend in self.backends:
+            await backend.client.aclose()
+
+    async def _probe(self, backend):
+        try:
+            response = await backend.client.get(f"{backend.base_url}/health", timeout=5.0)
+            health = response.json() if response.status_code == 200 else {}
+            backend.healthy = health.get("status") == "healthy"
+            backend.queue_depth = health.get("batching", {}).get("queue_depth", 0)
+        except Exception as e:
+            print(f"[BACKEND] Health probe failed for SD backend {backend.name}: {e}")
+            backend.healthy = False
+        backend.last_probe = time.time()
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+            await asyncio.sleep(self.probe_interval)
+
+    def choose(self, exclude=()):
+        """Pick a backend and the reason it was picked"""
+        candidates = [
+            backend for backend in self.backends
+            if backend not in exclude and backend.breaker.allows()
+        ]
+        if not candidates:
+            raise NoBackendAvailable("No Stable Diffusion backend is available")
+        # A long primary queue sends work to the fast backend even if it looks busier
+        if (self.failover in candidates and self.primary in candidates
+                and self.primary.queue_depth + self.primary.in_flight >= self.failover_queue_depth):
+            return self.failover, "failover"
+        healthy = [backend for backend in candidates if backend.healthy] or candidates
+        # min() keeps list order on ties, so the primary wins when loads are equal
+        return min(healthy, key=lambda backend: backend.expected_wait(self.default_latency)), "least_loaded"
+
+    async def _attempt(self, backend, json_data, headers):
+        """Send one generation to backend and spool the image; returns (file, content_type, seconds)"""
+        backend.in_flight += 1
+        backend.stats["requests"] += 1
+        backend.breaker.on_start()
+        started = time.monotonic()
+        image_file = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        try:
+            async with backend.client.stream(
+                "POST", f"{backend.base_url}/generate", json=json_data, headers=headers
+            ) as response:
+                if response.is_error:
+                    await response.aread()  # Keep the error body for the caller
+                response.raise_for_status()
+                content_type = response.headers.get("content-type", "image/png")
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    image_file.write(chunk)
+            image_file.seek(0)
+        except BaseException as e:
+            image_file.close()
+            status_code = getattr(getattr(e, "response", None), "status_code", 500)
+            if isinstance(e, asyncio.CancelledError):
+                backend.breaker.trial_in_flight = False  # Lost a hedge race; says nothing about health
+            elif overload_retry_after(e) is not None:
+                backend.stats["overloaded"] += 1
+                backend.breaker.on_success()  # Shedding load on purpose; the backend is up
+            elif status_code >= 500:
+                backend.stats["failures"] += 1
+                backend.breaker.on_failure()
+            else:
+                backend.breaker.on_success()  # The backend answered; the request itself was bad
+            raise
+        finally:
+            backend.in_flight -= 1
+        elapsed = time.monotonic() - started
+        backend.stats["successes"] += 1
+        backend.breaker.on_success()
+        backend.record_latency(elapsed)
+        return image_file, content_type, elapsed
+
+    async def _hedged(self, first, json_data, headers, route, tried):
+        """Run on first; after hedge_after seconds also run on a second backend, first success wins.
+
+        The hedge backend is appended to tried, so a retry after both fail goes somewhere else.
+        """
+        tasks = {asyncio.create_task(self._attempt(first, json_data, headers)): first}
+        done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+        if not done:
+            try:
+                second, _ = self.choose(exclude=tried)
+            except NoBackendAvailable:
+                second = None
+            if second is not None:
+                self.stats["hedged"] += 1
+                route["hedged_to"] = second.name
+                tried.append(second)
+                tasks[asyncio.create_task(self._attempt(second, json_data, headers))] = second
+        pending = set(tasks)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = tasks[task]
+                        if len(tasks) > 1:
+                            winner.stats["hedges_won"] += 1
+                        return winner, task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            # Losers may finish between cancel() and here; close anything they spooled
+            for task in pending:
+                try:
+                    image_file, _, _ = await task
+                    image_file.close()
+                except BaseException:
+                    pass
+
+    async def generate(self, json_data, headers=None):
+        """Generate on the best backend, retrying once elsewhere on a backend failure.
+
+        Returns (image_file, content_type, route) where route describes the decision.
+        """
+        self.stats["requests"] += 1
+        backend, reason = self.choose()
+        if reason == "failover":
+            self.stats["failovers"] += 1
+        route = {"backend": backend.name, "reason": reason}
+        tried = []
+        while True:
+            tried.append(backend)
+            try:
+                if self.hedge_after > 0 and len(self.backends) > 1:
+                    backend, (image_file, content_type, elapsed) = await self._hedged(backend, json_data, headers, route, tried)
+                else:
+                    image_file, content_type, elapsed = await self._attempt(backend, json_data, headers)
+                route["served_by"] = backend.name
+                route["latency_s"] = round(elapsed, 2)
+                route["attempts"] = len(tried)
+                return image_file, content_type, route
+            except Exception as e:
+                status_code = getattr(getattr(e, "response", None), "status_code", 500)
+                if status_code < 500:
+                    raise  # The request is bad, another backend would reject it too
+                try:
+                    backend, _ = self.choose(exclude=tried)
+                except NoBackendAvailable:
+                    raise e
+                print(f"[BACKEND] SD backend {tried[-1].name} failed ({e}), retrying on {backend.name}")
+                self.stats["retries"] += 1
+
+    def info(self):
+        return {
+            **self.stats,
+            "hedge_after_s": self.hedge_after,
+            "failover_backend": self.failover.name if self.failover else None,
+            "failover_queue_depth": self.failover_queue_depth,
+            "backends": {backend.name: backend.info() for backend in self.backends}
+        }
@@ -12,6 +12,8 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import getpass
 
+from credential_loader import fetch_key_from_agent
+
 class SecureCredentials:
     def __init__(self, key_file=".buddy_key", cred_file=".buddy_creds"):
         self.key_file = key_file
@@ -35,6 +37,11 @@ class SecureCredentials:
     def _load_or_create_key(self):
         """Load existing key or create new one"""
         if os.path.exists(self.key_file):
+            # A running credential agent already holds the unlocked key
+            stored_key = fetch_key_from_agent()
+            if stored_key is not None:
+                self.fernet = Fernet(stored_key)
+                return
             with open(self.key_file, 'rb') as f:
                 data = f.read()
                 salt = data[:16]
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Chat Sessions for BUDDY Backend
+Keeps the context tokens Ollama returns after each turn so the next turn
+can continue the conversation without resending the history.
+"""
+
+import time
+import uuid
+from collections import OrderedDict
+
+class ChatSession:
+    def __init__(self, session_id):
+        self.id = session_id
+        self.model = None  # Set on the first turn; context tokens are model specific
+        self.context = []  # Ollama context tokens after the last turn
+        self.turns = 0
+        self.truncations = 0
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.last_turn = None
+
+    def to_dict(self):
+        return {
+            "session_id": self.id,
+            "model": self.model,
+            "turns": self.turns,
+            "context_tokens": len(self.context),
+            "truncations": self.truncations,
+            "created_at": self.created_at,
+            "last_used": self.last_used,
+            "last_turn": self.last_turn
+        }
+
+class SessionStore:
+    """Sessions in this process's memory, least recently used evicted first.
+
+    They are not shared between processes, so the backend runs as a single
+    process (app.py holds BACKEND_LOCK_FILE) and sessions end on restart.
+    """
+
+    def __init__(self, max_sessions=1000, ttl=3600, token_budget=4096):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self._sessions = OrderedDict()  # session id -> ChatSession, least recently used first
+        self.stats = {"created": 0, "expired": 0, "evicted": 0, "truncations": 0, "turns": 0, "prompt_eval_tokens": 0}
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_used >= cutoff:
+                break
+            del self._sessions[session.id]
+            self.stats["expired"] += 1
+
+    def create(self):
+        """Start a new empty session, evicting the least recently used one if full"""
+        self._expire()
+        session = ChatSession(uuid.uuid4().hex)
+        self._sessions[session.id] = session
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.stats["evicted"] += 1
+        self.stats["created"] += 1
+        return session
+
+    def get(self, session_id):
+        """Return a live session and mark it used, or None if unknown or expired"""
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_used = time.time()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def delete(self, session_id):
+        return self._sessions.pop(session_id, None) is not None
+
+    def record_turn(self, session, final_chunk):
+        """Store the context from Ollama's final chunk and return per-turn stats"""
+        context = final_chunk.get("context") or []
+        truncated = len(context) > self.token_budget
+        if truncated:
+            # Keep the most recent tokens; the oldest turns fall out of the window
+            context = context[-self.token_budget:]
+            session.truncations += 1
+            self.stats["truncations"] += 1
+        session.context = context
+        session.turns += 1
+        session.last_used = time.time()
+
+        prompt_eval_count = final_chunk.get("prompt_eval_count", 0)
+        prompt_eval_duration_ns = final_chunk.get("prompt_eval_duration")
+        self.stats["turns"] += 1
+        self.stats["prompt_eval_tokens"] += prompt_eval_count
+        session.last_turn = {
+            "turn": session.turns,
+            "prompt_eval_count": prompt_eval_count,
+            "prompt_eval_ms": round(prompt_eval_duration_ns / 1e6, 1) if prompt_eval_duration_ns else None,
+            "eval_count": final_chunk.get("eval_count", 0),
+            "context_tokens": len(context),
+            "truncated": truncated
+        }
+        return session.last_turn
+
+    def info(self):
+        self._expire()
+        return {
+            **self.stats,
+            "active": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "ttl": self.ttl,
+            "token_budget": self.token_budget
+        }
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Single-flight request coalescing for BUDDY Backend
+Concurrent callers asking for the same key share one in-flight job.
+"""
+
+import asyncio
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}  # key -> asyncio.Task
+        self._waiters = {}  # asyncio.Task -> callers still awaiting it
+        self.stats = {"started": 0, "coalesced": 0, "abandoned": 0}
+
+    def _finished(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, factory):
+        """Run factory() once per key; concurrent callers await the same result or error.
+
+        A caller being cancelled (e.g. the client disconnected) does not cancel
+        the shared job for the remaining waiters; once the last one is gone the
+        job is cancelled, so no work is done for nobody.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+            self.stats["started"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    task.cancel()
+                    self.stats["abandoned"] += 1
+                    # Return only once it has unwound, so callers bounding concurrency stay bounded
+                    await asyncio.wait({task})
+
+    def info(self):
+        return {**self.stats, "in_flight": len(self._inflight)}
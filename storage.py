@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Image Storage Backends for BUDDY Backend
+Generated images go either to Cloudinary or to a local content-addressed
+store that the backend serves itself.
+"""
+
+import asyncio
+import contextvars
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from urllib.parse import urlsplit
+
+CONTENT_TYPE_EXTENSIONS = {
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/jpeg": "jpg",
+    "image/avif": "avif"
+}
+EXTENSION_CONTENT_TYPES = {ext: content_type for content_type, ext in CONTENT_TYPE_EXTENSIONS.items()}
+IMAGE_NAME_RE = re.compile(r"^([0-9a-f]{64})\.(png|webp|jpg|avif)$")
+# Base URL the current request reached the backend on; local image URLs are built from it
+REQUEST_BASE_URL = contextvars.ContextVar("request_base_url", default="")
+
+class StorageError(Exception):
+    """Raised when an image cannot be stored"""
+
+class CloudinaryStorage:
+    name = "cloudinary"
+
+    def __init__(self, folder="buddy-generated", unlock=None):
+        self.folder = folder
+        self.unlock = unlock  # Loads encrypted credentials into the environment, called on first upload
+        self._sdk_configured = False
+
+    def configured(self):
+        return all([os.getenv("CLOUDINARY_CLOUD_NAME"),
+                    os.getenv("CLOUDINARY_API_KEY"),
+                    os.getenv("CLOUDINARY_API_SECRET")])
+
+    def _uploader(self):
+        """Unlock credentials and configure the SDK the first time they are needed"""
+        try:
+            import cloudinary
+            import cloudinary.uploader
+        except ImportError:
+            raise StorageError("Cloudinary not available - install the cloudinary package.")
+        if not self.configured() and self.unlock is not None:
+            self.unlock()
+        if not self.configured():
+            raise StorageError("Cloudinary configuration missing. Please set CLOUDINARY_* environment variables.")
+        if not self._sdk_configured:
+            cloudinary.config(
+                cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
+                api_key=os.getenv("CLOUDINARY_API_KEY"),
+                api_secret=os.getenv("CLOUDINARY_API_SECRET")
+            )
+            self._sdk_configured = True
+        return cloudinary.uploader
+
+    async def save(self, image_file, content_type):
+        """Upload a file object and return its public URL"""
+        # Blocking SDK calls (and the one-time unlock), run off the event loop
+        uploader = await asyncio.to_thread(self._uploader)
+        result = await asyncio.to_thread(
+            uploader.upload,
+            image_file,
+            resource_type="image",
+            folder=self.folder
+        )
+        # The full result dict is large; timing goes to the request trace instead
+        print(f"[BACKEND] Uploaded {result.get('public_id')} to Cloudinary ({result.get('bytes')} bytes)")
+        return result["secure_url"]
+
+    def contains(self, url):
+        return True  # Cloudinary keeps uploads; nothing to check locally
+
+    def public_url(self, url):
+        return url
+
+    def info(self):
+        return {"backend": self.name, "configured": self.configured()}
+
+class LocalImageStore:
+    name = "local"
+
+    def __init__(self, root, base_url="", max_bytes=2 * 1024 ** 3, chunk_size=64 * 1024):
+        self.root = root
+        self.base_url = base_url.rstrip("/")  # Empty: use the URL each request came in on
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self.stats = {"stored": 0, "deduplicated": 0, "evictions": 0}
+        os.makedirs(root, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._scan())
+
+    def configured(self):
+        return True
+
+    def path_for(self, digest, ext):
+        # Two levels of sharding keep directories small
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.{ext}")
+
+    def _scan(self):
+        """Yield (path, size, last_access) for every stored image"""
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if IMAGE_NAME_RE.match(filename):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def _save(self, image_file, content_type):
+        ext = CONTENT_TYPE_EXTENSIONS.get(content_type.split(";")[0].strip(), "png")
+        digest = hashlib.sha256()
+        size = 0
+        # Hash while copying into a temp file next to the store, then move into place atomically
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as tmp:
+            while True:
+                chunk = image_file.read(self.chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        digest = digest.hexdigest()
+        path = self.path_for(digest, ext)
+        if os.path.exists(path):
+            os.unlink(tmp.name)
+            os.utime(path)
+            self.stats["deduplicated"] += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp.name, path)
+            with self._lock:
+                self.total_bytes += size
+            self.stats["stored"] += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+        return self._url(f"{digest}.{ext}")
+
+    def _url(self, name):
+        base_url = self.base_url or REQUEST_BASE_URL.get().rstrip("/")
+        return f"{base_url}/images/{name}"
+
+    def _evict(self):
+        """Delete least recently used images until the store is under 90% of its cap"""
+        with self._lock:
+            entries = sorted(self._scan(), key=lambda entry: entry[2])
+            self.total_bytes = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            for path, size, _ in entries:
+                if self.total_bytes <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                self.total_bytes -= size
+                self.stats["evictions"] += 1
+
+    async def save(self, image_file, content_type):
+        """Store a file object and return the URL the backend serves it from"""
+        try:
+            return await asyncio.to_thread(self._save, image_file, content_type)
+        except OSError as e:
+            raise StorageError(f"Local image store failed: {e}")
+
+    def lookup(self, name):
+        """Resolve a served image name to (path, content_type, etag), or None"""
+        match = IMAGE_NAME_RE.match(name)
+        if not match:
+            return None
+        digest, ext = match.groups()
+        path = self.path_for(digest, ext)
+        if not os.path.isfile(path):
+            return None
+        return path, EXTENSION_CONTENT_TYPES[ext], f'"{digest}"'
+
+    @staticmethod
+    def _name(url):
+        # Only the path counts, so URLs handed out on another host name or port still match
+        path = urlsplit(url).path
+        return path.rpartition("/images/")[2] if "/images/" in path else None
+
+    def contains(self, url):
+        """Whether a URL handed out earlier still points at a stored image"""
+        name = self._name(url)
+        return name is not None and self.lookup(name) is not None
+
+    def public_url(self, url):
+        """A stored image's URL as seen by the current request"""
+        name = self._name(url)
+        return self._url(name) if name is not None else url
+
+    def touch(self, path):
+        """Record an access so eviction keeps recently served images"""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def info(self):
+        return {
+            "backend": self.name,
+            "root": self.root,
+            "total_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            **self.stats
+        }
+
+def parse_range(header, size):
+    """Parse a single 'bytes=start-end' range; returns (start, end) inclusive, None for no range.
+
+    Raises ValueError for an unsatisfiable range.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].strip()
+    if "," in spec:
+        return None  # multipart ranges are not supported, serve the whole image
+    start, _, end = spec.partition("-")
+    try:
+        if start == "":
+            length = int(end)
+            if length <= 0:
+                raise ValueError("empty suffix range")
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        raise ValueError(f"Invalid range: {header}")
+    if start >= size or start > end:
+        raise ValueError(f"Unsatisfiable range: {header}")
+    return start, min(end, size - 1)
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The backend modules live at the repository root, the fake upstream servers in benchmarks/
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fakes import ServerThread, make_ollama_app, make_space_app  # noqa: E402
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+SPACE_PORT = free_port()
+OLLAMA_PORT = free_port()
+STATE_DIR = tempfile.mkdtemp(prefix="buddy-tests-")
+
+# app.py reads its configuration at import time, so this has to be in place before any test imports it
+os.environ.update({
+    "SD_BACKENDS": f"primary=http://127.0.0.1:{SPACE_PORT}",
+    "OLLAMA_URLS": f"http://127.0.0.1:{OLLAMA_PORT}",
+    "OLLAMA_PRELOAD": "false",
+    "STORAGE_BACKEND": "local",
+    "LOCAL_STORE_DIR": os.path.join(STATE_DIR, "images"),
+    "IMAGE_CACHE_ENABLED": "false",
+    "IMAGE_RATE_PER_MIN": "0",
+    "CHAT_RATE_PER_MIN": "0",
+    "JOB_WORKERS": "1",
+    "BACKEND_LOCK_FILE": os.path.join(STATE_DIR, "backend.lock")
+})
+
+@pytest.fixture(scope="session")
+def fake_space():
+    server = ServerThread(make_space_app(latency_s=0.5, jitter_s=0.0, image_bytes=4096, workers=2), SPACE_PORT).start()
+    yield server
+    server.stop()
+
+@pytest.fixture(scope="session")
+def fake_ollama():
+    server = ServerThread(make_ollama_app(tokens_per_sec=500.0, response_tokens=5, prompt_eval_ms=1.0), OLLAMA_PORT).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def run_backend(fake_space, fake_ollama):
+    """run_backend(test) runs the async test(client, app) against app.py started with the fakes"""
+    import app as backend
+
+    def run(test):
+        async def main():
+            async with backend.lifespan(backend.app):
+                transport = httpx.ASGITransport(app=backend.app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=30) as client:
+                    await test(client, backend.app)
+
+        asyncio.run(main())
+
+    return run
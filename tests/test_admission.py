@@ -0,0 +1,122 @@
+import asyncio
+import uuid
+
+import pytest
+
+from admission import AdmissionGate, FairQueue, Overloaded, RateLimited, RateLimiter, TokenBucket
+
+def test_token_bucket_refills_at_its_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("admission.time.monotonic", lambda: now[0])
+    bucket = TokenBucket(rate=2.0, burst=2)
+    assert bucket.take() == 0.0
+    assert bucket.take() == 0.0
+    assert bucket.take() == pytest.approx(0.5)
+    now[0] += 0.5
+    assert bucket.take() == 0.0
+    now[0] += 10  # Refills only up to the burst
+    assert bucket.take() == 0.0 and bucket.take() == 0.0 and bucket.take() > 0
+
+def test_rate_limiter_keeps_a_bucket_per_client():
+    limiter = RateLimiter(rate_per_min=1, burst=2, max_clients=2)
+    limiter.check("a")
+    limiter.check("a")
+    with pytest.raises(RateLimited) as excinfo:
+        limiter.check("a")
+    assert excinfo.value.retry_after >= 1
+    limiter.check("b")
+    limiter.check("c")  # Evicts a, the least recently used
+    limiter.check("a")
+    assert limiter.info()["clients"] == 2
+    assert limiter.stats == {"allowed": 5, "limited": 1}
+
+def test_rate_limiter_disabled_at_zero():
+    limiter = RateLimiter(rate_per_min=0, burst=1)
+    for _ in range(100):
+        limiter.check("a")
+
+def test_fair_queue_interleaves_by_cost_and_weight():
+    queue = FairQueue()
+    for i in range(4):
+        queue.push(f"a{i}", "a")
+    for i in range(2):
+        queue.push(f"b{i}", "b", weight=2.0)  # Twice the share: each item advances b half as far
+    queue.push("big", "c", cost=3.0)
+    queue.push("c1", "c")
+    queue.push("p", "d", priority=True)
+    assert queue.depth() == 9 and queue.depth("a") == 4
+    order = [queue.pop() for _ in range(len(queue))]
+    assert order[0] == "p"
+    assert order.index("b1") < order.index("a1")
+    assert order.index("c1") > order.index("a2")  # c's first item cost 3
+    assert queue.pop() is None
+
+def test_fair_queue_remove():
+    queue = FairQueue()
+    queue.push("x", "a")
+    queue.push("y", "a")
+    assert queue.remove("x")
+    assert not queue.remove("x")
+    assert queue.depth("a") == 1 and queue.pop() == "y"
+
+def test_admission_gate_hands_slots_over_fairly_and_sheds():
+    async def main():
+        gate = AdmissionGate("chat", limit=1, max_queue=3, max_queued_per_client=2)
+        release = await gate.acquire("a")
+        order = []
+
+        async def wait(client, tag):
+            done = await gate.acquire(client)
+            order.append(tag)
+            done()
+
+        waiters = [asyncio.create_task(wait("a", "a1")), asyncio.create_task(wait("a", "a2"))]
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await gate.acquire("a")  # a already has two waiting
+        waiters.append(asyncio.create_task(wait("b", "b1")))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await gate.acquire("c")  # Queue is full
+        assert gate.stats["shed"] == 2
+        release()
+        release()  # Safe to call twice
+        await asyncio.gather(*waiters)
+        assert order == ["a1", "b1", "a2"]
+        assert gate.active == 0
+
+    asyncio.run(main())
+
+def test_admission_gate_forgets_cancelled_waiters():
+    async def main():
+        gate = AdmissionGate("chat", limit=1)
+        release = await gate.acquire("a")
+        waiter = asyncio.create_task(gate.acquire("b"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert gate.info()["queue_depth"] == 0
+        release()
+        assert gate.active == 0
+
+    asyncio.run(main())
+
+def test_unknown_api_keys_share_the_ip_bucket(run_backend, monkeypatch):
+    import app as backend
+    monkeypatch.setattr(backend, "ADMISSION_API_KEYS", {"known-key"})
+
+    async def test(client, app):
+        app.state.image_limiter = RateLimiter(rate_per_min=1, burst=1)
+
+        async def submit(prompt, key=None):
+            headers = {"X-API-Key": key} if key else {}
+            return (await client.post("/jobs/generate", json={"prompt": prompt}, headers=headers)).status_code
+
+        assert await submit("no key") == 202
+        # A made-up key per request must not buy a fresh bucket
+        assert [await submit(f"random {i}", uuid.uuid4().hex) for i in range(3)] == [429, 429, 429]
+        # A configured key is its own client
+        assert await submit("known", "known-key") == 202
+        assert await submit("known again", "known-key") == 429
+
+    run_backend(test)
@@ -0,0 +1,25 @@
+import os
+import socket
+
+import credential_loader
+
+def test_status_reports_what_a_first_upload_could_load(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv(credential_loader.SOCKET_ENV, str(tmp_path / "key.sock"))
+    monkeypatch.delenv(credential_loader.KEY_FD_ENV, raising=False)
+    for var in credential_loader.REQUIRED_VARS:
+        monkeypatch.delenv(var, raising=False)
+    assert credential_loader.credential_status() == {"loaded": False, "available": False, "encrypted_file": False}
+
+    for name in (credential_loader.KEY_FILE, credential_loader.CRED_FILE):
+        (tmp_path / name).write_bytes(b"x")
+    # Encrypted, but nothing could unlock it without a password
+    assert credential_loader.credential_status()["available"] is False
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(os.environ[credential_loader.SOCKET_ENV])
+        assert credential_loader.credential_status() == {"loaded": False, "available": True, "encrypted_file": True}
+
+    for var in credential_loader.REQUIRED_VARS:
+        monkeypatch.setenv(var, "set")
+    assert credential_loader.credential_status()["loaded"] is True
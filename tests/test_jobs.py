@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+from jobs import CANCELLED, DETACHED, FAILED, QUEUED, RUNNING, SUCCEEDED, JobFailed, JobManager, QueueFullError
+
+def run(test):
+    asyncio.run(test())
+
+async def wait_for(predicate, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+def test_jobs_run_and_fail_with_status_codes():
+    async def runner(job):
+        if job.payload == "bad":
+            raise JobFailed(503, "busy", retry_after="7")
+        return job.payload.upper()
+
+    async def main():
+        manager = JobManager(runner, workers=1)
+        await manager.start()
+        ok, bad = manager.submit("t", "ok"), manager.submit("t", "bad")
+        await bad.done.wait()
+        assert (ok.status, ok.result) == (SUCCEEDED, "OK")
+        assert (bad.status, bad.status_code, bad.error, bad.retry_after) == (FAILED, 503, "busy", "7")
+        await manager.stop()
+
+    run(main)
+
+def test_fair_queue_interleaves_clients():
+    order = []
+
+    async def runner(job):
+        order.append(job.payload)
+
+    async def main():
+        manager = JobManager(runner, workers=1)
+        for i in range(3):
+            manager.submit("t", f"a{i}", client="a")
+        for i in range(2):
+            manager.submit("t", f"b{i}", client="b")
+        manager.submit("t", "cheap", client="c", priority=True)
+        await manager.start()
+        await wait_for(lambda: len(order) == 6)
+        await manager.stop()
+
+    run(main)
+    assert order == ["cheap", "a0", "b0", "a1", "b1", "a2"]
+
+def test_shedding_and_per_client_limit():
+    async def main():
+        manager = JobManager(lambda job: None, workers=1, max_queue=3, shed_depth=2, max_queued_per_client=1)
+        manager.submit("t", 1, client="a")
+        with pytest.raises(QueueFullError):
+            manager.submit("t", 2, client="a")
+        manager.submit("t", 3, client="b")
+        with pytest.raises(QueueFullError):
+            manager.submit("t", 4, client="c")  # Past shed_depth only priority jobs get in
+        manager.submit("t", 5, client="c", priority=True)
+        assert manager.stats["rejected"] == 2
+
+    run(main)
+
+def test_attach_and_cancel_leave_the_job_to_its_last_holder():
+    async def main():
+        manager = JobManager(lambda job: None, workers=1)
+        job = manager.submit("t", "p", client="alice", key="k")
+        assert manager.find("k") is job
+        manager.attach(job, "bob")
+        with pytest.raises(PermissionError):
+            manager.cancel(job.id, client="carol")
+        assert manager.cancel(job.id, client="alice") == DETACHED
+        assert job.status == QUEUED
+        with pytest.raises(PermissionError):
+            manager.cancel(job.id, client="alice")
+        assert manager.cancel(job.id, client="bob") == CANCELLED
+        assert job.status == CANCELLED
+        assert manager.find("k") is None
+        assert manager.cancel(job.id, client="bob") is None
+
+    run(main)
+
+def test_cancelling_a_running_job_cancels_its_runner():
+    async def main():
+        stopped = asyncio.Event()
+
+        async def runner(job):
+            try:
+                await asyncio.sleep(60)
+            finally:
+                stopped.set()
+
+        manager = JobManager(runner, workers=1)
+        await manager.start()
+        job = manager.submit("t", "p", key="k")
+        await wait_for(lambda: job.status == RUNNING)
+        assert manager.cancel(job.id) == CANCELLED
+        await job.done.wait()
+        assert job.status == CANCELLED and stopped.is_set()
+        assert manager.find("k") is None
+        await manager.stop()
+
+    run(main)
+
+def test_stop_while_a_cancelled_job_unwinds():
+    async def main():
+        async def runner(job):
+            try:
+                await asyncio.sleep(60)
+            finally:
+                await asyncio.sleep(0.05)  # Slow cleanup, e.g. closing an upstream request
+
+        manager = JobManager(runner, workers=1)
+        await manager.start()
+        job = manager.submit("t", "p")
+        await wait_for(lambda: job.status == RUNNING)
+        manager.cancel(job.id)
+        await asyncio.wait_for(manager.stop(), timeout=5)
+
+    run(main)
+
+def test_finished_jobs_expire_after_the_ttl():
+    async def runner(job):
+        return None
+
+    async def main():
+        manager = JobManager(runner, workers=1, ttl=0.05)
+        await manager.start()
+        job = manager.submit("t", "p")
+        await job.done.wait()
+        await wait_for(lambda: manager.get(job.id) is None)
+        assert manager.stats["expired"] == 1
+        await manager.stop()
+
+    run(main)
+
+def test_cancelled_running_image_job_stops_generating(run_backend):
+    async def test(client, app):
+        first = (await client.post("/jobs/generate", json={"prompt": "cancel me"})).json()
+        await wait_for(lambda: app.state.jobs.get(first["id"]).status == RUNNING)
+        await wait_for(lambda: app.state.sd_pool.backends[0].in_flight == 1)
+        assert (await client.delete(f"/jobs/{first['id']}")).status_code == 200
+        await app.state.jobs.get(first["id"]).done.wait()
+        assert app.state.jobs.get(first["id"]).status == CANCELLED
+
+        second = (await client.post("/jobs/generate", json={"prompt": "keep me"})).json()
+        await wait_for(lambda: app.state.jobs.get(second["id"]).status == RUNNING)
+        # JOB_WORKERS=1 caps SD requests: the cancelled generation is gone, not running in the background
+        assert app.state.sd_pool.backends[0].in_flight <= 1
+        await app.state.jobs.get(second["id"]).done.wait()
+        assert app.state.jobs.get(second["id"]).status == SUCCEEDED
+        assert app.state.storage.stats["stored"] + app.state.storage.stats["deduplicated"] == 1
+        assert app.state.image_flights.stats["abandoned"] == 1
+
+    run_backend(test)
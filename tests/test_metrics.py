@@ -0,0 +1,8 @@
+from metrics import Histogram
+
+def test_label_values_are_escaped():
+    histogram = Histogram("test_seconds", "Test", ("target",), buckets=(1,))
+    histogram.observe(0.5, target='C:\\models\n"sd"')
+    lines = histogram.render()
+    assert 'test_seconds_count{target="C:\\\\models\\n\\"sd\\""} 1' in lines
+    assert all("\n" not in line for line in lines)
@@ -0,0 +1,30 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from ollama_router import OllamaRouter, parse_keep_alive
+
+@pytest.mark.parametrize("value, expected", [("-1", -1), ("3600", 3600), ("0", 0), ("30m", "30m"), ("-1m", "-1m")])
+def test_parse_keep_alive(value, expected):
+    assert parse_keep_alive(value) == expected
+
+def test_preload_sends_numeric_keep_alive_as_a_number():
+    bodies = []
+
+    def handler(request):
+        bodies.append(json.loads(request.content))
+        return httpx.Response(200, json={"done": True})
+
+    async def main():
+        router = OllamaRouter(
+            ["http://ollama:11434"], ["llama3"],
+            lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+            keep_alive="-1"
+        )
+        await router.preload()
+        await router.aclose()
+
+    asyncio.run(main())
+    assert bodies == [{"model": "llama3", "keep_alive": -1}]
@@ -0,0 +1,35 @@
+import asyncio
+from collections import Counter
+
+import httpx
+
+from sd_pool import SDBackendPool
+
+def test_retry_skips_a_hedge_backend_that_already_failed():
+    calls = Counter()
+
+    async def handler(request):
+        host = request.url.host
+        calls[host] += 1
+        if host == "slow":
+            await asyncio.sleep(0.2)  # Long enough to be hedged, then fails too
+            return httpx.Response(500)
+        if host == "broken":
+            return httpx.Response(500)
+        return httpx.Response(200, content=b"image", headers={"content-type": "image/png"})
+
+    async def main():
+        pool = SDBackendPool(
+            [("slow", "http://slow"), ("broken", "http://broken"), ("good", "http://good")],
+            lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+            hedge_after=0.05
+        )
+        image_file, _, route = await pool.generate({"prompt": "p"})
+        assert image_file.read() == b"image"
+        await pool.aclose()
+        return route
+
+    route = asyncio.run(main())
+    assert route["served_by"] == "good"
+    assert route["attempts"] == 3
+    assert calls == {"slow": 1, "broken": 1, "good": 1}
@@ -0,0 +1,87 @@
+import asyncio
+import importlib.util
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPACES = {"hf_space_app": "hf_space_app.py", "fast_space_app": os.path.join("BUDDY-SD-Fast", "app.py")}
+
+def load_space(name):
+    """Import one of the single-file Space apps; they need the full diffusers/torch stack"""
+    pytest.importorskip("torch")
+    pytest.importorskip("diffusers")
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, SPACES[name]))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+@pytest.fixture(params=sorted(SPACES))
+def space(request):
+    return load_space(request.param)
+
+def test_pool_rebuild_retries_after_any_warm_up_error(space):
+    calls = []
+
+    def run_batch(params, prompts, seeds, tags):
+        calls.append(prompts)
+        if len(calls) == 1:
+            raise RuntimeError("out of memory")  # Not a BrokenProcessPool
+        return [None for _ in prompts]
+
+    async def main():
+        scheduler = space.BatchScheduler(run_batch, workers=1)
+        scheduler._make_executor = lambda: ThreadPoolExecutor(max_workers=1)
+        scheduler.rebuild_retry_s = 0
+        scheduler._warm_params = (1, 0.0, 64, 64, "default")
+        scheduler.recovering = True
+        await asyncio.wait_for(scheduler._rebuild(ThreadPoolExecutor(max_workers=1)), timeout=5)
+        assert not scheduler.recovering and scheduler._pool_ready.is_set()
+        assert len(calls) == 2
+        scheduler.shutdown()
+
+    asyncio.run(main())
+
+def test_settings_are_bounded(space, monkeypatch):
+    from fastapi import HTTPException
+
+    monkeypatch.setattr(space, "SCHEDULERS", {"default": None})
+    monkeypatch.setattr(space, "TIERS", {"quality": {"steps": 50, "scheduler": "default", "guidance_scale": 7.5}})
+    monkeypatch.setattr(space, "DEFAULT_TIER", "quality")
+
+    def resolve(**overrides):
+        return space.resolve_settings(space.PromptRequest(prompt="p", **overrides))
+
+    assert resolve() == (50, 7.5, "default")
+    assert resolve(steps=space.MAX_STEPS, guidance_scale=0.0) == (space.MAX_STEPS, 0.0, "default")
+    for overrides in ({"steps": 0}, {"steps": space.MAX_STEPS + 1}, {"guidance_scale": -1.0}, {"guidance_scale": 1e6}):
+        with pytest.raises(HTTPException) as excinfo:
+            resolve(**overrides)
+        assert excinfo.value.status_code == 400, overrides
+
+def post(space, path, body):
+    async def main():
+        transport = httpx.ASGITransport(app=space.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.post(path, json=body)
+
+    return asyncio.run(main())
+
+def test_refine_rejects_a_schedule_with_no_steps(monkeypatch):
+    import torch
+
+    fast = load_space("fast_space_app")
+    monkeypatch.setitem(fast.LOAD_STATE, "status", "ready")
+    monkeypatch.setattr(fast, "SCHEDULERS", {"default": None})
+    image_id = fast.latent_cache.put(
+        torch.zeros(4, 8, 8), prompt="p", seed=1, steps=4, guidance_scale=1.0, scheduler="default"
+    )
+    for body in ({"strength": 0.2}, {"steps": 1, "strength": 0.5}):
+        response = post(fast, "/refine", {"image_id": image_id, **body})
+        assert response.status_code == 400, body
+        assert "at least one step" in response.json()["detail"]
@@ -0,0 +1,33 @@
+import os
+import re
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Each Space deploys as a single file, so code they share (with each other or with the
+# backend's metrics.py) is copied between "# >>> shared: <name>" and "# <<< shared: <name>"
+FILES = ("metrics.py", "hf_space_app.py", os.path.join("BUDDY-SD-Fast", "app.py"))
+BEGIN = re.compile(r"^# >>> shared: (.+?) \(")
+
+def shared_blocks(path):
+    with open(os.path.join(ROOT, path), encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    blocks = {}
+    for index, line in enumerate(lines):
+        match = BEGIN.match(line)
+        if match:
+            name = match.group(1)
+            end = lines.index(f"# <<< shared: {name}", index)
+            blocks[name] = "\n".join(lines[index:end + 1])
+    return blocks
+
+def test_shared_blocks_match_in_every_copy():
+    copies = defaultdict(dict)
+    for path in FILES:
+        for name, text in shared_blocks(path).items():
+            copies[name][path] = text
+    assert set(copies) >= {"metric types", "output encoding", "worker telemetry", "batching", "request settings"}
+    for name, by_path in copies.items():
+        assert len(by_path) >= 2, f"shared block '{name}' only appears in {list(by_path)}"
+        first_path, first = next(iter(by_path.items()))
+        for path, text in by_path.items():
+            assert text == first, f"shared block '{name}' in {path} has drifted from {first_path}"
@@ -0,0 +1,63 @@
+import asyncio
+
+from singleflight import SingleFlight
+
+def test_concurrent_callers_share_one_run():
+    async def main():
+        flights = SingleFlight()
+        runs = []
+
+        async def work():
+            runs.append(1)
+            await asyncio.sleep(0.01)
+            return "done"
+
+        results = await asyncio.gather(*(flights.do("k", work) for _ in range(3)))
+        assert results == ["done"] * 3
+        assert len(runs) == 1
+        assert flights.info() == {"started": 1, "coalesced": 2, "abandoned": 0, "in_flight": 0}
+
+    asyncio.run(main())
+
+def test_work_continues_while_a_caller_still_waits():
+    async def main():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "done"
+
+        first = asyncio.create_task(flights.do("k", work))
+        second = asyncio.create_task(flights.do("k", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        release.set()
+        assert await second == "done"
+        assert flights.stats["abandoned"] == 0
+
+    asyncio.run(main())
+
+def test_work_is_cancelled_once_the_last_caller_leaves():
+    async def main():
+        flights = SingleFlight()
+        started, unwound = asyncio.Event(), asyncio.Event()
+
+        async def work():
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            finally:
+                unwound.set()
+
+        caller = asyncio.create_task(flights.do("k", work))
+        await started.wait()
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        # The caller only returns after the shared work has unwound
+        assert unwound.is_set()
+        assert flights.info()["abandoned"] == 1
+        assert flights.info()["in_flight"] == 0
+
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import io
+import os
+import time
+
+import pytest
+
+from storage import REQUEST_BASE_URL, LocalImageStore, parse_range
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=0-1,5-6", None),  # Multipart ranges get the whole image
+    ("items=0-1", None)
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5-2", "bytes=-0", "bytes=a-b"])
+def test_parse_range_rejects_unsatisfiable_ranges(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
+
+def save(store, data, content_type="image/png"):
+    return asyncio.run(store.save(io.BytesIO(data), content_type))
+
+def test_local_store_deduplicates_by_content(tmp_path):
+    store = LocalImageStore(str(tmp_path), base_url="http://cdn.example")
+    url = save(store, b"one")
+    digest = hashlib.sha256(b"one").hexdigest()
+    assert url == f"http://cdn.example/images/{digest}.png"
+    assert save(store, b"one") == url
+    assert store.stats == {"stored": 1, "deduplicated": 1, "evictions": 0}
+    path, content_type, etag = store.lookup(f"{digest}.png")
+    assert (content_type, etag) == ("image/png", f'"{digest}"')
+    assert store.lookup(f"{digest}.webp") is None
+    assert store.lookup("../secrets.png") is None
+
+def test_local_store_urls_follow_the_request_host(tmp_path):
+    store = LocalImageStore(str(tmp_path))
+    REQUEST_BASE_URL.set("http://10.0.0.5:8000/")
+    url = save(store, b"image")
+    assert url.startswith("http://10.0.0.5:8000/images/")
+    REQUEST_BASE_URL.set("https://buddy.example/")
+    # Stored under one host name, still found and re-addressed under another
+    assert store.contains(url)
+    assert store.public_url(url) == url.replace("http://10.0.0.5:8000", "https://buddy.example")
+    assert not store.contains("https://buddy.example/images/" + "0" * 64 + ".png")
+
+def test_local_store_evicts_least_recently_used(tmp_path):
+    store = LocalImageStore(str(tmp_path), base_url="http://h", max_bytes=25)
+    first = save(store, b"a" * 10)
+    second = save(store, b"b" * 10)
+    for age, url in ((200, first), (100, second)):
+        path = store.lookup(url.rpartition("/")[2])[0]
+        os.utime(path, (time.time() - age, time.time() - age))
+    save(store, b"c" * 10)  # Over the cap: the least recently used goes
+    assert not store.contains(first)
+    assert store.stats["evictions"] == 1 and store.total_bytes == 20
+
+def test_images_endpoint_serves_etags_and_ranges(run_backend):
+    async def test(client, app):
+        data = bytes(range(256)) * 4
+        url = await app.state.storage.save(io.BytesIO(data), "image/png")
+        path = "/images/" + url.rpartition("/images/")[2]
+
+        response = await client.get(path)
+        assert response.status_code == 200 and response.content == data
+        etag = response.headers["etag"]
+        assert response.headers["accept-ranges"] == "bytes"
+
+        assert (await client.get(path, headers={"If-None-Match": etag})).status_code == 304
+        assert (await client.get(path, headers={"If-None-Match": '"other"'})).status_code == 200
+
+        response = await client.get(path, headers={"Range": "bytes=10-19"})
+        assert response.status_code == 206 and response.content == data[10:20]
+        assert response.headers["content-range"] == f"bytes 10-19/{len(data)}"
+
+        response = await client.get(path, headers={"Range": f"bytes={len(data)}-"})
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{len(data)}"
+
+        assert (await client.get("/images/" + "0" * 64 + ".png")).status_code == 404
+
+    run_backend(test)